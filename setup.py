@@ -21,6 +21,6 @@ setup(name=PACKAGENAME,
           'numpy',
           'matplotlib'
           ],
-      scripts=['scripts/twopoppyrun'],
+      scripts=['scripts/twopoppyrun', 'scripts/twopoppybench'],
       zip_safe=False
       )
@@ -0,0 +1,675 @@
+"""
+Benchmarks of the two population model.
+
+All benchmarks use the disk of `wrapper.model_wrapper_test` (default
+parameters with rc = 20 AU and alpha = 1e-2) and can be run without network
+or any input files, for example:
+
+    >>> from twopoppy import benchmarks
+    >>> benchmarks.bench_fused_step()
+
+`run_suite` runs all benchmarks of `suite` and returns (or writes) the
+timings together with the versions and the machine as JSON, two such
+reports can be compared with `compare`. The script `twopoppybench` does
+both from the command line:
+
+    $ twopoppybench -o bench.json
+    $ twopoppybench -compare bench.json
+"""
+import timeit
+import numpy as np
+
+
+def canonical_disk(nr=200):
+    """
+    Returns the grid and initial conditions of `wrapper.model_wrapper_test`
+    with nr radial grid points as dictionary with the entries
+    'x', 'sig_g', 'sig_d', 'v_gas', 'T', 'alpha' and 'args'.
+    """
+    from .args import args
+    from .const import AU, Grav, k_b, mu, m_p
+
+    ARGS = args(nr=nr, rc=20 * AU, alpha=1e-2)
+    xi = np.logspace(np.log10(ARGS.r0), np.log10(ARGS.r1), nr + 1)
+    x = 0.5 * (xi[1:] + xi[:-1])
+    T = ((0.05**0.25 * ARGS.tstar * (x / ARGS.rstar)**-0.5)**4 + 7.**4)**0.25
+    alpha = ARGS.alpha * (x / x[0])**(ARGS.gamma - 1)
+    sig_g = ARGS.mdisk * (2. - ARGS.gamma) / (2. * np.pi * ARGS.rc**2) * \
+        (x / ARGS.rc)**-ARGS.gamma * np.exp(-(x / ARGS.rc)**(2. - ARGS.gamma))
+    sig_g = np.maximum(sig_g, 1e-100)
+    v_gas = -3.0 * alpha * k_b * T / mu / m_p / 2. / np.sqrt(Grav * ARGS.mstar / x) * (1. + 7. / 4.)
+    return {'x': x, 'sig_g': sig_g, 'sig_d': ARGS.d2g * sig_g, 'v_gas': v_gas, 'T': T, 'alpha': alpha,
+            'args': ARGS}
+
+
+def _best_time(func, repeat, number):
+    """
+    Returns the best time per call of `func` in seconds.
+    """
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def bench_fused_step(nrs=(200, 1000, 5000), repeat=5, number=20, verbose=True):
+    """
+    Time one dust step of `model.run` done by the fused numba kernel against
+    the numpy path (`get_size_limits`, `get_velocities_diffusion`,
+    `impl_donorcell_adv_diff_delta` and `tridag`).
+
+    Keywords:
+    ---------
+
+    nrs : list
+        numbers of radial grid points
+
+    repeat, number : int
+        the best of `repeat` timings of `number` calls is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per grid size with the keys 'nr', 'numpy', 'jit' (seconds
+        per step) and 'speedup'.
+    """
+    from .const import year
+    from .utils import get_size_limits
+    from .kernels import fused_step, has_numba
+
+    result = []
+    for nr in nrs:
+        d = canonical_disk(nr)
+        a = d['args']
+        x = d['x']
+        u_in = d['sig_d'] * x
+        a_grow = get_size_limits(0.0, d['sig_d'], x, d['sig_g'], d['v_gas'], d['T'], d['alpha'], a.mstar, a.a0,
+                                 a.vfrag, a.rhos, a.edrift, E_stick=a.estick)['a_grow']
+        timings = {'nr': nr}
+        for name, use_jit in [('numpy', False), ('jit', True)]:
+            def step():
+                fused_step(x, u_in, d['sig_g'], d['v_gas'], d['T'], d['alpha'], a.mstar, a.a0, a.vfrag, a.rhos,
+                           a.edrift, a.estick, a_grow, 10 * year, use_jit=use_jit)
+            step()
+            timings[name] = _best_time(step, repeat, number)
+        timings['speedup'] = timings['numpy'] / timings['jit']
+        result.append(timings)
+
+    if verbose:
+        if not has_numba():
+            print('numba is not installed, both timings use numpy')
+        print('{:>8s} {:>14s} {:>14s} {:>10s}'.format('nr', 'numpy [ms]', 'jit [ms]', 'speedup'))
+        for r in result:
+            print('{:8d} {:14.4f} {:14.4f} {:10.1f}'.format(r['nr'], 1e3 * r['numpy'], 1e3 * r['jit'], r['speedup']))
+
+    return result
+
+
+def bench_results_io(shapes=((100, 200), (300, 1000)), repeat=3, verbose=True):
+    """
+    Compare writing and reading `results` in the binary ('npy') and the
+    text ('txt') format, see `results.write`. Reading the binary format is
+    timed with and without memory mapping, in both cases all data is
+    accessed once.
+
+    Keywords:
+    ---------
+
+    shapes : list
+        (nt, nr) of the snapshot arrays
+
+    repeat : int
+        the best of `repeat` timings is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per shape and format with the keys 'nt', 'nr', 'fmt',
+        'write', 'read' (seconds), 'read_mmap' (seconds, binary only) and
+        'size' (bytes)
+    """
+    import io
+    import os
+    import tempfile
+    import contextlib
+    from .args import args
+    from .results import results, _fields
+
+    def load(dirname, mmap):
+        res = results()
+        with contextlib.redirect_stdout(io.StringIO()):
+            res.read(dirname, mmap=mmap)
+        for attr, _ in _fields:
+            value = getattr(res, attr)
+            if value is not None:
+                value.sum()
+
+    result = []
+    rng = np.random.RandomState(0)
+    for nt, nr in shapes:
+        res = results()
+        res.args = args(nr=nr, nt=nt)
+        res.x = np.logspace(13, 16, nr)
+        res.timesteps = np.logspace(10, 14, nt)
+        res.T = rng.rand(nr)
+        res.alpha = 1e-3
+        for name in ['sigma_g', 'sigma_d', 'v_gas', 'v_dust', 'v_0', 'v_1', 'a_dr', 'a_fr', 'a_df', 'a_t']:
+            setattr(res, name, 10**(10 * rng.rand(nt, nr) - 5))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in ['npy', 'txt']:
+                dirname = os.path.join(tmp, fmt)
+
+                def write():
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        res.write(dirname, fmt=fmt)
+
+                timings = {'nt': nt, 'nr': nr, 'fmt': fmt}
+                timings['write'] = _best_time(write, repeat, 1)
+                timings['read'] = _best_time(lambda: load(dirname, False), repeat, 1)
+                if fmt == 'npy':
+                    timings['read_mmap'] = _best_time(lambda: load(dirname, True), repeat, 1)
+                timings['size'] = sum(os.path.getsize(os.path.join(dirname, f)) for f in os.listdir(dirname))
+                result.append(timings)
+
+    if verbose:
+        print('{:>6s} {:>6s} {:>4s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+            'nt', 'nr', 'fmt', 'write [s]', 'read [s]', 'mmap [s]', 'size [MB]'))
+        for r in result:
+            print('{:6d} {:6d} {:>4s} {:10.4f} {:10.4f} {:>10s} {:10.2f}'.format(
+                r['nt'], r['nr'], r['fmt'], r['write'], r['read'],
+                '{:.4f}'.format(r['read_mmap']) if 'read_mmap' in r else '-', r['size'] / 1e6))
+
+    return result
+
+
+def bench_grid_io(n_models=10, nt=100, nr=200, compressions=('gzip', 'xz', 'chunked'), repeat=1, verbose=True):
+    """
+    Compare writing and reading a list of `results` with
+    `wrapper.write_grid_results` and `wrapper.load_grid_results` for
+    different compressions. 'chunked' compresses on all cores, see
+    `compression.chunked_file`.
+
+    Keywords:
+    ---------
+
+    n_models : int
+        number of results in the list
+
+    nt, nr : int
+        shape of the snapshot arrays
+
+    compressions : list
+        keys of `wrapper.compressors`
+
+    repeat : int
+        the best of `repeat` timings is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per compression with the keys 'compression', 'write',
+        'read' (seconds) and 'size' (bytes)
+    """
+    import io
+    import os
+    import tempfile
+    import contextlib
+    from .args import args
+    from .results import results
+    from .wrapper import write_grid_results, load_grid_results, compressors
+
+    rng = np.random.RandomState(0)
+    grid = []
+    for i in range(n_models):
+        res = results()
+        res.args = args(nr=nr, nt=nt)
+        res.x = np.logspace(13, 16, nr)
+        res.timesteps = np.logspace(10, 14, nt)
+        for name in ['sigma_g', 'sigma_d', 'v_gas', 'v_dust', 'a_t']:
+            setattr(res, name, np.cumsum(rng.rand(nt, nr), axis=1))
+        grid.append(res)
+
+    result = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in compressions:
+            fname = os.path.join(tmp, 'grid')
+            fname_out = fname + os.path.extsep + compressors[compression][1]
+
+            def write():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    write_grid_results(grid, fname, compression=compression)
+
+            def read():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    load_grid_results(fname_out)
+
+            timings = {'compression': compression}
+            timings['write'] = _best_time(write, repeat, 1)
+            timings['read'] = _best_time(read, repeat, 1)
+            timings['size'] = os.path.getsize(fname_out)
+            result.append(timings)
+
+    if verbose:
+        print('{:>12s} {:>10s} {:>10s} {:>10s}'.format('compression', 'write [s]', 'read [s]', 'size [MB]'))
+        for r in result:
+            print('{:>12s} {:10.4f} {:10.4f} {:10.2f}'.format(r['compression'], r['write'], r['read'], r['size'] / 1e6))
+
+    return result
+
+
+def _quiet(func, *args, **kwargs):
+    """
+    Calls func without printing (e.g. the progress bar of `model.run`).
+    """
+    import io
+    import contextlib
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def bench_tridag(nrs=(200, 1000, 5000), backends=None, repeat=5, number=50, verbose=True):
+    """
+    Time `model.tridag` with the dust transport matrix of the canonical
+    disk for every solver backend.
+
+    Keywords:
+    ---------
+
+    nrs : list
+        numbers of radial grid points
+
+    backends : None | list
+        solver backends, defaults to all that are available
+
+    repeat, number : int
+        the best of `repeat` timings of `number` calls is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per grid size and backend with the keys 'nr', 'backend'
+        and 'time' (seconds per solve)
+    """
+    from .const import year
+    from .kernels import has_numba
+    from .model import tridag, workspace, impl_donorcell_adv_diff_delta, _tridag_backends
+
+    if backends is None:
+        backends = [b for b in _tridag_backends if b != 'numba' or has_numba()]
+
+    result = []
+    for nr in nrs:
+        d = canonical_disk(nr)
+        x = d['x']
+        ws = workspace(nr)
+        A, B, C, D = [np.zeros(nr) for _ in range(4)]
+        #
+        # assemble the matrix of one dust step
+        #
+        impl_donorcell_adv_diff_delta(nr, x, 1e16 * np.ones(nr), d['v_gas'], np.ones(nr), d['sig_g'] * x,
+                                      np.zeros(nr), np.zeros(nr), np.ones(nr), d['sig_d'] * x, 10 * year,
+                                      0, 1, 1, 0, 0, d['sig_d'][0] * x[0], 1, A, B, C, D)
+        for backend in backends:
+            def solve():
+                tridag(A, B, C, D, nr, backend=backend, ws=ws)
+            solve()
+            result.append({'nr': nr, 'backend': backend, 'time': _best_time(solve, repeat, number)})
+
+    if verbose:
+        print('{:>8s} {:>8s} {:>12s}'.format('nr', 'backend', 'time [us]'))
+        for r in result:
+            print('{:8d} {:>8s} {:12.2f}'.format(r['nr'], r['backend'], 1e6 * r['time']))
+
+    return result
+
+
+def bench_donorcell(nrs=(200, 1000, 5000), repeat=5, number=20, verbose=True):
+    """
+    Time one dust transport step with `model.impl_donorcell_adv_diff_delta`
+    (matrix assembly and solve) using a `model.workspace`, with the default
+    solver backend.
+
+    Keywords:
+    ---------
+
+    nrs : list
+        numbers of radial grid points
+
+    repeat, number : int
+        the best of `repeat` timings of `number` calls is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per grid size with the keys 'nr' and 'time' (seconds per
+        step)
+    """
+    from .const import year
+    from .model import workspace, impl_donorcell_adv_diff_delta
+
+    result = []
+    for nr in nrs:
+        d = canonical_disk(nr)
+        x = d['x']
+        ws = workspace(nr)
+        D = 1e16 * np.ones(nr)
+        h = d['sig_g'] * x
+        u = d['sig_d'] * x
+
+        def step():
+            impl_donorcell_adv_diff_delta(nr, x, D, d['v_gas'], ws.ones, h, ws.zeros, ws.zeros, ws.ones, u,
+                                          10 * year, 0, 1, 1, 0, 0, u[0], 1, ws.A, ws.B, ws.C, ws.D, ws=ws,
+                                          out=ws.u_dust)
+        step()
+        result.append({'nr': nr, 'time': _best_time(step, repeat, number)})
+
+    if verbose:
+        print('{:>8s} {:>12s}'.format('nr', 'time [us]'))
+        for r in result:
+            print('{:8d} {:12.2f}'.format(r['nr'], 1e6 * r['time']))
+
+    return result
+
+
+def bench_run(setups=((100, 20), (200, 50), (400, 50)), tmax=1e5, repeat=1, verbose=True):
+    """
+    Time a full `model.run` of the canonical disk.
+
+    Keywords:
+    ---------
+
+    setups : list
+        (nr, nt) of the runs
+
+    tmax : float
+        end time of the runs [years], the snapshots are logarithmically
+        spaced from 100 years on
+
+    repeat : int
+        the best of `repeat` timings is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per setup with the keys 'nr', 'nt', 'time' (seconds),
+        'n_steps' (accepted steps) and 'per_step' (seconds)
+    """
+    from .const import year
+    from .model import run, run_stats
+
+    result = []
+    for nr, nt in setups:
+        d = canonical_disk(nr)
+        a = d['args']
+        time = np.logspace(2, np.log10(tmax), nt) * year
+        stats = []
+
+        def go():
+            stats.append(run_stats())
+            _quiet(run, d['x'], a.a0, time, d['sig_g'], d['sig_d'], d['v_gas'], d['T'], d['alpha'], a.mstar,
+                   a.vfrag, a.rhos, a.edrift, E_stick=a.estick, stats=stats[-1])
+
+        seconds = _best_time(go, repeat, 1)
+        n_steps = stats[-1].n_accepted
+        result.append({'nr': nr, 'nt': nt, 'time': seconds, 'n_steps': n_steps, 'per_step': seconds / n_steps})
+
+    if verbose:
+        print('{:>6s} {:>6s} {:>10s} {:>8s} {:>12s}'.format('nr', 'nt', 'time [s]', 'steps', 'step [us]'))
+        for r in result:
+            print('{:6d} {:6d} {:10.4f} {:8d} {:12.2f}'.format(r['nr'], r['nt'], r['time'], r['n_steps'],
+                                                               1e6 * r['per_step']))
+
+    return result
+
+
+def bench_reconstruction(shapes=((200, 150), (400, 300)), tmax=1e5, repeat=3, verbose=True):
+    """
+    Time `distribution_reconstruction.reconstruct_size_distribution` for
+    the last snapshot of a run of the canonical disk.
+
+    Keywords:
+    ---------
+
+    shapes : list
+        (nr, na), the number of radial grid points and particle sizes
+
+    tmax : float
+        time of the snapshot [years]
+
+    repeat : int
+        the best of `repeat` timings is used
+
+    verbose : bool
+        print a table of the results
+
+    Output:
+    -------
+
+    result : list
+        one dict per shape with the keys 'nr', 'na' and 'time' (seconds)
+    """
+    import warnings
+    from .const import year
+    from .model import run
+    from .distribution_reconstruction import reconstruct_size_distribution
+
+    result = []
+    for nr, na in shapes:
+        d = canonical_disk(nr)
+        a = d['args']
+        time = np.array([100., tmax]) * year
+        out = _quiet(run, d['x'], a.a0, time, d['sig_g'], d['sig_d'], d['v_gas'], d['T'], d['alpha'], a.mstar,
+                     a.vfrag, a.rhos, a.edrift, E_stick=a.estick)
+        sig_d, sig_g, a_t = out[1][-1], out[2][-1], out[10][-1]
+        sizes = np.logspace(np.log10(a.a0), np.log10(5 * a_t.max()), na)
+
+        def reconstruct():
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                reconstruct_size_distribution(d['x'], sizes, time[-1], sig_g, sig_d, d['alpha'], a.rhos, d['T'],
+                                              a.mstar, a.vfrag, a_0=a.a0, estick=a.estick)
+
+        result.append({'nr': nr, 'na': na, 'time': _best_time(reconstruct, repeat, 1)})
+
+    if verbose:
+        print('{:>6s} {:>6s} {:>10s}'.format('nr', 'na', 'time [s]'))
+        for r in result:
+            print('{:6d} {:6d} {:10.4f}'.format(r['nr'], r['na'], r['time']))
+
+    return result
+
+
+def environment():
+    """
+    Returns a dict describing the versions and the machine, which is stored
+    with the benchmark results.
+    """
+    import os
+    import sys
+    import platform
+    import datetime
+    import scipy
+    from .kernels import has_numba
+
+    return {
+        'twopoppy': getattr(sys.modules[__package__], '__version__', None),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'numba': has_numba(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'executable': sys.executable,
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        }
+
+
+suite = {
+    'tridag': bench_tridag,
+    'donorcell': bench_donorcell,
+    'fused_step': bench_fused_step,
+    'run': bench_run,
+    'reconstruction': bench_reconstruction,
+    'results_io': bench_results_io,
+    'grid_io': bench_grid_io,
+    }
+
+quick = {
+    'tridag': {'nrs': (200, 1000), 'repeat': 3, 'number': 10},
+    'donorcell': {'nrs': (200, 1000), 'repeat': 3, 'number': 5},
+    'fused_step': {'nrs': (200, 1000), 'repeat': 3, 'number': 5},
+    'run': {'setups': ((100, 10),), 'tmax': 1e4},
+    'reconstruction': {'shapes': ((100, 50),), 'repeat': 1},
+    'results_io': {'shapes': ((50, 100),), 'repeat': 1},
+    'grid_io': {'n_models': 3, 'nt': 20, 'nr': 100, 'compressions': ('gzip', 'chunked')},
+    }
+
+
+def run_suite(names=None, fast=False, fname=None, verbose=False):
+    """
+    Run the benchmarks and collect the results in a JSON-serializable dict
+    that can be compared between versions with `compare`.
+
+    Keywords:
+    ---------
+
+    names : None | list
+        keys of `suite`, defaults to all benchmarks
+
+    fast : bool
+        use the small settings in `quick`, e.g. for testing
+
+    fname : None | str
+        if given, the results are written to this JSON file
+
+    verbose : bool
+        print the table of every benchmark
+
+    Output:
+    -------
+
+    report : dict
+        'environment': see `environment`,
+        'benchmarks': benchmark name: list of results
+    """
+    import json
+
+    names = list(suite.keys()) if names is None else names
+    unknown = set(names) - set(suite.keys())
+    if unknown:
+        raise ValueError('unknown benchmarks {}, use a subset of {}'.format(
+            ', '.join(sorted(unknown)), ', '.join(suite.keys())))
+
+    report = {'environment': environment(), 'benchmarks': {}}
+    for name in names:
+        kwargs = quick[name] if fast else {}
+        report['benchmarks'][name] = suite[name](verbose=verbose, **kwargs)
+
+    if fname is not None:
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+_keys = ['nr', 'nt', 'na', 'backend', 'fmt', 'compression']
+
+
+def compare(old, new, threshold=1.2):
+    """
+    Compare two reports of `run_suite` and list the timings that changed.
+
+    Arguments:
+    ----------
+
+    old, new : dict | str
+        the reports or the names of their JSON files
+
+    Keywords:
+    ---------
+
+    threshold : float
+        timings that are slower (or faster) by more than this factor are
+        flagged
+
+    Output:
+    -------
+
+    changes : list
+        (benchmark, setup, quantity, old, new, ratio, flag) for every
+        timing that is in both reports, flag is 'slower', 'faster' or ''
+    """
+    import json
+
+    reports = []
+    for report in [old, new]:
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append(report['benchmarks'])
+
+    changes = []
+    for name, new_results in reports[1].items():
+        old_results = {tuple((k, r[k]) for k in _keys if k in r): r for r in reports[0].get(name, [])}
+        for r in new_results:
+            setup = tuple((k, r[k]) for k in _keys if k in r)
+            if setup not in old_results:
+                continue
+            for quantity in ['time', 'per_step', 'numpy', 'jit', 'write', 'read', 'read_mmap']:
+                if quantity in r and quantity in old_results[setup]:
+                    ratio = r[quantity] / old_results[setup][quantity]
+                    flag = 'slower' if ratio > threshold else 'faster' if ratio < 1 / threshold else ''
+                    changes.append((name, dict(setup), quantity, old_results[setup][quantity], r[quantity], ratio,
+                                    flag))
+    return changes
+
+
+def benchmarks_test():
+    """
+    Run the benchmark suite with the small settings, check that the
+    report survives a round trip through JSON and that comparing it with
+    itself shows no changes.
+
+    Output:
+    -------
+
+    report : dict
+        the report of `run_suite`
+    """
+    import os
+    import json
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'bench.json')
+        report = run_suite(fast=True, fname=fname)
+        with open(fname) as f:
+            assert json.load(f) == json.loads(json.dumps(report)), 'report is not JSON-serializable'
+        changes = compare(fname, report)
+
+    assert set(report['benchmarks'].keys()) == set(suite.keys())
+    assert all(len(results) > 0 for results in report['benchmarks'].values()), 'a benchmark returned nothing'
+    assert changes and all(ratio == 1.0 and flag == '' for *_, ratio, flag in changes)
+    return report
@@ -0,0 +1,259 @@
+"""
+Callbacks for the temperature, alpha and alpha_gas of `model.run`.
+
+T, alpha and alpha_gas can be functions `func(x, state)` of the radial grid
+and a `callback_state`, which gives access to the current model state:
+
+    >>> def T(x, state):
+    ...     return 10 * (x / x[-1])**-1.5 * state.sig_g / state.sig_g[-1]
+
+If a function does not depend on the state, it can say so, and it is then
+not evaluated every step:
+
+    >>> @callbacks.static
+    ... def alpha(x, state):
+    ...     return 1e-3 * (x / AU)**0.5
+
+    >>> @callbacks.time_only
+    ... def T(x, state):
+    ...     return 200 * (x / AU)**-0.5 * (1 + state.t / (1e6 * year))**-0.25
+
+Functions written for the older interface `func(x, locals_)`, which index
+`locals_` by name (e.g. `locals_['sig_g']` or `locals_['stats']`), keep
+working, as the state also supports item access to all attributes of the
+`model.integrator`.
+"""
+
+
+def static(func):
+    """
+    Marks a callback that only depends on x. It is evaluated once at the
+    start of the run.
+    """
+    func.depends = 'static'
+    return func
+
+
+def time_only(func):
+    """
+    Marks a callback that only depends on x and the time `state.t`. It is
+    evaluated again only if the time changed.
+    """
+    func.depends = 'time'
+    return func
+
+
+def depends(func):
+    """
+    Returns what a callback depends on: 'static', 'time' or 'state' (the
+    default for functions that are not marked).
+    """
+    return getattr(func, 'depends', 'state')
+
+
+class callback_state(object):
+    """
+    The model state that is passed to the callbacks. It is a view of the
+    `model.integrator`, so the callbacks should not keep it or modify
+    the arrays.
+
+    Attributes:
+    -----------
+
+    x : array
+        radial grid                     [cm]
+
+    t : float
+        time at the start of the step   [s]
+
+    dt : float
+        the time step that is about to be taken [s]
+
+    sig_g, sig_d : array
+        gas and dust surface density    [g cm^-2]
+
+    v_gas : array
+        gas velocity                    [cm s^-1]
+
+    a_max : None | array
+        the particle size of the last step (`size_limits['a_max']`, which
+        `model.run` returns as `a_t`), None before the first size limits
+        are computed                    [cm]
+
+    m_star : float
+        stellar mass                    [g]
+
+    stats : run_stats
+        counters of the steps so far
+
+    Item access, e.g. `state['sig_g']`, returns the attributes above or
+    any other attribute of the integrator, like the dictionary that older
+    callbacks received.
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    x = property(lambda self: self._model.x)
+    t = property(lambda self: self._model.t)
+    dt = property(lambda self: self._model.dt)
+    sig_g = property(lambda self: self._model.sig_g)
+    sig_d = property(lambda self: self._model.sig_d)
+    v_gas = property(lambda self: self._model.v_gas)
+    m_star = property(lambda self: self._model.m_star)
+    stats = property(lambda self: self._model.stats)
+
+    @property
+    def a_max(self):
+        size_limits = getattr(self._model, 'size_limits', None)
+        return None if size_limits is None else size_limits['a_max']
+
+    def __getitem__(self, name):
+        if name == 'a_max':
+            return self.a_max
+        try:
+            return getattr(self._model, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name == 'a_max' or hasattr(self._model, name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(vars(self._model).keys()) + ['a_max']
+
+
+class profile(object):
+    """
+    Evaluates a constant or a callback, and caches the value of static and
+    time-only callbacks.
+
+    Arguments:
+    ----------
+
+    value : float | array | function
+        the profile, functions are called as `value(x, state)`
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.func = value if hasattr(value, '__call__') else None
+        self.depends = 'static' if self.func is None else depends(self.func)
+        self.n_calls = 0
+        self._t = None
+
+    def __call__(self, x, state):
+        if self.func is None:
+            return self.value
+        if self.n_calls > 0 and (self.depends == 'static' or (self.depends == 'time' and state.t == self._t)):
+            return self.value
+        self.value = self.func(x, state)
+        self._t = state.t
+        self.n_calls += 1
+        return self.value
+
+
+def callbacks_test(nr=100, nt=10):
+    """
+    Run a model with callbacks of the old `(x, locals_)` form and with the
+    same callbacks using the state attributes and check that the results are
+    identical. Then check that static and time-only callbacks are evaluated
+    only once and once per step, and that they give the same results as
+    unmarked callbacks.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    n_calls : dict
+        the number of evaluations of the marked and unmarked callbacks
+    """
+    import numpy as np
+    from . import model
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 5, nt) * year
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    T_0 = 200 * (x / AU)**-0.5 + 10
+    v_gas = -1.5e-3 * k_b * T_0 / mu / m_p / np.sqrt(Grav * M_sun / x)
+    setup = (x, 1e-5, time, sig_g, sig_d, v_gas)
+    params = (M_sun, 1000., 1.6, 1.0)
+
+    def T_locals(x, locals_):
+        return T_0 * (locals_['sig_g'] / sig_g)**0.1 * (1 + locals_['t'] / (1e5 * year))**-0.1
+
+    def T_state(x, state):
+        return T_0 * (state.sig_g / sig_g)**0.1 * (1 + state.t / (1e5 * year))**-0.1
+
+    def alpha_locals(x, locals_):
+        assert locals_['stats'] is locals_.get('stats') and 'u_in' in locals_
+        return 1e-3 * (x / AU)**0.25
+
+    ref = model.run(*setup, T_locals, alpha_locals, *params)
+    res = model.run(*setup, T_state, alpha_locals, *params)
+    for a, b in zip(ref, res):
+        assert np.array_equal(a, b), 'state and locals callbacks differ'
+
+    #
+    # the size seen at the start of the step after a snapshot is the
+    # returned a_t of that snapshot
+    #
+    seen = {}
+
+    def alpha_a_max(x, state):
+        if state.a_max is not None:
+            assert state['a_max'] is state.a_max
+            seen[state.t] = state.a_max.copy()
+        return 1e-3 * (x / AU)**0.25
+
+    res = model.run(*setup, T_state, alpha_a_max, *params)
+    a_t = res[10]
+    for it in range(nt - 1):
+        assert np.array_equal(seen[time[it]], a_t[it]), 'state.a_max differs from a_t'
+
+    n_calls = {'static': 0, 'time': 0, 'state': 0}
+
+    def count(kind):
+        n_calls[kind] += 1
+
+    @static
+    def alpha_static(x, state):
+        count('static')
+        return 1e-3 * (x / AU)**0.25
+
+    @time_only
+    def T_time(x, state):
+        count('time')
+        return T_0 * (1 + state.t / (1e5 * year))**-0.1
+
+    def T_plain(x, state):
+        count('state')
+        return T_0 * (1 + state.t / (1e5 * year))**-0.1
+
+    stats = model.run_stats()
+    ref = model.run(*setup, T_plain, lambda x, state: 1e-3 * (x / AU)**0.25, *params)
+    res = model.run(*setup, T_time, alpha_static, *params, stats=stats)
+    for a, b in zip(ref, res):
+        assert np.array_equal(a, b), 'cached callbacks differ'
+    assert n_calls['static'] == 1, 'static callback evaluated {} times'.format(n_calls['static'])
+    #
+    # the first step starts at the time of the initial evaluation
+    #
+    assert n_calls['time'] == stats.n_accepted, 'time-only callback evaluated more than once per time'
+    assert n_calls['state'] == stats.n_accepted + 1, 'unmarked callback not evaluated every step'
+
+    return n_calls
@@ -0,0 +1,259 @@
+"""
+Chunked compression that uses several cores.
+
+`chunked_file` is a file-like object that splits the data into chunks which
+are compressed independently in a thread pool (zlib, lzma and bz2 release the
+GIL while they work). When reading, the chunks are decompressed in parallel
+as well. It is registered in `wrapper.compressors`, so it can be used for grid
+results:
+
+    >>> from twopoppy import wrapper
+    >>> wrapper.write_grid_results(res, 'grid', compression='chunked')
+    >>> res = wrapper.load_grid_results('grid.pzc')
+
+File layout:
+
+    magic           8 bytes, `MAGIC`
+    codec           1 byte, index into `_codec_names`
+    chunks          any number of: compressed length (8 bytes, little
+                    endian), raw length (8 bytes), compressed data
+"""
+import zlib
+import lzma
+import bz2
+import struct
+
+MAGIC = b'2POPCHK\x00'
+_codec_names = ['zlib', 'lzma', 'bz2']
+_codecs = {
+    'zlib': [lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress],
+    'lzma': [lambda data, level: lzma.compress(data, preset=level), lzma.decompress],
+    'bz2': [lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress]}
+_header = struct.Struct('<QQ')
+
+
+class chunked_file(object):
+    """
+    File object that compresses or decompresses independent chunks in
+    parallel.
+
+    Arguments:
+    ----------
+
+    fname : str
+        file name
+
+    Keywords:
+    ---------
+
+    mode : str
+        'r'/'rb' for reading, 'w'/'wb' for writing
+
+    codec : str
+        compression of the chunks when writing, one of 'zlib', 'lzma', 'bz2'.
+        When reading, the codec is taken from the file.
+
+    level : None | int
+        compression level (preset for lzma), None uses the default of the
+        codec
+
+    chunk_size : int
+        size of the uncompressed chunks in bytes
+
+    workers : None | int
+        number of threads, defaults to the number of CPUs
+    """
+
+    def __init__(self, fname, mode='r', codec='zlib', level=None, chunk_size=4 * 2**20, workers=None):
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+
+        if mode not in ['r', 'rb', 'w', 'wb']:
+            raise ValueError('mode needs to be \'r\' or \'w\'')
+        self.writing = mode.startswith('w')
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.f = open(fname, 'wb' if self.writing else 'rb')
+
+        if self.writing:
+            if codec not in _codecs:
+                self.close()
+                raise ValueError('codec needs to be one of {}'.format(', '.join(_codec_names)))
+            self.codec = codec
+            self.level = level
+            self.buffer = bytearray()
+            self.f.write(MAGIC + bytes([_codec_names.index(codec)]))
+        else:
+            start = self.f.read(len(MAGIC) + 1)
+            if len(start) < len(MAGIC) + 1 or start[:len(MAGIC)] != MAGIC or start[-1] >= len(_codec_names):
+                self.close()
+                raise IOError('{} is not a chunked file'.format(fname))
+            self.codec = _codec_names[start[-1]]
+            self.chunk = b''
+            self.pos = 0
+            self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    # ------- writing
+
+    def _submit(self, data):
+        """
+        Compress the chunk in the thread pool and write the finished chunks,
+        keeping at most two chunks per thread in memory.
+        """
+        self.pending.append(self.executor.submit(_codecs[self.codec][0], data, self.level))
+        self.pending[-1].raw_length = len(data)
+        while len(self.pending) > 2 * self.workers:
+            self._write_next()
+
+    def _write_next(self):
+        future = self.pending.pop(0)
+        data = future.result()
+        self.f.write(_header.pack(len(data), future.raw_length))
+        self.f.write(data)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._submit(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # ------- reading
+
+    def _read_ahead(self):
+        """
+        Submit the decompression of the next chunks, up to two per thread.
+        """
+        while not self.eof and len(self.pending) < 2 * self.workers:
+            header = self.f.read(_header.size)
+            if len(header) == 0:
+                self.eof = True
+                break
+            if len(header) < _header.size:
+                raise IOError('chunked file is truncated')
+            length, raw_length = _header.unpack(header)
+            data = self.f.read(length)
+            if len(data) < length:
+                raise IOError('chunked file is truncated')
+            self.pending.append(self.executor.submit(_codecs[self.codec][1], data))
+            self.pending[-1].raw_length = raw_length
+
+    def _next_chunk(self):
+        """
+        Make the next chunk the current one, returns False at the end of
+        the file.
+        """
+        self._read_ahead()
+        if len(self.pending) == 0:
+            return False
+        future = self.pending.pop(0)
+        self.chunk = future.result()
+        self.pos = 0
+        if len(self.chunk) != future.raw_length:
+            raise IOError('chunked file is damaged')
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos == len(self.chunk) and not self._next_chunk():
+                break
+            n = len(self.chunk) - self.pos if size < 0 else min(size, len(self.chunk) - self.pos)
+            parts.append(self.chunk[self.pos:self.pos + n])
+            self.pos += n
+            if size > 0:
+                size -= n
+        return b''.join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.pos == len(self.chunk) and not self._next_chunk():
+                break
+            end = self.chunk.find(b'\n', self.pos)
+            stop = len(self.chunk) if end < 0 else end + 1
+            parts.append(self.chunk[self.pos:stop])
+            self.pos = stop
+            if end >= 0:
+                break
+        return b''.join(parts)
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            if self.writing:
+                if len(self.buffer) > 0:
+                    self._submit(bytes(self.buffer))
+                    self.buffer = bytearray()
+                while self.pending:
+                    self._write_next()
+        finally:
+            self.executor.shutdown()
+            self.pending = []
+            self.f.close()
+
+
+def chunked_test(size=2**21, chunk_size=2**17):
+    """
+    Round trip of random and compressible data through `chunked_file` with
+    all codecs, reading in pieces of different sizes and with `readline`,
+    and check that every chunk decompresses on its own.
+
+    Keywords:
+    ---------
+
+    size : int
+        number of bytes to write
+
+    chunk_size : int
+        chunk size, choose it smaller than size to have several chunks
+
+    Output:
+    -------
+
+    ratios : dict
+        compression ratio of every codec
+    """
+    import os
+    import tempfile
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4, size, dtype=np.uint8).tobytes() + b'\n' + os.urandom(size // 8)
+
+    ratios = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'test.pzc')
+        for codec in _codec_names:
+            with chunked_file(fname, 'w', codec=codec, chunk_size=chunk_size, workers=3) as f:
+                for i in range(0, len(data), 100000):
+                    f.write(data[i:i + 100000])
+
+            with chunked_file(fname) as f:
+                assert f.read() == data, codec + ' round trip failed'
+
+            with chunked_file(fname) as f:
+                parts = [f.read(1), f.read(12345), f.readline(), f.read(chunk_size + 1), f.read()]
+                assert b''.join(parts) == data and parts[2].endswith(b'\n'), codec + ' partial reads failed'
+
+            with open(fname, 'rb') as f:
+                f.seek(len(MAGIC) + 1)
+                length, _ = _header.unpack(f.read(_header.size))
+                f.seek(length, 1)
+                length, _ = _header.unpack(f.read(_header.size))
+                assert _codecs[codec][1](f.read(length)) == data[chunk_size:2 * chunk_size], 'chunks are not independent'
+
+            ratios[codec] = len(data) / os.path.getsize(fname)
+    return ratios
@@ -0,0 +1,346 @@
+"""
+Optional numba-compiled kernels of the two population model.
+
+The kernels are written as plain python functions operating on arrays
+element by element, they are compiled with numba on first use. If numba is
+not installed, the functions `fused_step` and `model.tridag` fall back to
+the numpy implementations.
+"""
+import numpy as np
+from .const import k_b, mu, m_p, Grav, sig_h2
+
+_compiled = {}
+
+
+def has_numba():
+    """
+    Returns True if numba is installed.
+    """
+    if 'numba' not in _compiled:
+        from importlib.util import find_spec
+        _compiled['numba'] = find_spec('numba') is not None
+    return _compiled['numba']
+
+
+def jit(name):
+    """
+    Returns the numba-compiled version of the kernel `_<name>` of this module,
+    compiling it on first use.
+    """
+    if name not in _compiled:
+        import numba
+        _compiled[name] = numba.njit(cache=True)(globals()['_' + name])
+    return _compiled[name]
+
+
+def fused_step(x, u_in, sig_g, v_gas, T, alpha, m_star, a_0, V_FRAG, RHO_S, E_drift, E_stick,
+               a_grow_prev, dt, stokesregime=False, use_jit=True, solver=None):
+    """
+    Performs one dust time step of `model.run`: calculates the size limits,
+    the velocities and the diffusivity, assembles the transport equation and
+    solves it. With numba, all of this happens in a single compiled call
+    without intermediate python objects.
+
+    Arguments:
+    ----------
+
+    x : array
+        radial grid (nr)                        [cm]
+
+    u_in : array
+        sigma_d * x at the beginning of the step [g cm^-1]
+
+    sig_g, v_gas, T, alpha : array
+        gas surface density, gas velocity, temperature and
+        turbulence parameter (nr)
+
+    m_star, a_0, V_FRAG, RHO_S, E_drift, E_stick : float
+        see `model.run`
+
+    a_grow_prev : array
+        growth limit of the previous step (nr)  [cm]
+
+    dt : float
+        time step                               [s]
+
+    Keywords:
+    ---------
+
+    stokesregime : bool
+        include the first Stokes drag regime
+
+    use_jit : bool
+        use the numba kernel if numba is installed, otherwise
+        `utils.get_size_limits`, `utils.get_velocities_diffusion` and
+        `model.impl_donorcell_adv_diff_delta` are called.
+
+    solver : None | str
+        tridiagonal solver backend for the numpy path, see `model.tridag`
+
+    Output:
+    -------
+
+    u_dust, size_limits, velocities
+
+    u_dust : array
+        sigma_d * x at the end of the step
+
+    size_limits : dict
+        the entries 'a_max', 'a_df', 'a_fr', 'a_dr' and 'a_grow' as
+        returned by `utils.get_size_limits`
+
+    velocities : dict
+        'v_bar', 'D', 'v_0', 'v_1' as returned by
+        `utils.get_velocities_diffusion`, but 'v_bar' and 'D' already have
+        the boundary values used in the transport step.
+    """
+    if use_jit and has_numba():
+        n_r = len(x)
+
+        def arr(value):
+            return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=float), (n_r,)))
+
+        out = np.zeros([10, n_r])
+        jit('dust_step')(
+            arr(x), arr(u_in), arr(sig_g), arr(v_gas), arr(T), arr(alpha), float(m_star), float(a_0),
+            float(V_FRAG), float(RHO_S), float(E_drift), float(E_stick), bool(stokesregime),
+            arr(a_grow_prev), float(dt), out)
+        u_dust, a_max, a_df, a_fr, a_dr, a_grow, v_bar, D, v_0, v_1 = out
+        size_limits = {'a_max': a_max, 'a_df': a_df, 'a_fr': a_fr, 'a_dr': a_dr, 'a_grow': a_grow}
+        velocities = {'v_bar': v_bar, 'D': D, 'v_0': v_0, 'v_1': v_1}
+        return u_dust, size_limits, velocities
+
+    from .utils import get_size_limits, get_velocities_diffusion
+    from .model import impl_donorcell_adv_diff_delta
+
+    n_r = len(x)
+    size_limits = get_size_limits(0.0, u_in / x, x, sig_g, v_gas, T, alpha, m_star, a_0, V_FRAG, RHO_S,
+                                  E_drift, E_stick=E_stick, stokesregime=stokesregime,
+                                  a_grow_prev=a_grow_prev, dt=dt)
+    velocities = get_velocities_diffusion(x, size_limits['gamma'], v_gas, size_limits['St_0'],
+                                          size_limits['St_1'], T, size_limits['o_k'], alpha,
+                                          size_limits['mask_drift'])
+    v = velocities['v_bar']
+    D = velocities['D']
+
+    v[0]   = v[1]   # noqa
+    D[0]   = D[1]   # noqa
+    D[-2:] = 0      # noqa
+    v[-2:] = 0      # noqa
+
+    u_dust = impl_donorcell_adv_diff_delta(
+        n_r, x, D, v, np.ones(n_r), sig_g * x, np.zeros(n_r), np.zeros(n_r), np.ones(n_r), u_in, dt,
+        0, 1, 1, 0, 0, u_in[0], 1, np.zeros(n_r), np.zeros(n_r), np.zeros(n_r), np.zeros(n_r), solver=solver)
+
+    return u_dust, size_limits, velocities
+
+
+def _thomas(a, b, c, r, n, gam, u):
+    """
+    Thomas algorithm writing into the work array `gam` and the solution `u`,
+    see `model.tridag`.
+    """
+    bet = b[0]
+    u[0] = r[0] / bet
+    for j in range(1, n):
+        gam[j] = c[j - 1] / bet
+        bet = b[j] - a[j] * gam[j]
+        if bet == 0:
+            raise ValueError('tridag failed')
+        u[j] = (r[j] - a[j] * u[j - 1]) / bet
+    for j in range(n - 2, -1, -1):
+        u[j] = u[j] - gam[j + 1] * u[j + 1]
+
+
+def _dust_step(x, u_in, sig_g, v_gas, T, alpha, m_star, a_0, V_FRAG, RHO_S, E_drift, E_stick,
+               stokesregime, a_grow_prev, dt, out):
+    """
+    Fused kernel of `fused_step`. The rows of `out` are filled with
+    u_dust, a_max, a_df, a_fr, a_dr, a_grow, v_bar, D, v_0, v_1.
+    The operations follow `utils.get_size_limits`,
+    `utils.get_velocities_diffusion` and
+    `model.impl_donorcell_adv_diff_delta` in the same order.
+    """
+    fudge_fr = 0.37
+    fudge_dr = 0.55
+    N = 0.5
+
+    n_r = len(x)
+    u_dust = out[0]
+    a_max_t_out = out[1]
+    a_df = out[2]
+    a_fr = out[3]
+    a_dr = out[4]
+    a_grow = out[5]
+    v = out[6]
+    D = out[7]
+    v_0 = out[8]
+    v_1 = out[9]
+
+    #
+    # pressure power-law index
+    #
+    P = np.empty(n_r)
+    for i in range(n_r):
+        P[i] = sig_g[i] * np.sqrt(Grav * m_star / x[i]**3) * np.sqrt(k_b * T[i] / mu / m_p)
+    gamma = np.empty(n_r)
+    for i in range(1, n_r - 1):
+        gamma[i] = x[i] / P[i] * (P[i + 1] - P[i - 1]) / (x[i + 1] - x[i - 1])
+    gamma[0] = gamma[1]
+    gamma[n_r - 1] = gamma[n_r - 2]
+
+    #
+    # size limits and velocities
+    #
+    for i in range(n_r):
+        sigma_d_t = u_in[i] / x[i]
+        c2 = k_b * T[i] / mu / m_p
+        o_k = np.sqrt(Grav * m_star / x[i]**3)
+        cs = np.sqrt(k_b * T[i] / mu / m_p)
+        H = cs / o_k
+        n = sig_g[i] / (np.sqrt(2.0 * np.pi) * H * mu * m_p)
+        lambd = 0.5 / (sig_h2 * n)
+
+        afr = fudge_fr * 2 * sig_g[i] * V_FRAG**2 / \
+            (3 * np.pi * alpha[i] * RHO_S * k_b * T[i] / mu / m_p)
+        if stokesregime:
+            a_fr_stokes = np.sqrt(3 / (2 * np.pi)) * np.sqrt((sig_g[i] * lambd) / (alpha[i] * RHO_S)) * \
+                V_FRAG / cs
+            afr = min(afr, a_fr_stokes)
+
+        adr = E_stick * fudge_dr / E_drift * 2 / np.pi * sigma_d_t / RHO_S * \
+            x[i]**2 * (Grav * m_star / x[i]**3) / (abs(gamma[i]) * c2)
+        adf = fudge_fr * 2 * sig_g[i] / (RHO_S * np.pi) * V_FRAG * np.sqrt(
+            Grav * m_star / x[i]) / (abs(gamma[i]) * k_b * T[i] / mu / m_p * (1 - N))
+        adf = max(a_0, adf)
+
+        a_St1 = 2.0 * sig_g[i] / (np.pi * RHO_S)
+        afr = min(a_St1, afr)
+        adr = min(a_St1, adr)
+
+        a_max = max(a_0, min(adr, afr))
+        a_max = max(a_0, min(adf, a_max))
+        a_max_out = min(adf, a_max)
+        mask_drift = adr < afr and adr < adf
+
+        tau_grow = sig_g[i] / max(1e-100, E_stick * sigma_d_t * o_k)
+        agrow = a_grow_prev[i] * np.exp(min(709.0, dt / tau_grow))
+
+        a_max_t = min(a_max, agrow)
+        a_max_t_out[i] = min(a_max_out, agrow)
+        a_fr[i] = afr
+        a_dr[i] = adr
+        a_df[i] = adf
+        a_grow[i] = agrow
+
+        St_0 = RHO_S / sig_g[i] * np.pi / 2 * a_0
+        St_1 = RHO_S / sig_g[i] * np.pi / 2 * a_max_t
+
+        v_dr = k_b * T[i] / mu / m_p / (2 * o_k * x[i]) * gamma[i]
+        v_0[i] = v_gas[i] / (1 + St_0**2) + 2 / (St_0 + 1 / St_0) * v_dr
+        v_1[i] = v_gas[i] / (1 + St_1**2) + 2 / (St_1 + 1 / St_1) * v_dr
+        f_m = 0.97 if mask_drift else 0.75
+        v[i] = v_0[i] * (1 - f_m) + v_1[i] * f_m
+        D[i] = alpha[i] * k_b * T[i] / mu / m_p / o_k
+
+    v[0] = v[1]
+    D[0] = D[1]
+    D[n_r - 2:] = 0.0
+    v[n_r - 2:] = 0.0
+
+    #
+    # matrix assembly with g = 1, K = L = 0, flim = 1, h = sig_g * x
+    #
+    A = np.zeros(n_r)
+    B = np.zeros(n_r)
+    C = np.zeros(n_r)
+    rhs = np.zeros(n_r)
+    h = np.empty(n_r)
+    D05 = np.zeros(n_r)
+    h05 = np.zeros(n_r)
+    for i in range(n_r):
+        h[i] = sig_g[i] * x[i]
+    for i in range(1, n_r):
+        D05[i] = 0.5 * (D[i - 1] + D[i])
+        h05[i] = 0.5 * (h[i - 1] + h[i])
+    for i in range(1, n_r - 1):
+        vol = 0.5 * (x[i + 1] - x[i - 1])
+        A[i] = -dt / vol * (
+            max(0., v[i]) +
+            D05[i] * h05[i] / ((x[i] - x[i - 1]) * h[i - 1]))
+        B[i] = 1. + dt / vol * (
+            max(0., v[i + 1]) -
+            min(0., v[i]) +
+            D05[i + 1] * h05[i + 1] / ((x[i + 1] - x[i]) * h[i]) +
+            D05[i] * h05[i] / ((x[i] - x[i - 1]) * h[i]))
+        C[i] = dt / vol * (
+            min(0., v[i + 1]) -
+            D05[i + 1] * h05[i + 1] / ((x[i + 1] - x[i]) * h[i + 1]))
+        rhs[i] = u_in[i] - (A[i] * u_in[i - 1] + B[i] * u_in[i] + C[i] * u_in[i + 1])
+
+    # boundary conditions: pl=0, pr=1, ql=1, qr=0, rl=0, rr=u_in[0]
+
+    B[0] = 1.0
+    C[0] = 0.0
+    A[n_r - 1] = - 1.0 / (h[n_r - 2] * (x[n_r - 1] - x[n_r - 2]))
+    B[n_r - 1] = 1.0 / (h[n_r - 1] * (x[n_r - 1] - x[n_r - 2]))
+    rhs[0] = 0.0 - (B[0] * u_in[0] + C[0] * u_in[1])
+    rhs[n_r - 1] = u_in[0] - (A[n_r - 1] * u_in[n_r - 2] + B[n_r - 1] * u_in[n_r - 1])
+
+    #
+    # solve and do the delta-update
+    #
+    if B[0] == 0.:
+        raise ValueError('tridag: rewrite equations')
+    gam = np.zeros(n_r)
+    u2 = np.zeros(n_r)
+    bet = B[0]
+    u2[0] = rhs[0] / bet
+    for j in range(1, n_r):
+        gam[j] = C[j - 1] / bet
+        bet = B[j] - A[j] * gam[j]
+        if bet == 0:
+            raise ValueError('tridag failed')
+        u2[j] = (rhs[j] - A[j] * u2[j - 1]) / bet
+    for j in range(n_r - 2, -1, -1):
+        u2[j] = u2[j] - gam[j + 1] * u2[j + 1]
+
+    for i in range(n_r):
+        u_dust[i] = u_in[i] + u2[i]
+
+
+def fused_step_test(nr=500, rtol=1e-12):
+    """
+    Compare one step of the numba kernel of `fused_step` against the numpy
+    path for the disk of `benchmarks.canonical_disk`, with and without the
+    Stokes regime.
+
+    Output:
+    -------
+
+    err : float
+        the largest relative deviation that was found
+    """
+    from .const import year
+    from .utils import get_size_limits
+    from .benchmarks import canonical_disk
+
+    d = canonical_disk(nr)
+    a = d['args']
+    x = d['x']
+    u_in = d['sig_d'] * x
+    a_grow = get_size_limits(0.0, d['sig_d'], x, d['sig_g'], d['v_gas'], d['T'], d['alpha'], a.mstar, a.a0,
+                             a.vfrag, a.rhos, a.edrift, E_stick=a.estick)['a_grow']
+    err = 0.0
+    for stokesregime in [False, True]:
+        res = [fused_step(x, u_in, d['sig_g'], d['v_gas'], d['T'], d['alpha'], a.mstar, a.a0, a.vfrag, a.rhos,
+                          a.edrift, a.estick, a_grow, 100 * year, stokesregime=stokesregime, use_jit=use_jit)
+               for use_jit in [False, True]]
+        pairs = [(res[0][0], res[1][0])]
+        pairs += [(res[0][1][k], res[1][1][k]) for k in ['a_max', 'a_df', 'a_fr', 'a_dr', 'a_grow']]
+        pairs += [(res[0][2][k], res[1][2][k]) for k in ['v_bar', 'D', 'v_0', 'v_1']]
+        for ref, val in pairs:
+            err = max(err, np.max(np.abs(val - ref) / np.maximum(np.abs(ref), 1e-100)))
+
+    assert err <= rtol, 'jit kernel deviates by {:g}'.format(err)
+    return err
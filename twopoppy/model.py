@@ -1,5 +1,9 @@
 def run(x, a_0, time, sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S,
-        E_drift, E_stick=1., nogrowth=False, gasevol=True, alpha_gas=None, stokesregime=False):
+        E_drift, E_stick=1., nogrowth=False, gasevol=True, alpha_gas=None, stokesregime=False,
+        solver=None, jit=False, dt_control='cfl', rtol=1e-3, atol=1e-10, stats=None,
+        checkpoint=None, checkpoint_steps=None, checkpoint_seconds=None, restart=None, sink=None,
+        fields=None, reductions=None, gas_solution='auto', gas_every=1, gas_rtol=None, scheme='euler', stop=None,
+        truncate=False, observer=None):
     """
     This function evolves the two population model (all model settings
     are stored in velocity). It returns the important parameters of
@@ -64,6 +68,121 @@ def run(x, a_0, time, sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S,
     alpha_gas : None | array | function
         if not None: use this for the gas [-]
 
+    gas_solution : str
+        how the gas is evolved if gasevol is true
+        'numerical': solve the viscous evolution implicitly every step
+        'lbp':       evaluate the self-similar solution of Lynden-Bell &
+                     Pringle, which requires a power-law viscosity and the
+                     self-similar initial profile, see `fit_lbp`
+        'auto':      'lbp' if its assumptions hold, else 'numerical' [default]
+
+    gas_every : int
+        the gas is updated every gas_every dust steps, with the sum of
+        their time steps. In between, the dust uses the last gas surface
+        density and velocity. The gas is always updated at the snapshots.
+
+    gas_rtol : None | float
+        if given, gas_every is ignored and the gas is updated once the
+        relative change of sig_g, extrapolated from the rate of change of
+        the last update, reaches gas_rtol
+
+    solver : None | str
+        tridiagonal solver backend: 'python', 'scipy' or 'numba'. If None,
+        the environment variable `TWOPOPPY_SOLVER` or the default backend
+        is used, see `get_solver`. 'scipy' (LAPACK gtsv) pivots, so it loses
+        the relative accuracy of a dust surface density that is many orders
+        of magnitude below its maximum. This can make the time step too
+        short (e.g. in `wrapper.model_wrapper_test`), so it is never the
+        default.
+
+    jit : bool
+        if true, the size limits, velocities and the dust transport of each
+        step are done by a single numba-compiled kernel, see
+        `kernels.fused_step`. Without numba, this falls back to numpy.
+        The kernel only implements growing particles with scheme='euler',
+        with nogrowth=True or another scheme jit is ignored and the numpy
+        implementation is used.
+
+    scheme : str
+        time integration of the dust and the numerical gas evolution, see
+        `adv_diff_step`: 'euler' (first order) [default], 'crank_nicolson'
+        or 'tr_bdf2' (second order). The second order schemes allow much
+        larger time steps for the same error with dt_control='error'.
+
+    dt_control : str
+        how the time step is chosen
+        'cfl':   increase dt by a factor of 10 each step, but at most to t/200,
+                 and divide it by 10 while the dust surface density changes
+                 by more than a factor of 2 [default]
+        'error': estimate the local error of the dust update by step
+                 doubling and adapt dt such that it stays within the
+                 tolerances `rtol` and `atol`
+
+    rtol : float
+        relative tolerance of the dust surface density for dt_control='error'
+
+    atol : float
+        absolute tolerance of the dust surface density for dt_control='error'
+                                        [g cm^-2]
+
+    stats : None | run_stats
+        if given, this object is updated with the number of accepted and
+        rejected steps and the time step statistics. With
+        `run_stats(profile=True)`, it also records the time spent in every
+        phase of the steps, see `run_stats`.
+
+    checkpoint : None | str
+        if given, the state of the integration and the snapshots that were
+        already filled are written to this file (numpy .npz format) every
+        `checkpoint_steps` steps and/or every `checkpoint_seconds` seconds
+        of wall clock time. If neither is set, every 600 seconds.
+
+    checkpoint_steps : None | int
+        number of time steps between checkpoints
+
+    checkpoint_seconds : None | float
+        wall clock time between checkpoints [s]
+
+    restart : None | str
+        checkpoint file from which the integration is resumed. All other
+        arguments need to be the same as in the interrupted run, the
+        result is then identical to that of an uninterrupted run.
+
+    sink : None | object
+        where the snapshots are stored, see `sinks`. The default
+        `sinks.memory_sink()` keeps them in memory, `sinks.npy_sink(dirname)`
+        writes each snapshot to disk when it is reached, the returned arrays
+        are then memory maps of these files. When restarting, the sink needs
+        to be the same as in the interrupted run.
+
+    fields : None | list
+        names of the fields that are recorded at the snapshots, a subset of
+        'sig_d', 'sig_g', 'v_bar', 'v_gas', 'v_0', 'v_1', 'a_dr', 'a_fr',
+        'a_df', 'a_t', 'a_gr', 'T', 'alpha', 'alpha_gas' (in the order of
+        the returned arrays). The other outputs are returned as None.
+        Default: all.
+
+    reductions : None | list
+        `reductions.reduction` objects, which are evaluated at every
+        snapshot or every few steps and accumulate their values, e.g.
+        `reductions.dust_mass()`. They are stored in checkpoints.
+
+    stop : None | list
+        `stops.stop_condition` objects, which are evaluated every few
+        steps. The run ends as soon as one of them is met, its name and the
+        time are stored as `stop_reason` and `t_stop` in `stats`. The
+        snapshots that were not reached are NaN.
+
+    truncate : bool
+        if a stop condition ended the run, return only the snapshots that
+        were reached (and their times)
+
+    observer : None | observer
+        receives the progress of the run, see `twopoppy.observers`.
+        Default: a `observers.console_observer`, which writes a progress
+        bar at most twice per second; pass `observers.silent_observer()`
+        to write nothing.
+
 
     Returns:
     ---------
@@ -106,499 +225,2197 @@ def run(x, a_0, time, sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S,
 
     the temperature (and also alpha) can be an array (with nr elements) or it
     can be a function that function is always just called with two arguments r
-    and locals(). This allows the user to access local information like surface
-    density if necessary (nonsense-example):
+    and a `callbacks.callback_state` of the model. This allows the user
+    to access local information like surface density if necessary
+    (nonsense-example):
 
-        def T(x,locals_):
-            return 10*(x/x[-1])**-1.5 * locals_['sig_g']/locals_['sig_g'][-1]
+        def T(x,state):
+            return 10*(x/x[-1])**-1.5 * state.sig_g/state.sig_g[-1]
 
 
     but still keeps things simple enough to do something like this:
 
-        def T(x,locals_):
+        @callbacks.static
+        def T(x,state):
             return 200*(x/AU)**-1
-    """
-    from numpy import ones, zeros, maximum, minimum, sqrt, where
-    from .const import year, Grav, k_b, mu, m_p
-    from .utils import get_size_limits, get_velocities_diffusion
-    import sys
 
-    CFL = 2
+    Functions marked with `callbacks.static` are evaluated once, those
+    marked with `callbacks.time_only` once per time. Older functions that
+    index the state by name, like `locals_['sig_g']`, still work.
+    """
+    import numpy as np
+    from time import perf_counter
+    from .sinks import memory_sink
+    from .observers import console_observer, progress_event
 
-    #
-    # some setup
-    #
     n_r = len(x)
     n_t = len(time)
-    g = ones(n_r)
-    K = zeros(n_r)
-    L = zeros(n_r)
-    flim = ones(n_r)
-    A0 = zeros(n_r)
-    B0 = zeros(n_r)
-    C0 = zeros(n_r)
-    D0 = zeros(n_r)
-
-    #
-    # setup
-    #
-    t               = time[0]           # noqa
-    solution_d      = zeros([n_t,n_r])  # noqa
-    solution_d[0,:] = sig_d             # noqa
-    solution_g      = zeros([n_t,n_r])  # noqa
-    solution_g[0,:] = sig_g             # noqa
-    vgas            = zeros([n_t,n_r])  # noqa
-    vgas[0,:]       = v_gas             # noqa
-    v_bar           = zeros([n_t,n_r])  # noqa
-    Diff            = zeros([n_t,n_r])  # noqa
-    v_0             = zeros([n_t,n_r])  # noqa
-    v_1             = zeros([n_t,n_r])  # noqa
-    a_t             = zeros([n_t,n_r])  # noqa
-    a_df            = zeros([n_t,n_r])  # noqa
-    a_fr            = zeros([n_t,n_r])  # noqa
-    a_dr            = zeros([n_t,n_r])  # noqa
-    a_gr            = zeros([n_t,n_r])  # noqa
-    Tout            = zeros([n_t,n_r])  # noqa
-    alphaout        = zeros([n_t,n_r])  # noqa
-    alphagasout     = zeros([n_t,n_r])  # noqa
-    u_in            = solution_d[0,:]*x # noqa
-    it_old          = 1                 # noqa
-    snap_count      = 0                 # noqa
-
-    progress_bar(round((it_old - 1) / (n_t - 1) * 100), 'toy model running')
-
-    # T can be either an array or a specific function.
-    # in either case, we define a function that returns the temperature
-
-    if hasattr(T, '__call__'):
-        Tfunc = T
+    all_names = ['sig_d', 'sig_g', 'v_bar', 'v_gas', 'v_0', 'v_1', 'a_dr', 'a_fr', 'a_df', 'a_t', 'a_gr', 'T',
+                 'alpha', 'alpha_gas']
+    if fields is None:
+        names = all_names
+    else:
+        names = [name for name in all_names if name in fields]
+        unknown = set(fields) - set(all_names)
+        if unknown:
+            raise ValueError('unknown fields {}, use a subset of {}'.format(
+                ', '.join(sorted(unknown)), ', '.join(all_names)))
+    if sink is None:
+        sink = memory_sink()
+    reductions = reductions or []
+    stop = stop or []
+    if observer is None:
+        observer = console_observer()
+
+    def progress(snapshot, **kwargs):
+        return progress_event(model.t, time[-1], model.dt, model.stats.n_accepted, snapshot, n_t, **kwargs)
+
+    def store(it):
+        tic = model.stats.tic()
+        sink.write(it, model.state(names))
+        for red in reductions:
+            if red.every is None:
+                red.record(model)
+        model.stats.toc('output', tic)
+
+    model = integrator(x, a_0, time[0], sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S, E_drift,
+                       E_stick=E_stick, nogrowth=nogrowth, gasevol=gasevol, alpha_gas=alpha_gas,
+                       stokesregime=stokesregime, solver=solver, jit=jit, dt_control=dt_control, rtol=rtol,
+                       atol=atol, stats=stats, gas_solution=gas_solution, gas_every=gas_every, gas_rtol=gas_rtol,
+                       scheme=scheme)
+    if restart is None:
+        for cond in stop:
+            cond.reset()
+        sink.start(names, time, n_r)
+        store(0)
+        it_start = 1
     else:
-        def Tfunc(x, a_tlocals_):
-            return T
+        saved = model.restore(restart)
+        if not np.array_equal(saved.pop('time'), time):
+            raise ValueError('the snapshot times differ from those of the checkpoint')
+        it_start = model.snap_count + 1
+        for i, red in enumerate(reductions):
+            red.times = list(saved.pop('reduction_{}_times'.format(i)))
+            red.values = list(saved.pop('reduction_{}_values'.format(i)))
+        for i, cond in enumerate(stop):
+            prefix = 'stop_{}/'.format(i)
+            cond.state = {key[len(prefix):]: saved.pop(key) for key in list(saved) if key.startswith(prefix)}
+        sink.resume(names, time, n_r, saved)
+
+    if checkpoint_steps is None and checkpoint_seconds is None:
+        checkpoint_seconds = 600.
+    last = {'step': model.stats.n_accepted, 'time': perf_counter()}
+
+    def write_checkpoint(model):
+        due_steps = checkpoint_steps is not None and model.stats.n_accepted - last['step'] >= checkpoint_steps
+        due_time = checkpoint_seconds is not None and perf_counter() - last['time'] >= checkpoint_seconds
+        if due_steps or due_time:
+            tic = model.stats.tic()
+            n_filled = model.snap_count + 1
+            extra = sink.state(n_filled)
+            for i, red in enumerate(reductions):
+                extra['reduction_{}_times'.format(i)] = np.array(red.times)
+                extra['reduction_{}_values'.format(i)] = np.array(red.values)
+            for i, cond in enumerate(stop):
+                for key, value in cond.state.items():
+                    extra['stop_{}/{}'.format(i, key)] = value
+            model.checkpoint(checkpoint, time=time, **extra)
+            last['step'] = model.stats.n_accepted
+            last['time'] = perf_counter()
+            model.stats.toc('checkpoint', tic)
+
+    def after_step(model):
+        tic = model.stats.tic()
+        for red in reductions:
+            if red.every is not None and model.stats.n_accepted % red.every == 0:
+                red.record(model)
+        if observer.every is not None and model.stats.n_accepted % observer.every == 0:
+            observer.update(progress(model.snap_count))
+        model.stats.toc('output', tic)
+        for cond in stop:
+            if cond.check(model):
+                model.stats.stop_reason = cond.name
+                model.stats.t_stop = model.t
+                return True
+        if checkpoint is not None:
+            write_checkpoint(model)
+
+    if checkpoint is None and all(red.every is None for red in reductions) and not stop and observer.every is None:
+        callback = None
+    else:
+        callback = after_step
 
-    # alpha can be either an array or a specific function.
-    # in either case, we define a function that returns it
+    observer.start(progress(it_start - 1))
 
-    if hasattr(alpha, '__call__'):
-        alpha_func = alpha
-    else:
-        def alpha_func(x, locals_):
-            return alpha
+    n_filled = n_t
+    for it in range(it_start, n_t):
+        if not model.advance_to(time[it], callback=callback):
+            #
+            # a stop condition was met, mark the remaining snapshots
+            #
+            n_filled = it
+            unfilled = {name: np.nan for name in names}
+            for it_unfilled in range(it, n_t):
+                sink.write(it_unfilled, unfilled)
+            break
+        store(it)
+        observer.update(progress(it))
 
-    # the same for alpha_gas
+    observer.finish(progress(n_filled - 1, done=True, stop_reason=model.stats.stop_reason))
 
-    if alpha_gas is None:
-        alpha_gas = alpha
+    sink.close()
+    out = sink.result()
+    if truncate and n_filled < n_t:
+        time = time[:n_filled]
+        out = {name: arr[:n_filled] for name, arr in out.items()}
+    return (time,) + tuple(out.get(name) for name in all_names)
 
-    if hasattr(alpha_gas, '__call__'):
-        alpha_gas_func = alpha_gas
-    else:
-        def alpha_gas_func(x, locals_):
-            return alpha_gas
 
-    #
-    # save the velocity which will be used
-    #
-    size_limits = get_size_limits(t, solution_d[0, :], x, sig_g, v_gas, Tfunc(x, locals()),
-                                  alpha_func(x, locals()), m_star, a_0, V_FRAG, RHO_S,
-                                  E_drift, E_stick=E_stick, stokesregime=stokesregime, nogrowth=nogrowth)
+class integrator(object):
+    """
+    Resumable version of `run`: holds the state of one two population model
+    and evolves it step by step, such that several models can be advanced
+    alternately, driven by an external scheduler or stopped at any time.
+    `run` is a loop over the snapshot times which calls `advance_to` and
+    stores `state`.
 
-    gamma = size_limits['gamma']
-    St_0 = size_limits['St_0']
-    St_1 = size_limits['St_1']
-    o_k = size_limits['o_k']
-    mask_drift = size_limits['mask_drift']
-    # calculate the velocity
+    Arguments:
+    ----------
 
-    velocities = get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha_func(x, locals()), mask_drift)
+    t : float
+        initial time                    [s]
 
+    All other arguments and keywords are the same as for `run`.
 
-    v_bar[0, :]       = velocities['v_bar']         # noqa
-    Diff[0, :]        = velocities['D']             # noqa
-    v_0[0, :]         = velocities['v_0']           # noqa
-    v_1[0, :]         = velocities['v_1']           # noqa
-    a_t[0, :]         = size_limits['a_max']        # noqa
-    a_df[0, :]        = size_limits['a_df']         # noqa
-    a_fr[0, :]        = size_limits['a_fr']         # noqa
-    a_gr[0, :]        = size_limits['a_grow']       # noqa
-    a_dr[0, :]        = size_limits['a_dr']         # noqa
-    Tout[0, :]        = Tfunc(x, locals())          # noqa
-    alphaout[0, :]    = alpha_func(x, locals())     # noqa
-    alphagasout[0, :] = alpha_gas_func(x, locals()) # noqa
+    Attributes:
+    -----------
 
-    #
-    # the loop
-    #
-    dt = 10 * year
-    while t < time[-1]:
-        #
-        # set the time step
-        #
-        dt = min(dt * 10, time[it_old] - t)
-        if t != 0.0:
-            dt = min(dt, t / 200.0)
-        if dt == 0:
-            print('ERROR:')
-            print('t      = %g years' % (t / year))
-            print('it_old = %g' % it_old)
-            print('dt = 0')
-            sys.exit(1)
+    t, dt : float
+        current time and the last time step [s]
 
-        # update the temperature and alpha
+    u_in : array
+        dust surface density times radius (nr) [g cm^-1]
 
-        _T = Tfunc(x, locals())
-        _alpha = alpha_func(x, locals())
-        _alpha_gas = alpha_gas_func(x, locals())
+    sig_g, v_gas : array
+        gas surface density and velocity (nr)
 
-        # calculate the sizes
+    size_limits, velocities : dict
+        the sizes and velocities of the last step, see
+        `utils.get_size_limits` and `utils.get_velocities_diffusion`
 
-        size_limits = get_size_limits(t, u_in / x, x, sig_g, v_gas, _T, _alpha, m_star,
-                                      a_0, V_FRAG, RHO_S, E_drift, E_stick=E_stick,
-                                      stokesregime=stokesregime, nogrowth=nogrowth,
-                                      a_grow_prev=size_limits['a_grow'], dt=dt)
+    stats : run_stats
+        counters of accepted and rejected steps
 
-        gamma = size_limits['gamma']
-        St_0 = size_limits['St_0']
-        St_1 = size_limits['St_1']
-        o_k = size_limits['o_k']
-        mask_drift = size_limits['mask_drift']
-        # calculate the velocity
+    Example:
+    --------
 
-        velocities = get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, _alpha, mask_drift)
+    >>> model = integrator(x, a_0, 0.0, sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S, E_drift)
+    >>> model.advance_to(1e5 * year)
+    >>> sig_d = model.state()['sig_d']
 
-        v = velocities['v_bar']
-        D = velocities['D']
+    Note:
+    -----
+
+    The callables T, alpha and alpha_gas are called with the radial grid
+    and a `callbacks.callback_state`, which has the attributes 'x', 't',
+    'dt', 'sig_g', 'sig_d', 'v_gas', 'a_max', 'm_star' and 'stats', and
+    gives item access to all attributes of the integrator (e.g. 'u_in').
+    If alpha_gas is None, alpha is evaluated only once per step.
+    """
 
-        v[0]   = v[1]   # noqa
-        D[0]   = D[1]   # noqa
-        D[-2:] = 0      # noqa
-        v[-2:] = 0      # noqa
+    def __init__(self, x, a_0, t, sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S,
+                 E_drift, E_stick=1., nogrowth=False, gasevol=True, alpha_gas=None, stokesregime=False,
+                 solver=None, jit=False, dt_control='cfl', rtol=1e-3, atol=1e-10, stats=None,
+                 gas_solution='auto', gas_every=1, gas_rtol=None, scheme='euler'):
+        import numpy as np
+        from .const import year
+        from .utils import get_size_limits, get_velocities_diffusion, grid_context
+        from .kernels import has_numba
+        from .callbacks import callback_state, profile
+
+        if dt_control not in ['cfl', 'error']:
+            raise ValueError('dt_control needs to be \'cfl\' or \'error\'')
+        if gas_solution not in ['auto', 'numerical', 'lbp']:
+            raise ValueError('gas_solution needs to be \'auto\', \'numerical\' or \'lbp\'')
+        if gas_every < 1:
+            raise ValueError('gas_every needs to be a positive number of steps')
+        if scheme not in schemes:
+            raise ValueError('scheme needs to be one of {}'.format(', '.join(schemes.keys())))
+
+        self.x = x
+        self.a_0 = a_0
+        self.m_star = m_star
+        self.V_FRAG = V_FRAG
+        self.RHO_S = RHO_S
+        self.E_drift = E_drift
+        self.E_stick = E_stick
+        self.nogrowth = nogrowth
+        self.gasevol = gasevol
+        self.stokesregime = stokesregime
+        self.solver = get_solver(solver)
+        self.jit = jit and has_numba() and not nogrowth and scheme == 'euler'
+        self.scheme = scheme
+        self.dt_control = dt_control
+        self.rtol = rtol
+        self.atol = atol
+        self.stats = run_stats() if stats is None else stats
+        self.T = T
+        self.alpha = alpha
+        self.alpha_gas = alpha if alpha_gas is None else alpha_gas
+        self.gas_every = gas_every
+        self.gas_rtol = gas_rtol
         #
-        # set up the equation
+        # the callbacks are evaluated through profiles, which cache the
+        # static and time-only ones, and receive the state view
         #
-        h = sig_g * x
+        self.profiles = {'T': profile(T), 'alpha': profile(alpha), 'alpha_gas': profile(self.alpha_gas)}
+        self.callback_state = callback_state(self)
+        self._alpha_gas_is_alpha = alpha_gas is None
+
+        n_r = len(x)
+        self.ws = workspace(n_r)
+        self.g = np.ones(n_r)
+        self.K = np.zeros(n_r)
+        self.L = np.zeros(n_r)
+        self.flim = np.ones(n_r)
+
         #
-        # do the update
+        # the state
         #
-        #u_dust = impl_donorcell_adv_diff_delta(
-        #    n_r, x, D, v, g, h, K, L, flim, u_in, dt, 1, 1, 0, 0, 0, 0, 1, A0, B0, C0, D0)
-        
-        #Have changed this to allow outflow at the inner edge
-        u_dust = impl_donorcell_adv_diff_delta(
-            n_r, x, D, v, g, h, K, L, flim, u_in, dt, 0, 1, 1, 0, 0, u_in[0], 1, A0, B0, C0, D0)
+        self.t = t
+        self.dt = 10 * year
+        self.dt_next = self.dt
+        self.snap_count = 0
+        self.sig_d = np.array(sig_d, dtype=float)
+        self.u_in = self.sig_d * x
+        self.sig_g = sig_g
+        self.v_gas = v_gas
+        #
+        # time and number of dust steps since the last gas update and the
+        # relative rate of change of sig_g in the last update [s^-1]
+        #
+        self.dt_gas = 0.0
+        self.n_gas = 0
+        self.gas_rate = np.inf
 
-        mask = abs(u_dust[1:-1] / u_in[1:-1] - 1) > CFL
         #
-        # try variable time step
+        # the sizes and velocities of the initial conditions
         #
-        while any(u_dust[1:-1][mask] / x[1:-1][mask] >= 1e-30):
-            dt = dt / 10.
-            if dt < year and snap_count > 0:
-                print('ERROR: time step got too short')
-                sys.exit(1)
-            u_dust = impl_donorcell_adv_diff_delta(
-                n_r, x, D, v, g, h, K, L, flim, u_in, dt, 0, 1, 1, 0, 0, u_in[0], 1, A0, B0, C0, D0)
-            mask = abs(u_dust[1:-1] / u_in[1:-1] - 1) > CFL
+        self._T = self.get_T()
+        self._alpha = self.get_alpha()
+        self._alpha_gas = self.get_alpha_gas()
+        self.ctx = grid_context(x, self._T, self._alpha, m_star)
         #
-        # update
+        # parameters of the self-similar gas solution, None if it is not used,
+        # static callbacks are passed as their values
         #
-        u_in = u_dust[:]
-        t = t + dt
+        self.lbp = None
+        self.t_lbp = t
+        if gasevol and gas_solution != 'numerical':
+            static = all(self.profiles[name].depends == 'static' for name in ['T', 'alpha_gas'])
+            self.lbp = fit_lbp(x, sig_g, self._T if static else T, self._alpha_gas if static else self.alpha_gas,
+                               m_star)
+            if self.lbp is None and gas_solution == 'lbp':
+                raise ValueError('the gas does not follow the self-similar solution, see `fit_lbp`')
+
+        self.size_limits = get_size_limits(t, self.sig_d, x, sig_g, v_gas, self._T, self._alpha, m_star, a_0,
+                                           V_FRAG, RHO_S, E_drift, E_stick=E_stick, stokesregime=stokesregime,
+                                           nogrowth=nogrowth, ctx=self.ctx)
+        sl = self.size_limits
+        self.velocities = get_velocities_diffusion(x, sl['gamma'], v_gas, sl['St_0'], sl['St_1'], self._T,
+                                                   sl['o_k'], self._alpha, sl['mask_drift'], ctx=self.ctx)
+
+    def get_T(self):
+        """
+        Returns the temperature at the current state.
+        """
+        return self.profiles['T'](self.x, self.callback_state)
+
+    def get_alpha(self):
+        """
+        Returns the turbulence parameter of the dust at the current state.
+        """
+        return self.profiles['alpha'](self.x, self.callback_state)
+
+    def get_alpha_gas(self):
+        """
+        Returns the turbulence parameter of the gas at the current state. If
+        no separate alpha_gas was given, this is the last value of alpha.
+        """
+        if self._alpha_gas_is_alpha:
+            return self._alpha
+        return self.profiles['alpha_gas'](self.x, self.callback_state)
+
+    def step(self, t_max=None):
+        """
+        Does one accepted time step of the dust and the gas.
+
+        Keywords:
+        ---------
+
+        t_max : None | float
+            if given, the time step is limited such that t does not exceed
+            t_max                       [s]
+
+        Output:
+        -------
+
+        dt : float
+            the time step that was taken [s]
+        """
+        import numpy as np
+        from .const import year
+        from .utils import get_size_limits, get_velocities_diffusion
+        from .kernels import fused_step
+
+        CFL = 2
+        x = self.x
+        n_r = len(x)
+        t = self.t
+        ws = self.ws
+        solver = self.solver
+        scheme = self.scheme
+        sig_g = self.sig_g
+        v_gas = self.v_gas
+        u_in = self.u_in
+        g, K, L, flim = self.g, self.K, self.L, self.flim
+        A0, B0, C0, D0 = ws.A, ws.B, ws.C, ws.D
         #
-        # update the gas
+        # set the time step
         #
-        if gasevol:
-            nu_gas = _alpha_gas * k_b * _T / mu / m_p * sqrt(x**3 / Grav / m_star)
-            u_gas_old = sig_g * x
-            u_gas = u_gas_old[:]
-            v_gas = zeros(n_r)
-            D_gas = 3.0 * sqrt(x)
-            g_gas = nu_gas / sqrt(x)
-            h_gas = ones(n_r)
-            K_gas = zeros(n_r)
-            L_gas = zeros(n_r)
-
-            # p_L = -(x[1] - x[0]) * h_gas[1] / (x[1] * g_gas[1])
-            # q_L = 1. / x[0] - 1. / x[1] * g_gas[0] / g_gas[1] * h_gas[1] / h_gas[0]
-            # r_L = 0.0
-
-            p_L = 1.0
-            q_L = - (g_gas[1] / h_gas[1] - g_gas[0] / h_gas[0]) / (x[1] - x[0])
-            r_L = g_gas[0] / h_gas[0] * (u_gas[1] - u_gas[0]) / (x[1] - x[0])
+        if self.dt_control == 'cfl':
+            dt = self.dt * 10
+            if t_max is not None:
+                dt = min(dt, t_max - t)
+            if t != 0.0:
+                dt = min(dt, t / 200.0)
+        else:
+            #
+            # a step that is cut short to end at t_max keeps the proposal
+            # of the controller for the next step
+            #
+            dt = self.dt_next
+            if t_max is not None:
+                dt = min(dt, t_max - t)
+            dt_proposed = self.dt_next
+            rejected = False
+        if dt == 0:
+            raise RuntimeError('dt = 0 at t = {:g} years, t_max = {:g} years'.format(
+                t / year, (t if t_max is None else t_max) / year))
+        self.dt = dt
 
-            u_gas = impl_donorcell_adv_diff_delta(n_r, x, D_gas, v_gas, g_gas, h_gas, K_gas, L_gas,
-                                                  flim, u_gas, dt, p_L, 0.0, q_L, 1.0, r_L, 1e-100 * x[n_r - 1], 1, A0, B0, C0, D0)
-            sig_g = u_gas / x
-            sig_g = maximum(sig_g, 1e-100)
+        # update the temperature and alpha
 
+        stats = self.stats
+        tic = stats.tic()
+        self._T = _T = self.get_T()
+        self._alpha = _alpha = self.get_alpha()
+        self._alpha_gas = self.get_alpha_gas()
+        a_grow_prev = self.size_limits['a_grow']
+        if not self.jit:
+            self.ctx.update(_T, _alpha, self.m_star)
+        tic = stats.toc('callbacks', tic)
+
+        while True:
+            if self.jit:
+                #
+                # sizes, velocities and the dust update in one compiled call
+                #
+                u_dust, size_limits, velocities = fused_step(
+                    x, u_in, sig_g, v_gas, _T, _alpha, self.m_star, self.a_0, self.V_FRAG, self.RHO_S,
+                    self.E_drift, self.E_stick, a_grow_prev, dt, stokesregime=self.stokesregime)
+                tic = stats.toc('fused_step', tic)
+                v = velocities['v_bar']
+                D = velocities['D']
+                h = np.multiply(sig_g, x, out=ws.h)
+            else:
+                # calculate the sizes
+
+                size_limits = get_size_limits(t, u_in / x, x, sig_g, v_gas, _T, _alpha, self.m_star,
+                                              self.a_0, self.V_FRAG, self.RHO_S, self.E_drift,
+                                              E_stick=self.E_stick, stokesregime=self.stokesregime,
+                                              nogrowth=self.nogrowth, a_grow_prev=a_grow_prev, dt=dt,
+                                              ctx=self.ctx)
+                tic = stats.toc('size_limits', tic)
+
+                gamma = size_limits['gamma']
+                St_0 = size_limits['St_0']
+                St_1 = size_limits['St_1']
+                o_k = size_limits['o_k']
+                mask_drift = size_limits['mask_drift']
+                # calculate the velocity
+
+                velocities = get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, _T, o_k, _alpha, mask_drift,
+                                                      ctx=self.ctx)
+                tic = stats.toc('velocities', tic)
+
+                v = velocities['v_bar']
+                D = velocities['D']
+
+                v[0]   = v[1]   # noqa
+                D[0]   = D[1]   # noqa
+                D[-2:] = 0      # noqa
+                v[-2:] = 0      # noqa
+                #
+                # set up the equation
+                #
+                h = np.multiply(sig_g, x, out=ws.h)
+                #
+                # do the update
+                #
+                #u_dust = impl_donorcell_adv_diff_delta(
+                #    n_r, x, D, v, g, h, K, L, flim, u_in, dt, 1, 1, 0, 0, 0, 0, 1, A0, B0, C0, D0)
+
+                #Have changed this to allow outflow at the inner edge
+                u_dust = adv_diff_step(
+                    n_r, x, D, v, g, h, K, L, flim, u_in, dt, 0, 1, 1, 0, 0, u_in[0], A0, B0, C0, D0, scheme=scheme,
+                    solver=solver, ws=ws, out=ws.u_dust)
+                tic = stats.toc('dust_solve', tic)
+
+            if self.dt_control == 'cfl':
+                break
             #
-            # now get the gas velocities from the exact fluxes
+            # estimate the error by comparing with two half steps
             #
-            u_flux = zeros(n_r)
-            u_flux[1:n_r + 1] = - flim[1:n_r + 1] * 0.25 * (D_gas[1:] + D_gas[:-1]) * (h_gas[1:] + h_gas[:-1]) * (
-                g_gas[1:] / h_gas[1] * u_gas[1:] - g_gas[:-1] / h_gas[:-1] * u_gas[:-1]) / (x[1:] - x[:-1])
-            mask = u_flux > 0.0
-            imask = u_flux <= 0.0
-            v_gas[mask] = u_flux[mask] / u_gas[maximum(0, where(mask)[0] - 1)]
-            v_gas[imask] = u_flux[imask] / u_gas[minimum(n_r - 1, where(imask)[0] + 1)]
-
-        #
-        # find out if we reached a snapshot
-        #
-        if t >= time[it_old]:
+            u_half = adv_diff_step(
+                n_r, x, D, v, g, h, K, L, flim, u_in, dt / 2, 0, 1, 1, 0, 0, u_in[0], A0, B0, C0, D0, scheme=scheme,
+                solver=solver, ws=ws, out=ws.u_half)
+            u_half = adv_diff_step(
+                n_r, x, D, v, g, h, K, L, flim, u_half, dt / 2, 0, 1, 1, 0, 0, u_half[0], A0, B0, C0, D0,
+                scheme=scheme, solver=solver, ws=ws, out=ws.u_half)
+            scale = self.atol * x[1:-1] + self.rtol * np.maximum(abs(u_in[1:-1]), abs(u_half[1:-1]))
+            err = (abs(u_half[1:-1] - u_dust[1:-1]) / scale).max()
+            tic = stats.toc('error_estimate', tic)
+            if err <= 1.0:
+                u_dust = u_half
+                #
+                # the local error scales as dt**(order + 1), the step does
+                # not grow right after a rejection
+                #
+                factor = min(5.0, 0.9 * err**(-1 / (schemes[scheme] + 1))) if err > 0 else 5.0
+                self.dt_next = dt * (min(factor, 1.0) if rejected else factor)
+                if dt < dt_proposed and not rejected:
+                    self.dt_next = max(self.dt_next, dt_proposed)
+                break
+            stats.n_rejected += 1
+            rejected = True
             #
-            # one more step completed
+            # where the transport is stiff, the estimate decreases more
+            # slowly than dt**(order + 1), so reduce the step as if the
+            # scheme were first order
             #
-            it_old = it_old + 1
-            snap_count = snap_count + 1
+            dt = dt * max(0.2, 0.9 / err)
+            if dt < 1e-10 * year:
+                raise RuntimeError('time step got too short at t = {:g} years'.format(t / year))
+
+        if self.dt_control == 'cfl':
+            mask = abs(u_dust[1:-1] / u_in[1:-1] - 1) > CFL
             #
-            # notify
+            # try variable time step
             #
-            progress_bar(round((it_old - 1.) / (n_t) * 100.), 'toy model running')
+            while any(u_dust[1:-1][mask] / x[1:-1][mask] >= 1e-30):
+                stats.n_rejected += 1
+                dt = dt / 10.
+                if dt < year and self.snap_count > 0:
+                    raise RuntimeError('time step got too short at t = {:g} years'.format(t / year))
+                u_dust = adv_diff_step(
+                    n_r, x, D, v, g, h, K, L, flim, u_in, dt, 0, 1, 1, 0, 0, u_in[0], A0, B0, C0, D0, scheme=scheme,
+                    solver=solver, ws=ws, out=ws.u_dust)
+                mask = abs(u_dust[1:-1] / u_in[1:-1] - 1) > CFL
+                tic = stats.toc('cfl_retry', tic)
+        #
+        # update, u_in is owned by the integrator while u_dust may be a buffer
+        #
+        u_in[:] = u_dust
+        np.divide(u_in, x, out=self.sig_d)
+        self.t = t + dt
+        self.dt = dt
+        self.size_limits = size_limits
+        self.velocities = velocities
+        stats.accept(dt)
+        #
+        # update the gas, possibly only every few steps
+        #
+        if self.gasevol:
+            self.dt_gas += dt
+            self.n_gas += 1
+            if self.gas_rtol is None:
+                due = self.n_gas >= self.gas_every
+            else:
+                due = self.dt_gas * self.gas_rate >= self.gas_rtol
+            if due or (t_max is not None and self.t >= t_max):
+                self.update_gas()
+        return dt
+
+    def update_gas(self):
+        """
+        Evolves the gas over the time `dt_gas` since its last update.
+        """
+        import numpy as np
+
+        ws = self.ws
+        sig_old = self.sig_g
+        if self.gas_rtol is not None:
             #
-            # save the data
+            # keep the old values, sig_g may be the buffer of the new ones
             #
-            solution_d[snap_count, :] = u_dust / x  # noqa
-            solution_g[snap_count, :] = sig_g       # noqa
-            v_bar[snap_count, :]      = v           # noqa
-            vgas[snap_count, :]       = v_gas       # noqa
-            Diff[snap_count, :]       = D           # noqa
+            sig_old = ws.sig_g_old
+            np.copyto(sig_old, self.sig_g)
+        if self.lbp is not None:
+            tic = self.stats.tic()
+            sig_new, v_new = lbp_gas(self.x, self.t - self.t_lbp, self.lbp, ws=ws)
+            self.stats.toc('gas_lbp', tic)
+        else:
+            sig_new, v_new = update_gas(self.x, sig_old, self.dt_gas, self._T, self._alpha_gas, self.m_star,
+                                        solver=self.solver, ws=ws, stats=self.stats, scheme=self.scheme)
+        if self.gas_rtol is not None:
             #
-            # store the rest
+            # the largest relative change where the gas is not negligible
             #
-            v_0[snap_count, :]      = velocities['v_0']     # noqa
-            v_1[snap_count, :]      = velocities['v_1']     # noqa
-            a_t[snap_count, :]      = size_limits['a_max']  # noqa
-            a_df[snap_count, :]     = size_limits['a_df']   # noqa
-            a_fr[snap_count, :]     = size_limits['a_fr']   # noqa
-            a_dr[snap_count, :]     = size_limits['a_dr']   # noqa
-            a_gr[snap_count, :]     = size_limits['a_grow']   # noqa
-            Tout[snap_count, :]     = _T      # noqa
-            alphaout[snap_count, :] = _alpha  # noqa
-            alphagasout[snap_count, :] = _alpha_gas  # noqa
+            change = np.divide(sig_new, sig_old, out=ws.tmp1)
+            np.subtract(change, 1.0, out=change)
+            np.abs(change, out=change)
+            np.less_equal(sig_old, 1e-6 * sig_old.max(), out=ws.mask)
+            np.copyto(change, 0.0, where=ws.mask)
+            self.gas_rate = change.max() / self.dt_gas
+        self.sig_g, self.v_gas = sig_new, v_new
+        self.dt_gas = 0.0
+        self.n_gas = 0
+        self.stats.n_gas += 1
+
+    def advance_to(self, t_end, callback=None):
+        """
+        Steps until the time t_end is reached, the last step is shortened
+        to end exactly at t_end.
+
+        Arguments:
+        ----------
+
+        t_end : float
+            time to evolve to           [s]
+
+        Keywords:
+        ---------
+
+        callback : None | function
+            if given, called with the integrator after every step. If it
+            returns True, the integration stops before t_end.
+
+        Output:
+        -------
+
+        reached : bool
+            False if the callback stopped the integration
+        """
+        while self.t < t_end:
+            self.step(t_max=t_end)
+            if callback is not None and callback(self):
+                return False
+        self.snap_count += 1
+        return True
+
+    def state(self, names=None):
+        """
+        Returns a copy of the current state as dictionary with the keys
+        't', 'dt', 'sig_d', 'sig_g', 'v_bar', 'v_gas', 'D', 'v_0', 'v_1',
+        'a_dr', 'a_fr', 'a_df', 'a_t', 'a_gr', 'T', 'alpha' and 'alpha_gas',
+        in the units of the output of `run`. The sizes, velocities,
+        temperature and alpha values are those used in the last step.
+
+        Keywords:
+        ---------
+
+        names : None | list
+            if given, only these fields (and 't', 'dt') are copied
+        """
+        import numpy as np
+        sl = self.size_limits
+        vel = self.velocities
+        state = {
+            'sig_d': self.sig_d,
+            'sig_g': self.sig_g,
+            'v_bar': vel['v_bar'],
+            'v_gas': self.v_gas,
+            'D': vel['D'],
+            'v_0': vel['v_0'],
+            'v_1': vel['v_1'],
+            'a_dr': sl['a_dr'],
+            'a_fr': sl['a_fr'],
+            'a_df': sl['a_df'],
+            'a_t': sl['a_max'],
+            'a_gr': sl['a_grow'],
+            'T': self._T,
+            'alpha': self._alpha,
+            'alpha_gas': self._alpha_gas,
+            }
+        if names is not None:
+            state = {key: state[key] for key in names}
+        state = {key: np.array(val, copy=True) for key, val in state.items()}
+        state['t'] = self.t
+        state['dt'] = self.dt
+        return state
+
+    def checkpoint(self, fname, **extra):
+        """
+        Writes the evolving state to the numpy file `fname` (.npz), from
+        which it can be restored with `restore`. The file is replaced
+        atomically, such that an interrupted write leaves the previous
+        checkpoint intact.
+
+        Arguments:
+        ----------
+
+        fname : str
+            file name
+
+        Keywords:
+        ---------
+
+        all further keywords are arrays that are stored in the same file
+        and returned by `restore`, e.g. the snapshots that were already
+        filled.
+        """
+        import os
+        import numpy as np
+
+        data = {
+            't': self.t,
+            'dt': self.dt,
+            'dt_next': self.dt_next,
+            'snap_count': self.snap_count,
+            'n_accepted': self.stats.n_accepted,
+            'n_rejected': self.stats.n_rejected,
+            'n_gas_updates': self.stats.n_gas,
+            'dt_stats': [self.stats.dt_min, self.stats.dt_max, self.stats.dt_sum],
+            'dt_gas': self.dt_gas,
+            'n_gas': self.n_gas,
+            'gas_rate': self.gas_rate,
+            'u_in': self.u_in,
+            'sig_d': self.sig_d,
+            'sig_g': self.sig_g,
+            'v_gas': self.v_gas,
+            '_T': self._T,
+            '_alpha': self._alpha,
+            '_alpha_gas': self._alpha_gas,
+            }
+        for key, val in self.size_limits.items():
+            data['size_limits/' + key] = val
+        for key, val in self.velocities.items():
+            data['velocities/' + key] = val
+        for key, val in extra.items():
+            data['extra/' + key] = val
+
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(tmp, fname)
+
+    def restore(self, fname):
+        """
+        Restores the state written by `checkpoint`. The integrator needs to
+        be set up with the same arguments as the one that wrote the file.
+
+        Arguments:
+        ----------
+
+        fname : str
+            file name
+
+        Output:
+        -------
+
+        extra : dict
+            the additional arrays passed to `checkpoint`
+        """
+        import numpy as np
+
+        with np.load(fname) as data:
+            if data['u_in'].shape != np.shape(self.x):
+                raise ValueError('checkpoint {} has {} grid points, not {}'.format(
+                    fname, len(data['u_in']), len(self.x)))
+            self.t = data['t'][()]
+            self.dt = data['dt'][()]
+            self.dt_next = data['dt_next'][()]
+            self.snap_count = int(data['snap_count'])
+            self.stats.n_accepted = int(data['n_accepted'])
+            self.stats.n_rejected = int(data['n_rejected'])
+            if 'dt_gas' in data.files:
+                self.stats.n_gas = int(data['n_gas_updates'])
+                self.dt_gas = data['dt_gas'][()]
+                self.n_gas = int(data['n_gas'])
+                self.gas_rate = data['gas_rate'][()]
+            if 'dt_stats' in data.files:
+                self.stats.dt_min, self.stats.dt_max, self.stats.dt_sum = data['dt_stats'].tolist()
+            self.u_in = data['u_in'].copy()
+            self.sig_d = data['sig_d'].copy()
+            self.sig_g = data['sig_g'].copy()
+            self.v_gas = data['v_gas'].copy()
+            self._T = data['_T'][()]
+            self._alpha = data['_alpha'][()]
+            self._alpha_gas = data['_alpha_gas'][()]
+            groups = {'size_limits/': {}, 'velocities/': {}, 'extra/': {}}
+            for key in data.files:
+                for prefix, group in groups.items():
+                    if key.startswith(prefix):
+                        group[key[len(prefix):]] = data[key]
+        self.size_limits = groups['size_limits/']
+        self.velocities = groups['velocities/']
+        return groups['extra/']
+
+
+def run_ensemble(x, a_0, time, sig_g, sig_d, v_gas, T, alpha, m_star, V_FRAG, RHO_S,
+                 E_drift, E_stick=1., nogrowth=False, gasevol=True, alpha_gas=None, stokesregime=False,
+                 gas_solution='auto', observer=None):
+    """
+    Evolves an ensemble of two population models on the same radial grid
+    in lock-step. This gives the same results as calling `run` for every
+    model, but the size limits, velocities and the transport are computed
+    for all models with single numpy calls. Every model keeps its own time
+    and time step, models that already reached `time[-1]` are masked out.
 
-    progress_bar(100., 'toy model running')
 
-    return time, solution_d, solution_g, v_bar, vgas, v_0, v_1, a_dr, a_fr, a_df, a_t, a_gr, Tout, alphaout, alphagasout
+    Arguments:
+    ----------
+    x : array
+        radial grid (nr)                [cm]
 
+    a_0 : float | array
+        monomer size (n_models)         [cm]
 
-def impl_donorcell_adv_diff_delta(n_x, x, Diff, v, g, h, K, L, flim, u_in, dt, pl, pr, ql, qr, rl, rr, coagulation_method, A, B, C, D):
-    r"""
-    Implicit donor cell advection-diffusion scheme with piecewise constant values
+    time : array
+        time of snapshots (nt)          [s]
 
-    NOTE: The cell centers can be arbitrarily placed - the interfaces are assumed
-    to be in the middle of the "centers", which makes all interface values
-    just the arithmetic mean of the center values.
+    sig_g : array
+        gas surface density (n_models,nr) [g cm^-2]
 
-        Perform one time step for the following PDE:
+    sig_d : array
+        dust surface density (n_models,nr) [g cm^-2]
 
-           du   d  /    \    d  /              d  /       u   \ \
-           -- + -- | u v | - -- | h(x) Diff(x) -- | g(x) ----  | | = K + L u
-           dt   dx \    /    dx \              dx \      h(x) / /
+    v_gas : array
+        gas velocity (n_models,nr)      [cm/s]
 
-        with boundary conditions
+    T : float | array
+        temperature (nr) or (n_models,nr) [K]
 
-            dgu/h |            |
-          p ----- |      + q u |       = r
-             dx   |x=xbc       |x=xbc
+    alpha : float | array
+        turbulence parameter (nr), (n_models,1) or (n_models,nr) [-]
 
-    Arguments:
-    ----------
-    n_x : int
-        number of grid points
+    m_star : float | array
+        stellar mass (n_models)         [g]
 
-    x : array-like
-        the grid
+    V_FRAG : float | array
+        fragmentation velocity (n_models) [cm s^-1]
 
-    Diff : array-like
-        value of Diff @ cell center
+    RHO_S : float | array
+        internal density of the dust (n_models) [g cm^-3]
 
-    v : array-like
-        the values for v @ interface (array[i] = value @ i-1/2)
+    E_drift : float | array
+        drift efficiency (n_models)     [-]
 
-    g : array-like
-        the values for g(x)
+    E_stick : float | array
+        sticking probability (n_models) [-]
 
-    h : array-like
-        the values for h(x)
 
-    K : array-like
-        the values for K(x)
+    Keywords:
+    ---------
 
-    L : array-like
-        the values for L(x)
+    stokesregime, nogrowth, gasevol : bool
+        see `run`, these apply to all models
 
-    flim : array-like
-        diffusion flux limiting factor at interfaces
+    alpha_gas : None | float | array
+        if not None: use this for the gas, same shapes as alpha [-]
 
-    u : array-like
-        the current values of u(x)
+    gas_solution : str
+        'numerical', 'lbp' or 'auto', see `run`. The choice is made for
+        every model, so that each one gives the same result as `run`.
 
-    dt : float
-        the time step
+    observer : None | observer
+        receives the progress of the slowest model, see `run`. The step
+        count is the number of passes over the active models.
 
 
-    Output:
-    -------
+    Returns:
+    ---------
 
-    u : array-like
-        the updated values of u(x) after timestep dt
+    The same quantities as `run`, each of the (nt,nr) arrays gets an
+    additional leading axis of length n_models.
+
+    Note:
+    -----
 
+    Per-model scalars are given as floats or arrays of length n_models.
+    Radial profiles (T, alpha, alpha_gas) need to be arrays that broadcast
+    to (n_models, nr), so a per-model constant alpha is given with shape
+    (n_models, 1). In contrast to `run`, functions are not supported as
+    temperature or alpha.
     """
-    from numpy import zeros
-    D05 = zeros(n_x)
-    h05 = zeros(n_x)
-    rhs = zeros(n_x)
+    import numpy as np
+    from .const import year, Grav, k_b, mu, m_p
+    from .utils import get_size_limits, get_velocities_diffusion
+    from .observers import console_observer, progress_event
+
+    CFL = 2
+
     #
-    # calculate the arrays at the interfaces
+    # some setup
     #
-    for i in range(1, n_x):
-        D05[i] = flim[i] * 0.5 * (Diff[i - 1] + Diff[i])
-        h05[i] = 0.5 * (h[i - 1] + h[i])
+    sig_g = np.array(sig_g, dtype=float, ndmin=2)
+    n_m, n_r = sig_g.shape
+    n_t = len(time)
+    shape = (n_m, n_r)
+    g = np.ones(n_r)
+    K = np.zeros(n_r)
+    L = np.zeros(n_r)
+    flim = np.ones(n_r)
+    idx = np.arange(n_r)
+
+    def profile(value):
+        if hasattr(value, '__call__'):
+            raise TypeError('run_ensemble does not support functions for T or alpha')
+        return np.array(np.broadcast_to(np.asarray(value, dtype=float), shape))
+
+    def column(value):
+        value = np.asarray(value, dtype=float)
+        if value.ndim == 0:
+            return value[()]
+        elif value.shape != (n_m,):
+            raise ValueError('per-model scalars need to be floats or arrays of length n_models')
+        return value[:, None]
+
+    def sub(value, members):
+        return value if np.ndim(value) == 0 else value[members]
+
+    sig_d = profile(sig_d)
+    v_gas = profile(v_gas)
+    T = profile(T)
+    alpha = profile(alpha)
+    if alpha_gas is None:
+        alpha_gas = alpha
+    else:
+        alpha_gas = profile(alpha_gas)
+
+    a_0, m_star, V_FRAG, RHO_S, E_drift, E_stick = [
+        column(value) for value in [a_0, m_star, V_FRAG, RHO_S, E_drift, E_stick]]
     #
-    # calculate the entries of the tridiagonal matrix
+    # the self-similar gas solution of every model, None where it is not used
     #
-    for i in range(1, n_x - 1):
-        vol = 0.5 * (x[i + 1] - x[i - 1])
-        A[i] = -dt / vol *  \
-            (
-            max(0., v[i]) +
-            D05[i] * h05[i] * g[i - 1] / ((x[i] - x[i - 1]) * h[i - 1])
-            )
-        B[i] = 1. - dt * L[i] + dt / vol * \
-            (
-            max(0., v[i + 1]) -
-            min(0., v[i]) +
-            D05[i + 1] * h05[i + 1] * g[i] / ((x[i + 1] - x[i]) * h[i]) +
-            D05[i] * h05[i] * g[i] / ((x[i] - x[i - 1]) * h[i])
-            )
-        C[i] = dt / vol *  \
-            (
-            min(0., v[i + 1]) -
-            D05[i + 1] * h05[i + 1] * g[i + 1] / ((x[i + 1] - x[i]) * h[i + 1])
-            )
-        D[i] = -dt * K[i]
+    if gas_solution not in ['auto', 'numerical', 'lbp']:
+        raise ValueError('gas_solution needs to be \'auto\', \'numerical\' or \'lbp\'')
+    lbps = [None] * n_m
+    if gasevol and gas_solution != 'numerical':
+        lbps = [fit_lbp(x, sig_g[i], T[i], alpha_gas[i], np.ravel(m_star)[i] if np.ndim(m_star) else m_star)
+                for i in range(n_m)]
+        if gas_solution == 'lbp' and None in lbps:
+            raise ValueError('the gas of model(s) {} does not follow the self-similar solution, see `fit_lbp`'.format(
+                [i for i, lbp in enumerate(lbps) if lbp is None]))
+    use_lbp = np.array([lbp is not None for lbp in lbps])
+
+    names = ['solution_d', 'solution_g', 'v_bar', 'vgas', 'v_0', 'v_1', 'a_dr', 'a_fr',
+             'a_df', 'a_t', 'a_gr', 'Tout', 'alphaout', 'alphagasout']
+    out = {name: np.zeros([n_m, n_t, n_r]) for name in names}
+
+    t          = np.ones(n_m) * time[0]     # noqa
+    dt         = np.ones(n_m) * 10 * year   # noqa
+    u_in       = sig_d * x                  # noqa
+    it_old     = np.ones(n_m, dtype=int)    # noqa
+    snap_count = np.zeros(n_m, dtype=int)   # noqa
+
+    def store(members, snap, rows, sig_d, size_limits, velocities, v):
+        out['solution_d'][members, snap, :] = sig_d
+        out['solution_g'][members, snap, :] = sig_g[members]
+        out['v_bar'][members, snap, :] = v[rows]
+        out['vgas'][members, snap, :] = v_gas[members]
+        out['v_0'][members, snap, :] = velocities['v_0'][rows]
+        out['v_1'][members, snap, :] = velocities['v_1'][rows]
+        out['a_t'][members, snap, :] = size_limits['a_max'][rows]
+        out['a_df'][members, snap, :] = size_limits['a_df'][rows]
+        out['a_fr'][members, snap, :] = size_limits['a_fr'][rows]
+        out['a_dr'][members, snap, :] = size_limits['a_dr'][rows]
+        out['a_gr'][members, snap, :] = size_limits['a_grow'][rows]
+        out['Tout'][members, snap, :] = T[members]
+        out['alphaout'][members, snap, :] = alpha[members]
+        out['alphagasout'][members, snap, :] = alpha_gas[members]
+
+    def cfl_failed(u_new, u_old):
+        mask = abs(u_new[:, 1:-1] / u_old[:, 1:-1] - 1) > CFL
+        return np.any(mask & (u_new[:, 1:-1] / x[1:-1] >= 1e-30), 1)
+
+    def check(u, members, what):
+        failed = np.isnan(u[:, 0])
+        if failed.any():
+            raise ValueError('tridag failed in the {} update of model(s) {}'.format(
+                what, members[failed]))
+
+    if observer is None:
+        observer = console_observer('ensemble model running')
+    n_pass = 0
+
+    def progress(**kwargs):
+        return progress_event(t.min(), time[-1], dt.min(), n_pass, snap_count.min(), n_t, **kwargs)
+
+    observer.start(progress())
+
     #
-    # boundary Conditions
+    # initial size limits and velocities
     #
-    A[0] = 0.
-    B[0] = ql - pl * g[0] / (h[0] * (x[1] - x[0]))
-    C[0] = pl * g[1] / (h[1] * (x[1] - x[0]))
-    D[0] = u_in[0] - rl
-
-    A[-1] = - pr * g[-2] / (h[-2] * (x[-1] - x[-2]))
-    B[-1] = qr + pr * g[-1] / (h[-1] * (x[-1] - x[-2]))
-    C[-1] = 0.
-    D[-1] = u_in[-1] - rr
+    size_limits = get_size_limits(t[:, None], sig_d, x, sig_g, v_gas, T, alpha, m_star, a_0, V_FRAG,
+                                  RHO_S, E_drift, E_stick=E_stick, stokesregime=stokesregime, nogrowth=nogrowth)
+    velocities = get_velocities_diffusion(x, size_limits['gamma'], v_gas, size_limits['St_0'], size_limits['St_1'],
+                                          T, size_limits['o_k'], alpha, size_limits['mask_drift'])
+    a_grow = size_limits['a_grow']
+    all_members = np.arange(n_m)
+    store(all_members, 0, all_members, sig_d, size_limits, velocities, velocities['v_bar'])
 
     #
-    # if coagulation_method==2,
-    #  then we change the arrays and
-    #  give them back to the calling routine
-    # otherwise, we solve the equation
+    # the loop, each pass advances all models that did not yet finish
     #
-    if coagulation_method == 2:
-        A = A / dt
-        B = (B - 1.) / dt
-        C = C / dt
-        D = D / dt
-    else:
+    while True:
+        act = np.where(t < time[-1])[0]
+        if len(act) == 0:
+            break
+        n_a = len(act)
+        n_pass += 1
         #
-        # the old way
+        # set the time steps
         #
-        # rhs = u - D
+        _t = t[act]
+        _dt = np.minimum(dt[act] * 10, time[it_old[act]] - _t)
+        _dt = np.where(_t != 0.0, np.minimum(_dt, _t / 200.0), _dt)
+        if np.any(_dt == 0):
+            raise RuntimeError('dt = 0 for model(s) {}'.format(act[_dt == 0]))
+
+        _sig_g = sig_g[act]
+        _v_gas = v_gas[act]
+        _T = T[act]
+        _alpha = alpha[act]
+        _m_star = sub(m_star, act)
+
+        # calculate the sizes
+
+        size_limits = get_size_limits(_t[:, None], u_in[act] / x, x, _sig_g, _v_gas, _T, _alpha, _m_star,
+                                      sub(a_0, act), sub(V_FRAG, act), sub(RHO_S, act), sub(E_drift, act),
+                                      E_stick=sub(E_stick, act), stokesregime=stokesregime, nogrowth=nogrowth,
+                                      a_grow_prev=a_grow[act], dt=_dt[:, None])
 
+        # calculate the velocity
+
+        velocities = get_velocities_diffusion(x, size_limits['gamma'], _v_gas, size_limits['St_0'],
+                                              size_limits['St_1'], _T, size_limits['o_k'], _alpha,
+                                              size_limits['mask_drift'])
+
+        v = velocities['v_bar']
+        D = velocities['D']
+
+        v[:, 0]   = v[:, 1]   # noqa
+        D[:, 0]   = D[:, 1]   # noqa
+        D[:, -2:] = 0         # noqa
+        v[:, -2:] = 0         # noqa
         #
-        # the delta-way
+        # do the update of all active models
         #
-        for i in range(1, n_x - 1):
-            rhs[i] = u_in[i] - D[i] - \
-                (A[i] * u_in[i - 1] + B[i] * u_in[i] + C[i] * u_in[i + 1])
-        rhs[0] = rl - (B[0] * u_in[0] + C[0] * u_in[1])
-        rhs[-1] = rr - (A[-1] * u_in[-2] + B[-1] * u_in[-1])
-
+        h = _sig_g * x
+        u_old = u_in[act]
+        A0, B0, C0, D0 = [np.zeros([n_a, n_r]) for _ in range(4)]
+        u_dust = impl_donorcell_adv_diff_delta(
+            n_r, x, D, v, g, h, K, L, flim, u_old, _dt, 0, 1, 1, 0, 0, u_old[:, 0], 1, A0, B0, C0, D0)
+        check(u_dust, act, 'dust')
         #
-        # solve for u2
+        # reduce the time step of the models that failed the CFL test
         #
-        u2 = tridag(A, B, C, rhs, n_x)
+        retry = cfl_failed(u_dust, u_old)
+        while retry.any():
+            ir = np.where(retry)[0]
+            _dt[ir] = _dt[ir] / 10.
+            too_short = (_dt[ir] < year) & (snap_count[act[ir]] > 0)
+            if too_short.any():
+                raise RuntimeError('time step got too short for model(s) {}'.format(act[ir][too_short]))
+            A0, B0, C0, D0 = [np.zeros([len(ir), n_r]) for _ in range(4)]
+            u_dust[ir] = impl_donorcell_adv_diff_delta(
+                n_r, x, D[ir], v[ir], g, h[ir], K, L, flim, u_old[ir], _dt[ir], 0, 1, 1, 0, 0,
+                u_old[ir, 0], 1, A0, B0, C0, D0)
+            check(u_dust[ir], act[ir], 'dust')
+            retry[ir] = cfl_failed(u_dust[ir], u_old[ir])
         #
-        # update u
-        # u = u2   # old way
+        # update
+        #
+        u_in[act] = u_dust
+        t[act] = _t + _dt
+        dt[act] = _dt
+        a_grow[act] = size_limits['a_grow']
+        #
+        # update the gas
         #
-        u_out = u_in + u2  # delta way
+        if gasevol:
+            for m in act[use_lbp[act]]:
+                sig_g[m], v_gas[m] = lbp_gas(x, t[m] - time[0], lbps[m])
+            num = ~use_lbp[act]
+        if gasevol and num.any():
+            gas_members = act[num]
+            n_g = len(gas_members)
+            nu_gas = alpha_gas[gas_members] * k_b * _T[num] / mu / m_p * np.sqrt(x**3 / Grav / sub(m_star, gas_members))
+            u_gas = _sig_g[num] * x
+            D_gas = 3.0 * np.sqrt(x)
+            g_gas = nu_gas / np.sqrt(x)
+            v_gas0 = np.zeros(n_r)
+            h_gas = np.ones(n_r)
+            K_gas = np.zeros(n_r)
+            L_gas = np.zeros(n_r)
 
-    return u_out
+            p_L = 1.0
+            q_L = - (g_gas[:, 1] / h_gas[1] - g_gas[:, 0] / h_gas[0]) / (x[1] - x[0])
+            r_L = g_gas[:, 0] / h_gas[0] * (u_gas[:, 1] - u_gas[:, 0]) / (x[1] - x[0])
 
+            A0, B0, C0, D0 = [np.zeros([n_g, n_r]) for _ in range(4)]
+            u_gas = impl_donorcell_adv_diff_delta(n_r, x, D_gas, v_gas0, g_gas, h_gas, K_gas, L_gas,
+                                                  flim, u_gas, _dt[num], p_L, 0.0, q_L, 1.0, r_L,
+                                                  1e-100 * x[n_r - 1], 1, A0, B0, C0, D0)
+            check(u_gas, gas_members, 'gas')
+            sig_g[gas_members] = np.maximum(u_gas / x, 1e-100)
 
-def tridag(a, b, c, r, n):
-    """
-    Solves a tridiagnoal matrix equation
+            #
+            # now get the gas velocities from the exact fluxes
+            #
+            u_flux = np.zeros([n_g, n_r])
+            u_flux[:, 1:] = - flim[1:] * 0.25 * (D_gas[1:] + D_gas[:-1]) * (h_gas[1:] + h_gas[:-1]) * (
+                g_gas[:, 1:] / h_gas[1] * u_gas[:, 1:] - g_gas[:, :-1] / h_gas[:-1] * u_gas[:, :-1]) / (x[1:] - x[:-1])
+            u_upwind = np.where(u_flux > 0.0, u_gas[:, np.maximum(0, idx - 1)], u_gas[:, np.minimum(n_r - 1, idx + 1)])
+            v_gas[gas_members] = u_flux / u_upwind
+        #
+        # find out which models reached a snapshot
+        #
+        snap = t[act] >= time[it_old[act]]
+        if snap.any():
+            members = act[snap]
+            it_old[members] += 1
+            snap_count[members] += 1
+            store(members, snap_count[members], snap, u_dust[snap] / x, size_limits, velocities, v)
+            observer.update(progress())
+        elif observer.every is not None and n_pass % observer.every == 0:
+            observer.update(progress())
 
-        M * u  =  r
+    observer.finish(progress(done=True))
 
-    where M is tridiagonal, and u and r are vectors of length n.
+    return (time, out['solution_d'], out['solution_g'], out['v_bar'], out['vgas'], out['v_0'], out['v_1'],
+            out['a_dr'], out['a_fr'], out['a_df'], out['a_t'], out['a_gr'], out['Tout'], out['alphaout'],
+            out['alphagasout'])
+
+
+def update_gas(x, sig_g, dt, T, alpha_gas, m_star, solver=None, ws=None, stats=None, scheme='euler'):
+    """
+    Evolves the gas surface density by one viscous time step and returns it
+    together with the gas velocity derived from the fluxes at the interfaces.
 
     Arguments:
     ----------
 
-    a : array
-        lower diagonal entries
+    x : array
+        radial grid (nr)                [cm]
 
-    b : array
-        diagonal entries
+    sig_g : array
+        gas surface density (nr)        [g cm^-2]
 
-    c : array
-        upper diagonal entries
+    dt : float
+        time step                       [s]
 
-    r : array
-        right hand side vector
+    T : array
+        temperature (nr)                [K]
 
-    n : int
-        size of the vectors
+    alpha_gas : float | array
+        turbulence parameter of the gas [-]
 
-    Returns:
-    --------
+    m_star : float
+        stellar mass                    [g]
 
-    u : array
-        solution vector
-    """
-    import numpy as np
+    Keywords:
+    ---------
 
-    gam = np.zeros(n)
-    u = np.zeros(n)
+    solver : None | str
+        tridiagonal solver backend, see `tridag`
 
-    if b[0] == 0.:
-        raise ValueError('tridag: rewrite equations')
+    ws : None | workspace
+        work buffers, see `workspace`. If given, no arrays are allocated and
+        the returned arrays are the buffers `ws.sig_g` and `ws.v_gas`.
 
-    bet = b[0]
+    stats : None | run_stats
+        if given, the solve and the velocity reconstruction are timed as
+        the phases 'gas_solve' and 'gas_velocity'
 
-    u[0] = r[0] / bet
+    scheme : str
+        time integration, see `adv_diff_step`
 
-    for j in np.arange(1, n):
-        gam[j] = c[j - 1] / bet
-        bet = b[j] - a[j] * gam[j]
+    Output:
+    -------
 
-        if bet == 0:
-            raise ValueError('tridag failed')
-        u[j] = (r[j] - a[j] * u[j - 1]) / bet
+    sig_g : array
+        the updated gas surface density (nr) [g cm^-2]
 
-    for j in np.arange(n - 2, -1, -1):
-        u[j] = u[j] - gam[j + 1] * u[j + 1]
-    return u
+    v_gas : array
+        the gas velocity (nr)           [cm s^-1]
+    """
+    import numpy as np
+    from .const import Grav, k_b, mu, m_p
+
+    n_r = len(x)
+    if ws is None:
+        ws = workspace(n_r)
+    tic = 0.0 if stats is None else stats.tic()
+    tmp = ws.tmp1
+    #
+    # the viscosity
+    #
+    nu_gas = ws.tmp2
+    np.multiply(alpha_gas, k_b, out=nu_gas)
+    np.multiply(nu_gas, T, out=nu_gas)
+    np.divide(nu_gas, mu, out=nu_gas)
+    np.divide(nu_gas, m_p, out=nu_gas)
+    np.power(x, 3, out=tmp)
+    np.divide(tmp, Grav, out=tmp)
+    np.divide(tmp, m_star, out=tmp)
+    np.sqrt(tmp, out=tmp)
+    np.multiply(nu_gas, tmp, out=nu_gas)
+    #
+    # set up the diffusion equation
+    #
+    u_gas = ws.u_gas_in
+    np.multiply(sig_g, x, out=u_gas)
+    np.sqrt(x, out=tmp)
+    D_gas = np.multiply(3.0, tmp, out=ws.D_gas)
+    g_gas = np.divide(nu_gas, tmp, out=ws.g_gas)
+    h_gas = ws.ones
+
+    # p_L = -(x[1] - x[0]) * h_gas[1] / (x[1] * g_gas[1])
+    # q_L = 1. / x[0] - 1. / x[1] * g_gas[0] / g_gas[1] * h_gas[1] / h_gas[0]
+    # r_L = 0.0
+
+    p_L = 1.0
+    q_L = - (g_gas[1] / h_gas[1] - g_gas[0] / h_gas[0]) / (x[1] - x[0])
+    r_L = g_gas[0] / h_gas[0] * (u_gas[1] - u_gas[0]) / (x[1] - x[0])
+    if scheme != 'euler':
+        #
+        # the condition above lags the gradient by one step, which is only
+        # consistent with backward Euler. The higher order schemes use the
+        # state it relaxes to, u[1] = u[0].
+        #
+        r_L = 0.0
+
+    u_gas = adv_diff_step(n_r, x, D_gas, ws.zeros, g_gas, h_gas, ws.zeros, ws.zeros, ws.ones, u_gas, dt, p_L, 0.0,
+                          q_L, 1.0, r_L, 1e-100 * x[n_r - 1], ws.A, ws.B, ws.C, ws.D, scheme=scheme, solver=solver,
+                          ws=ws, out=ws.u_gas)
+    np.divide(u_gas, x, out=ws.sig_g)
+    np.maximum(ws.sig_g, 1e-100, out=ws.sig_g)
+    if stats is not None:
+        tic = stats.toc('gas_solve', tic)
+    #
+    # now get the gas velocities from the exact fluxes
+    #
+    flux = ws.u_flux[1:]
+    t1 = ws.tmp1[:n_r - 1]
+    t2 = ws.tmp2[:n_r - 1]
+    np.negative(ws.ones[1:], out=flux)
+    np.multiply(flux, 0.25, out=flux)
+    np.add(D_gas[1:], D_gas[:-1], out=t1)
+    np.multiply(flux, t1, out=flux)
+    np.add(h_gas[1:], h_gas[:-1], out=t1)
+    np.multiply(flux, t1, out=flux)
+    np.divide(g_gas[1:], h_gas[1], out=t1)
+    np.multiply(t1, u_gas[1:], out=t1)
+    np.divide(g_gas[:-1], h_gas[:-1], out=t2)
+    np.multiply(t2, u_gas[:-1], out=t2)
+    np.subtract(t1, t2, out=t1)
+    np.multiply(flux, t1, out=flux)
+    np.subtract(x[1:], x[:-1], out=t1)
+    np.divide(flux, t1, out=flux)
+
+    u_flux = ws.u_flux
+    v_gas = ws.v_gas
+    v_gas.fill(0.)
+    np.greater(u_flux, 0.0, out=ws.mask)
+    np.less_equal(u_flux, 0.0, out=ws.imask)
+    #
+    # upwind values: u_gas[max(0, i - 1)] and u_gas[min(n_r - 1, i + 1)]
+    #
+    tmp[0] = u_gas[0]
+    tmp[1:] = u_gas[:-1]
+    np.divide(u_flux, tmp, out=v_gas, where=ws.mask)
+    tmp[:-1] = u_gas[1:]
+    tmp[-1] = u_gas[-1]
+    np.divide(u_flux, tmp, out=v_gas, where=ws.imask)
+    if stats is not None:
+        stats.toc('gas_velocity', tic)
 
+    return ws.sig_g, v_gas
 
-def progress_bar(perc, text=''):
+
+def fit_lbp(x, sig_g, T, alpha_gas, m_star, rtol=1e-8):
     """
-    This is a very simple progress bar which displays the given
-    percentage of completion on the command line, overwriting its
-    previous output.
+    Checks whether the gas evolves according to the self-similar solution
+    of Lynden-Bell & Pringle (1974), see `wrapper.lbp_solution`: the
+    viscosity needs to be a power law nu = nu1 * (x / x[0])**gamma with a
+    static temperature and alpha_gas, and the surface density needs to be
+    the self-similar profile
+
+        sig_g = A * r**-gamma * exp(-r**(2 - gamma) / T1),  r = x / x[0].
+
+    The profile is fitted to the cells above the floor value of 1e-100, but
+    every cell needs to match it, so a disk that is cut off (set to the
+    floor beyond some radius) is not self-similar.
 
     Arguments:
     ----------
 
-    perc : float
-        The percentage of completion, should be
-        between 0 and 100. Only 100.0 finishes with the
+    x : array
+        radial grid (nr)                [cm]
+
+    sig_g : array
+        initial gas surface density (nr) [g cm^-2]
+
+    T : array | function
+        temperature (nr)                [K]
+
+    alpha_gas : float | array | function
+        turbulence parameter of the gas [-]
+
+    m_star : float
+        stellar mass                    [g]
+
+    Keywords:
+    ---------
+
+    rtol : float
+        largest relative deviation of the viscosity and the surface density
+        from the fitted profiles
+
+    Output:
+    -------
+
+    lbp : None | dict
+        None if the assumptions do not hold, otherwise a dict with the
+        entries 'nu1', 'gamma', 'A', 'T1' (of the initial profile) and
+        'ts', the viscous time scale [s], which are used by `lbp_gas`
+    """
+    import numpy as np
+    from .const import Grav, k_b, mu, m_p
+
+    if hasattr(T, '__call__') or hasattr(alpha_gas, '__call__'):
+        return None
+    r = x / x[0]
+    nu = alpha_gas * k_b * np.asarray(T) / mu / m_p * np.sqrt(x**3 / Grav / m_star) * np.ones_like(x)
+    if np.any(nu <= 0):
+        return None
+    #
+    # power law of the viscosity
+    #
+    gamma, log_nu1 = np.polyfit(np.log(r), np.log(nu), 1)
+    nu1 = np.exp(log_nu1)
+    if gamma >= 2 or np.max(np.abs(nu1 * r**gamma / nu - 1)) > rtol:
+        return None
+    #
+    # self-similar profile
+    #
+    mask = sig_g > 1e-90
+    if mask.sum() < 3:
+        return None
+    slope, log_A = np.polyfit(r[mask]**(2 - gamma), np.log(sig_g[mask] * r[mask]**gamma), 1)
+    if slope >= 0:
+        return None
+    lbp = {'nu1': nu1, 'gamma': gamma, 'A': np.exp(log_A), 'T1': -1.0 / slope,
+           'ts': x[0]**2 / (3 * (2 - gamma)**2 * nu1)}
+    if np.max(np.abs(lbp_gas(x, 0.0, lbp)[0] / np.maximum(sig_g, 1e-100) - 1)) > rtol:
+        return None
+    return lbp
+
+
+def lbp_gas(x, dt, lbp, ws=None):
+    """
+    Gas surface density and velocity of the self-similar solution,
+    a time dt after the profile that was fitted by `fit_lbp`:
+
+        sig_g = A * (T1 / T1_0)**(-(5/2 - gamma) / (2 - gamma)) * r**-gamma * exp(-r**(2 - gamma) / T1)
+        v_gas = -3 nu / x * (1/2 - (2 - gamma) r**(2 - gamma) / T1)
+
+    where r = x / x[0] and T1 = T1_0 + dt / ts.
+
+    Arguments:
+    ----------
+
+    x : array
+        radial grid (nr)                [cm]
+
+    dt : float
+        time since the fitted profile   [s]
+
+    lbp : dict
+        the parameters returned by `fit_lbp`
+
+    Keywords:
+    ---------
+
+    ws : None | workspace
+        work buffers, see `workspace`. If given, no arrays are allocated and
+        the returned arrays are the buffers `ws.sig_g` and `ws.v_gas`.
+
+    Output:
+    -------
+
+    sig_g : array
+        the gas surface density (nr)    [g cm^-2]
+
+    v_gas : array
+        the gas velocity (nr)           [cm s^-1]
+    """
+    import numpy as np
+
+    if ws is None:
+        ws = workspace(len(x))
+    gamma = lbp['gamma']
+    T1 = lbp['T1'] + dt / lbp['ts']
+    r = np.divide(x, x[0], out=ws.tmp1)
+    #
+    # s = r**(2 - gamma) / T1 and the viscosity nu = nu1 * r**gamma
+    #
+    s = np.power(r, 2 - gamma, out=ws.tmp2)
+    np.divide(s, T1, out=s)
+    nu = np.power(r, gamma, out=ws.tmp3)
+    np.multiply(nu, lbp['nu1'], out=nu)
+
+    sig_g = np.negative(s, out=ws.sig_g)
+    np.exp(sig_g, out=sig_g)
+    np.multiply(sig_g, lbp['A'] * (T1 / lbp['T1'])**(-(2.5 - gamma) / (2 - gamma)) * lbp['nu1'], out=sig_g)
+    np.divide(sig_g, nu, out=sig_g)
+    np.maximum(sig_g, 1e-100, out=sig_g)
+
+    v_gas = np.multiply(s, -(2 - gamma), out=ws.v_gas)
+    np.add(v_gas, 0.5, out=v_gas)
+    np.multiply(v_gas, nu, out=v_gas)
+    np.divide(v_gas, x, out=v_gas)
+    np.multiply(v_gas, -3.0, out=v_gas)
+
+    return sig_g, v_gas
+
+
+def impl_donorcell_adv_diff_delta(n_x, x, Diff, v, g, h, K, L, flim, u_in, dt, pl, pr, ql, qr, rl, rr, coagulation_method, A, B, C, D,
+                                  vectorized=True, solver=None, ws=None, out=None, theta=1.0):
+    r"""
+    Implicit donor cell advection-diffusion scheme with piecewise constant values
+
+    NOTE: The cell centers can be arbitrarily placed - the interfaces are assumed
+    to be in the middle of the "centers", which makes all interface values
+    just the arithmetic mean of the center values.
+
+        Perform one time step for the following PDE:
+
+           du   d  /    \    d  /              d  /       u   \ \
+           -- + -- | u v | - -- | h(x) Diff(x) -- | g(x) ----  | | = K + L u
+           dt   dx \    /    dx \              dx \      h(x) / /
+
+        with boundary conditions
+
+            dgu/h |            |
+          p ----- |      + q u |       = r
+             dx   |x=xbc       |x=xbc
+
+    Arguments:
+    ----------
+    n_x : int
+        number of grid points
+
+    x : array-like
+        the grid
+
+    Diff : array-like
+        value of Diff @ cell center
+
+    v : array-like
+        the values for v @ interface (array[i] = value @ i-1/2)
+
+    g : array-like
+        the values for g(x)
+
+    h : array-like
+        the values for h(x)
+
+    K : array-like
+        the values for K(x)
+
+    L : array-like
+        the values for L(x)
+
+    flim : array-like
+        diffusion flux limiting factor at interfaces
+
+    u : array-like
+        the current values of u(x)
+
+    dt : float | array
+        the time step, an array of n_batch time steps for batched input
+
+    Keywords:
+    ---------
+
+    vectorized : bool
+        True:  assemble the matrix with numpy array operations [default]
+        False: use the original per-cell loops (reference implementation)
+
+    solver : None | str
+        backend of the tridiagonal solver, see `tridag`, not used for
+        batched input
+
+    ws : None | workspace
+        work buffers of size n_x, see `workspace`. If given, the interface
+        values, the right hand side and the solver use these buffers and
+        the matrix assembly does not allocate any arrays.
+
+    out : None | array
+        array of size n_x in which the result is stored, may be `u_in`
+
+    theta : float
+        implicitness of the time integration, 0.5 <= theta <= 1
+        1:   backward Euler, first order [default]
+        0.5: Crank-Nicolson, second order but not L-stable
+        see also `adv_diff_step` for TR-BDF2
+
+
+    Output:
+    -------
+
+    u : array-like
+        the updated values of u(x) after timestep dt
+
+    Note:
+    -----
+
+    The equations of n_batch independent problems on the same grid `x` can
+    be solved at once by passing `u_in`, `A`, `B`, `C`, `D` (and all other
+    arrays that differ between the problems) with shape (n_batch, n_x), the
+    time step and the boundary values as arrays of length n_batch. The
+    system is then solved with `tridag_batch` and rows that hit a zero pivot
+    are returned as NaN without affecting the others.
+
+    """
+    import numpy as np
+    from numpy import zeros, maximum, minimum, shape, ndim, asarray
+    batched = ndim(u_in) == 2
+    if theta != 1.0:
+        #
+        # the matrix is that of backward Euler with a time step theta * dt,
+        # the right hand side is divided by theta below
+        #
+        if not 0.5 <= theta < 1.0:
+            raise ValueError('theta needs to be between 0.5 and 1')
+        if coagulation_method == 2:
+            raise ValueError('coagulation_method 2 needs theta = 1')
+        dt = theta * asarray(dt) if ndim(dt) > 0 else theta * dt
+    if ws is not None and not batched:
+        if ws.n != n_x:
+            raise ValueError('workspace has size {} but n_x = {}'.format(ws.n, n_x))
+        D05 = ws.D05
+        h05 = ws.h05
+        rhs = ws.rhs
+    else:
+        ws = None
+        D05 = zeros(shape(u_in))
+        h05 = zeros(shape(u_in))
+        rhs = zeros(shape(u_in))
+    if ndim(dt) > 0:
+        dt = asarray(dt)[:, None]
+    if vectorized and ws is not None:
+        _assemble_in_place(n_x, x, Diff, v, g, h, K, L, flim, dt, A, B, C, D, ws)
+    elif vectorized:
+        #
+        # calculate the arrays at the interfaces
+        #
+        D05[..., 1:] = flim[..., 1:] * 0.5 * (Diff[..., :-1] + Diff[..., 1:])
+        h05[..., 1:] = 0.5 * (h[..., :-1] + h[..., 1:])
+        #
+        # calculate the entries of the tridiagonal matrix, the operations
+        # are ordered as in the loop below to give identical results
+        #
+        vol = 0.5 * (x[2:] - x[:-2])
+        A[..., 1:-1] = -dt / vol * \
+            (
+            maximum(0., v[..., 1:-1]) +
+            D05[..., 1:-1] * h05[..., 1:-1] * g[..., :-2] / ((x[1:-1] - x[:-2]) * h[..., :-2])
+            )
+        B[..., 1:-1] = 1. - dt * L[..., 1:-1] + dt / vol * \
+            (
+            maximum(0., v[..., 2:]) -
+            minimum(0., v[..., 1:-1]) +
+            D05[..., 2:] * h05[..., 2:] * g[..., 1:-1] / ((x[2:] - x[1:-1]) * h[..., 1:-1]) +
+            D05[..., 1:-1] * h05[..., 1:-1] * g[..., 1:-1] / ((x[1:-1] - x[:-2]) * h[..., 1:-1])
+            )
+        C[..., 1:-1] = dt / vol * \
+            (
+            minimum(0., v[..., 2:]) -
+            D05[..., 2:] * h05[..., 2:] * g[..., 2:] / ((x[2:] - x[1:-1]) * h[..., 2:])
+            )
+        D[..., 1:-1] = -dt * K[..., 1:-1]
+    elif batched:
+        raise ValueError('batched input needs the vectorized matrix assembly')
+    else:
+        #
+        # calculate the arrays at the interfaces
+        #
+        for i in range(1, n_x):
+            D05[i] = flim[i] * 0.5 * (Diff[i - 1] + Diff[i])
+            h05[i] = 0.5 * (h[i - 1] + h[i])
+        #
+        # calculate the entries of the tridiagonal matrix
+        #
+        for i in range(1, n_x - 1):
+            vol = 0.5 * (x[i + 1] - x[i - 1])
+            A[i] = -dt / vol *  \
+                (
+                max(0., v[i]) +
+                D05[i] * h05[i] * g[i - 1] / ((x[i] - x[i - 1]) * h[i - 1])
+                )
+            B[i] = 1. - dt * L[i] + dt / vol * \
+                (
+                max(0., v[i + 1]) -
+                min(0., v[i]) +
+                D05[i + 1] * h05[i + 1] * g[i] / ((x[i + 1] - x[i]) * h[i]) +
+                D05[i] * h05[i] * g[i] / ((x[i] - x[i - 1]) * h[i])
+                )
+            C[i] = dt / vol *  \
+                (
+                min(0., v[i + 1]) -
+                D05[i + 1] * h05[i + 1] * g[i + 1] / ((x[i + 1] - x[i]) * h[i + 1])
+                )
+            D[i] = -dt * K[i]
+    #
+    # boundary Conditions
+    #
+    A[..., 0] = 0.
+    B[..., 0] = ql - pl * g[..., 0] / (h[..., 0] * (x[1] - x[0]))
+    C[..., 0] = pl * g[..., 1] / (h[..., 1] * (x[1] - x[0]))
+    D[..., 0] = u_in[..., 0] - rl
+
+    A[..., -1] = - pr * g[..., -2] / (h[..., -2] * (x[-1] - x[-2]))
+    B[..., -1] = qr + pr * g[..., -1] / (h[..., -1] * (x[-1] - x[-2]))
+    C[..., -1] = 0.
+    D[..., -1] = u_in[..., -1] - rr
+
+    #
+    # if coagulation_method==2,
+    #  then we change the arrays and
+    #  give them back to the calling routine
+    # otherwise, we solve the equation
+    #
+    if coagulation_method == 2:
+        A = A / dt
+        B = (B - 1.) / dt
+        C = C / dt
+        D = D / dt
+    else:
+        #
+        # the old way
+        #
+        # rhs = u - D
+
+        #
+        # the delta-way
+        #
+        if vectorized and ws is not None:
+            t1 = ws.tmp1[:n_x - 2]
+            t2 = ws.tmp2[:n_x - 2]
+            np.multiply(A[1:-1], u_in[:-2], out=t1)
+            np.multiply(B[1:-1], u_in[1:-1], out=t2)
+            np.add(t1, t2, out=t1)
+            np.multiply(C[1:-1], u_in[2:], out=t2)
+            np.add(t1, t2, out=t1)
+            np.subtract(u_in[1:-1], D[1:-1], out=rhs[1:-1])
+            np.subtract(rhs[1:-1], t1, out=rhs[1:-1])
+        elif vectorized:
+            rhs[..., 1:-1] = u_in[..., 1:-1] - D[..., 1:-1] - \
+                (A[..., 1:-1] * u_in[..., :-2] + B[..., 1:-1] * u_in[..., 1:-1] + C[..., 1:-1] * u_in[..., 2:])
+        else:
+            for i in range(1, n_x - 1):
+                rhs[i] = u_in[i] - D[i] - \
+                    (A[i] * u_in[i - 1] + B[i] * u_in[i] + C[i] * u_in[i + 1])
+        if theta != 1.0:
+            np.divide(rhs[..., 1:-1], theta, out=rhs[..., 1:-1])
+        rhs[..., 0] = rl - (B[..., 0] * u_in[..., 0] + C[..., 0] * u_in[..., 1])
+        rhs[..., -1] = rr - (A[..., -1] * u_in[..., -2] + B[..., -1] * u_in[..., -1])
+
+        #
+        # solve for u2
+        #
+        if batched:
+            u2, _ = tridag_batch(A, B, C, rhs)
+        else:
+            u2 = tridag(A, B, C, rhs, n_x, backend=solver, ws=ws)
+        #
+        # update u
+        # u = u2   # old way
+        #
+        if out is None:
+            u_out = u_in + u2  # delta way
+        else:
+            u_out = np.add(u_in, u2, out=out)
+
+    return u_out
+
+
+def _assemble_in_place(n_x, x, Diff, v, g, h, K, L, flim, dt, A, B, C, D, ws):
+    """
+    Vectorized matrix assembly of `impl_donorcell_adv_diff_delta` using the
+    buffers of the workspace `ws`. The operations are done in the same order
+    as in the vectorized assembly to give identical results.
+    """
+    import numpy as np
+
+    m = n_x - 2
+    D05 = ws.D05
+    h05 = ws.h05
+    vol = ws.vol[:m]
+    dxl = ws.dxl[:m]
+    dxr = ws.dxr[:m]
+    cA = ws.cA[:m]
+    cB = ws.cB[:m]
+    t1 = ws.tmp1[:m]
+    t2 = ws.tmp2[:m]
+    t3 = ws.tmp3[:m]
+    #
+    # interface values, ws.rhs is used as scratch space here
+    #
+    np.add(Diff[:-1], Diff[1:], out=ws.rhs[1:])
+    np.multiply(flim[1:], 0.5, out=D05[1:])
+    np.multiply(D05[1:], ws.rhs[1:], out=D05[1:])
+    np.add(h[:-1], h[1:], out=h05[1:])
+    np.multiply(0.5, h05[1:], out=h05[1:])
+    #
+    # geometric factors
+    #
+    np.subtract(x[2:], x[:-2], out=vol)
+    np.multiply(0.5, vol, out=vol)
+    np.subtract(x[1:-1], x[:-2], out=dxl)
+    np.subtract(x[2:], x[1:-1], out=dxr)
+    np.multiply(D05[1:-1], h05[1:-1], out=cA)
+    np.multiply(D05[2:], h05[2:], out=cB)
+    #
+    # lower diagonal
+    #
+    np.multiply(cA, g[:-2], out=t1)
+    np.multiply(dxl, h[:-2], out=t2)
+    np.divide(t1, t2, out=t1)
+    np.maximum(0., v[1:-1], out=t2)
+    np.add(t2, t1, out=t2)
+    np.divide(-dt, vol, out=t3)
+    np.multiply(t3, t2, out=A[1:-1])
+    #
+    # diagonal
+    #
+    np.maximum(0., v[2:], out=t1)
+    np.minimum(0., v[1:-1], out=t2)
+    np.subtract(t1, t2, out=t1)
+    np.multiply(cB, g[1:-1], out=t2)
+    np.multiply(dxr, h[1:-1], out=t3)
+    np.divide(t2, t3, out=t2)
+    np.add(t1, t2, out=t1)
+    np.multiply(cA, g[1:-1], out=t2)
+    np.multiply(dxl, h[1:-1], out=t3)
+    np.divide(t2, t3, out=t2)
+    np.add(t1, t2, out=t1)
+    np.divide(dt, vol, out=t3)
+    np.multiply(t3, t1, out=t1)
+    np.multiply(dt, L[1:-1], out=B[1:-1])
+    np.subtract(1., B[1:-1], out=B[1:-1])
+    np.add(B[1:-1], t1, out=B[1:-1])
+    #
+    # upper diagonal, t3 still holds dt / vol
+    #
+    np.multiply(cB, g[2:], out=t1)
+    np.multiply(dxr, h[2:], out=t2)
+    np.divide(t1, t2, out=t1)
+    np.minimum(0., v[2:], out=t2)
+    np.subtract(t2, t1, out=t2)
+    np.multiply(t3, t2, out=C[1:-1])
+
+    np.multiply(-dt, K[1:-1], out=D[1:-1])
+
+
+_gamma_trbdf2 = 2.0 - 2.0**0.5
+
+schemes = {'euler': 1, 'crank_nicolson': 2, 'tr_bdf2': 2}
+
+
+def adv_diff_step(n_x, x, Diff, v, g, h, K, L, flim, u_in, dt, pl, pr, ql, qr, rl, rr, A, B, C, D, scheme='euler',
+                  solver=None, ws=None, out=None):
+    """
+    One time step of the advection-diffusion equation of
+    `impl_donorcell_adv_diff_delta` with a choice of time integration. The
+    arguments are those of `impl_donorcell_adv_diff_delta` (without
+    `coagulation_method`).
+
+    Keywords:
+    ---------
+
+    scheme : str
+        'euler':          backward Euler, first order [default]
+        'crank_nicolson': theta = 1/2, second order, but oscillates for
+                          time steps far above the diffusion time of a cell
+        'tr_bdf2':        trapezoidal rule to gamma * dt, then BDF2 to dt,
+                          with gamma = 2 - sqrt(2). Second order and L-stable,
+                          it needs two solves per step.
+        `schemes` maps every scheme to its order.
+
+    solver, ws, out :
+        see `impl_donorcell_adv_diff_delta`, with a workspace the
+        intermediate stage of 'tr_bdf2' uses `ws.u_stage` and `ws.u_bdf`
+
+    Output:
+    -------
+
+    u : array-like
+        the updated values of u(x) after timestep dt
+    """
+    import numpy as np
+
+    if scheme == 'euler':
+        return impl_donorcell_adv_diff_delta(n_x, x, Diff, v, g, h, K, L, flim, u_in, dt, pl, pr, ql, qr, rl, rr, 1,
+                                             A, B, C, D, solver=solver, ws=ws, out=out)
+    elif scheme == 'crank_nicolson':
+        return impl_donorcell_adv_diff_delta(n_x, x, Diff, v, g, h, K, L, flim, u_in, dt, pl, pr, ql, qr, rl, rr, 1,
+                                             A, B, C, D, solver=solver, ws=ws, out=out, theta=0.5)
+    elif scheme != 'tr_bdf2':
+        raise ValueError('scheme needs to be one of {}'.format(', '.join(schemes.keys())))
+    #
+    # TR-BDF2: trapezoidal stage to t + gamma dt, then BDF2 through u_in and
+    # the stage, written as backward Euler from a combination w of the two:
+    #
+    #   u - (1 - gamma) / (2 - gamma) dt F(u) = w
+    #   w = (u_stage - (1 - gamma)**2 u_in) / (gamma (2 - gamma))
+    #
+    gamma = _gamma_trbdf2
+    use_ws = ws is not None and np.ndim(u_in) == 1
+    u_stage = impl_donorcell_adv_diff_delta(n_x, x, Diff, v, g, h, K, L, flim, u_in, np.multiply(gamma, dt), pl, pr,
+                                            ql, qr, rl, rr, 1, A, B, C, D, solver=solver, ws=ws,
+                                            out=ws.u_stage if use_ws else None, theta=0.5)
+    if use_ws:
+        w = np.multiply(u_in, (1 - gamma)**2, out=ws.u_bdf)
+        np.subtract(u_stage, w, out=w)
+        np.divide(w, gamma * (2 - gamma), out=w)
+    else:
+        w = (u_stage - (1 - gamma)**2 * u_in) / (gamma * (2 - gamma))
+    dt_bdf = np.multiply((1 - gamma) / (2 - gamma), dt)
+    return impl_donorcell_adv_diff_delta(n_x, x, Diff, v, g, h, K, L, flim, w, dt_bdf, pl, pr, ql, qr, rl, rr, 1,
+                                         A, B, C, D, solver=solver, ws=ws, out=out)
+
+
+def tridag(a, b, c, r, n, backend=None, ws=None):
+    """
+    Solves a tridiagnoal matrix equation
+
+        M * u  =  r
+
+    where M is tridiagonal, and u and r are vectors of length n.
+
+    Arguments:
+    ----------
+
+    a : array
+        lower diagonal entries
+
+    b : array
+        diagonal entries
+
+    c : array
+        upper diagonal entries
+
+    r : array
+        right hand side vector
+
+    n : int
+        size of the vectors
+
+    Keywords:
+    ---------
+
+    backend : None | str
+        which solver to use, see `get_solver`:
+
+        'python': pure python Thomas algorithm (reference)
+        'scipy':  LAPACK gtsv through scipy
+        'numba':  JIT-compiled Thomas algorithm, needs numba
+
+        None selects the value of the environment variable
+        `TWOPOPPY_SOLVER` or the default backend.
+
+    ws : None | workspace
+        if given, the solution is written into `ws.sol` and the work arrays
+        of the workspace are used instead of allocating new ones
+
+    Note:
+    -----
+
+    gtsv uses partial pivoting, which does not conserve the relative
+    accuracy of entries that are many orders of magnitude below the maximum
+    of u. In the dust evolution, this can cause spurious time step
+    rejections, which is why 'scipy' is never selected by default.
+
+    Returns:
+    --------
+
+    u : array
+        solution vector
+    """
+    if b[0] == 0.:
+        raise ValueError('tridag: rewrite equations')
+
+    return _tridag_backends[get_solver(backend)](a, b, c, r, n, ws=ws)
+
+
+def tridag_batch(a, b, c, r):
+    """
+    Solves n_batch independent tridiagonal matrix equations
+
+        M_i * u_i  =  r_i
+
+    with the Thomas algorithm, vectorized over the batch axis. A member that
+    hits a zero pivot does not abort the others, its solution is set to NaN
+    and it is flagged in the returned mask.
+
+    Arguments:
+    ----------
+
+    a : array
+        lower diagonal entries          (n_batch, n)
+
+    b : array
+        diagonal entries                (n_batch, n)
+
+    c : array
+        upper diagonal entries          (n_batch, n)
+
+    r : array
+        right hand side vectors         (n_batch, n)
+
+    Returns:
+    --------
+
+    u : array
+        solution vectors                (n_batch, n)
+
+    failed : array
+        boolean mask of the members that hit a zero pivot (n_batch)
+    """
+    import numpy as np
+
+    # transpose, such that the sweep accesses contiguous memory
+
+    a, b, c, r = [np.ascontiguousarray(np.transpose(np.atleast_2d(arr))) for arr in [a, b, c, r]]
+    n = r.shape[0]
+
+    gam = np.zeros_like(r)
+    u = np.zeros_like(r)
+
+    bet = b[0].copy()
+    failed = bet == 0
+    bet[failed] = 1.
+
+    u[0] = r[0] / bet
+
+    for j in range(1, n):
+        gam[j] = c[j - 1] / bet
+        bet = b[j] - a[j] * gam[j]
+
+        zero = bet == 0
+        if zero.any():
+            failed |= zero
+            bet[zero] = 1.
+        u[j] = (r[j] - a[j] * u[j - 1]) / bet
+
+    for j in range(n - 2, -1, -1):
+        u[j] = u[j] - gam[j + 1] * u[j + 1]
+
+    u[:, failed] = np.nan
+    return u.T.copy(), failed
+
+
+def get_solver(backend=None):
+    """
+    Returns the name of the tridiagonal solver backend to be used.
+
+    Keywords:
+    ---------
+
+    backend : None | str
+        'python', 'scipy' or 'numba'. If None, the environment variable
+        `TWOPOPPY_SOLVER` is used and if that is not set, 'numba' is used
+        if numba is installed and 'python' otherwise.
+
+    Returns:
+    --------
+
+    backend : str
+        name of the backend
+    """
+    import os
+    from .kernels import has_numba
+
+    if backend is None:
+        backend = os.environ.get('TWOPOPPY_SOLVER', None)
+    if backend is None:
+        backend = 'numba' if has_numba() else 'python'
+    if backend not in _tridag_backends:
+        raise ValueError('unknown tridag backend \'{}\', use one of {}'.format(
+            backend, ', '.join(_tridag_backends.keys())))
+    if backend == 'numba' and not has_numba():
+        raise ImportError('tridag backend \'numba\' needs numba to be installed')
+    return backend
+
+
+def _tridag_python(a, b, c, r, n, ws=None):
+    """
+    Pure python Thomas algorithm, see `tridag`.
+    """
+    import numpy as np
+
+    if ws is None:
+        gam = np.zeros(n)
+        u = np.zeros(n)
+    else:
+        gam = ws.gam
+        u = ws.sol
+
+    bet = b[0]
+
+    u[0] = r[0] / bet
+
+    for j in range(1, n):
+        gam[j] = c[j - 1] / bet
+        bet = b[j] - a[j] * gam[j]
+
+        if bet == 0:
+            raise ValueError('tridag failed')
+        u[j] = (r[j] - a[j] * u[j - 1]) / bet
+
+    for j in range(n - 2, -1, -1):
+        u[j] = u[j] - gam[j + 1] * u[j + 1]
+    return u
+
+
+def _tridag_scipy(a, b, c, r, n, ws=None):
+    """
+    LAPACK gtsv (Gaussian elimination with partial pivoting), see `tridag`.
+    """
+    from scipy.linalg.lapack import dgtsv
+
+    if ws is None:
+        _, _, _, u, info = dgtsv(a[1:n], b[:n], c[:n - 1], r[:n])
+    else:
+        #
+        # gtsv overwrites its input, so we work on copies in the workspace
+        #
+        ws.dl[:n - 1] = a[1:n]
+        ws.gam[:n] = b[:n]
+        ws.du[:n - 1] = c[:n - 1]
+        ws.sol[:n] = r[:n]
+        _, _, _, u, info = dgtsv(ws.dl[:n - 1], ws.gam[:n], ws.du[:n - 1], ws.sol[:n],
+                                 overwrite_dl=True, overwrite_d=True, overwrite_du=True, overwrite_b=True)
+    if info > 0:
+        raise ValueError('tridag failed')
+    elif info < 0:
+        raise ValueError('tridag: illegal value in argument {} of gtsv'.format(-info))
+    return u
+
+
+def _tridag_numba(a, b, c, r, n, ws=None):
+    """
+    JIT-compiled Thomas algorithm, see `tridag`.
+    """
+    import numpy as np
+    from .kernels import jit
+
+    if ws is None:
+        gam = np.zeros(n)
+        u = np.zeros(n)
+    else:
+        gam = ws.gam
+        u = ws.sol
+    jit('thomas')(a, b, c, r, n, gam, u)
+    return u
+
+
+_tridag_backends = {
+    'python': _tridag_python,
+    'scipy': _tridag_scipy,
+    'numba': _tridag_numba,
+    }
+
+
+class workspace(object):
+    """
+    Work buffers of the solver for a grid of n_r points. An instance is
+    created once by `run` and passed as `ws` to `update_gas`,
+    `impl_donorcell_adv_diff_delta` and `tridag`, such that the time steps
+    do not allocate new arrays.
+
+    All buffers are overwritten by every call that uses the workspace, so
+    results that need to be kept have to be copied.
+
+    Arguments:
+    ----------
+
+    n_r : int
+        number of grid points
+    """
+
+    def __init__(self, n_r):
+        import numpy as np
+
+        self.n = n_r
+        #
+        # matrix and right hand side of the implicit scheme
+        #
+        for name in ['A', 'B', 'C', 'D', 'D05', 'h05', 'rhs', 'gam', 'sol', 'dl', 'du']:
+            setattr(self, name, np.zeros(n_r))
+        #
+        # interior scratch arrays of the matrix assembly
+        #
+        for name in ['vol', 'dxl', 'dxr', 'cA', 'cB', 'tmp1', 'tmp2', 'tmp3']:
+            setattr(self, name, np.zeros(n_r))
+        #
+        # dust and gas state
+        #
+        for name in ['h', 'u_dust', 'u_half', 'u_stage', 'u_bdf', 'u_gas_in', 'u_gas', 'sig_g', 'sig_g_old', 'v_gas',
+                     'D_gas', 'g_gas', 'u_flux']:
+            setattr(self, name, np.zeros(n_r))
+        #
+        # constants and the upwind masks of the gas velocity
+        #
+        self.ones = np.ones(n_r)
+        self.zeros = np.zeros(n_r)
+        self.mask = np.zeros(n_r, dtype=bool)
+        self.imask = np.zeros(n_r, dtype=bool)
+
+
+class run_stats(object):
+    """
+    Counters of a model run, pass an instance as `stats` to `run` to
+    retrieve them.
+
+    Keywords:
+    ---------
+
+    profile : bool
+        if true, the wall time and the number of calls of every phase of
+        the time steps are recorded in `timers`. Otherwise the timers cost
+        one attribute lookup per phase.
+
+    Attributes:
+    -----------
+
+    n_accepted : int
+        number of accepted time steps
+
+    n_rejected : int
+        number of rejected attempts, i.e. failed CFL tests or steps whose
+        estimated error exceeded the tolerances
+
+    n_gas : int
+        number of gas updates
+
+    dt_min, dt_max, dt_sum : float
+        smallest, largest and total accepted time step [s], see also
+        `dt_mean`
+
+    stop_reason : None | str
+        name of the stop condition that ended the run early, see `stops`
+
+    t_stop : None | float
+        time at which the run was stopped [s]
+
+    timers : dict
+        phase name: [wall time in s, number of calls], for profile=True.
+        The phases are 'callbacks' (T, alpha and the grid context), 'size_limits',
+        'velocities', 'fused_step' (with jit=True), 'dust_solve',
+        'error_estimate' (dt_control='error'), 'cfl_retry', 'gas_solve',
+        'gas_velocity' (flux to velocity), 'gas_lbp', 'output' (snapshots
+        and reductions) and 'checkpoint'.
+    """
+
+    def __init__(self, profile=False):
+        self.n_accepted = 0
+        self.n_rejected = 0
+        self.n_gas = 0
+        self.dt_min = float('inf')
+        self.dt_max = 0.0
+        self.dt_sum = 0.0
+        self.profile = profile
+        self.timers = {}
+        self.stop_reason = None
+        self.t_stop = None
+
+    @property
+    def dt_mean(self):
+        return self.dt_sum / self.n_accepted if self.n_accepted > 0 else float('nan')
+
+    def accept(self, dt):
+        """
+        Counts an accepted step of size dt.
+        """
+        self.n_accepted += 1
+        self.dt_sum += dt
+        if dt < self.dt_min:
+            self.dt_min = dt
+        if dt > self.dt_max:
+            self.dt_max = dt
+
+    def tic(self):
+        """
+        Returns the start time of a phase, 0 if profiling is off.
+        """
+        if not self.profile:
+            return 0.0
+        from time import perf_counter
+        return perf_counter()
+
+    def toc(self, phase, start):
+        """
+        Adds the time since start to the timer of the phase and returns the
+        current time, which can be the start of the next phase.
+        """
+        if not self.profile:
+            return 0.0
+        from time import perf_counter
+        now = perf_counter()
+        timer = self.timers.get(phase)
+        if timer is None:
+            timer = self.timers[phase] = [0.0, 0]
+        timer[0] += now - start
+        timer[1] += 1
+        return now
+
+    def report(self):
+        """
+        Returns a table of the timers, sorted by time.
+        """
+        total = sum(timer[0] for timer in self.timers.values())
+        lines = ['{:<16s} {:>10s} {:>8s} {:>10s} {:>6s}'.format('phase', 'time [s]', 'calls', 'per call', '%')]
+        for phase, (seconds, calls) in sorted(self.timers.items(), key=lambda item: -item[1][0]):
+            lines.append('{:<16s} {:10.4f} {:8d} {:8.1f}us {:6.1f}'.format(
+                phase, seconds, calls, seconds / calls * 1e6, 100 * seconds / total))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        from .const import year
+        return '{} accepted steps, {} rejected steps, {} gas updates, dt = {:.3g} / {:.3g} / {:.3g} years ' \
+            '(min / mean / max)'.format(self.n_accepted, self.n_rejected, self.n_gas, self.dt_min / year,
+                                        self.dt_mean / year, self.dt_max / year)
+
+
+def progress_bar(perc, text=''):
+    """
+    This is a very simple progress bar which displays the given
+    percentage of completion on the command line, overwriting its
+    previous output.
+
+    Arguments:
+    ----------
+
+    perc : float
+        The percentage of completion, should be
+        between 0 and 100. Only 100.0 finishes with the
         word "Done!".
 
     Keywords:
@@ -626,3 +2443,850 @@ def progress_bar(perc, text=''):
     else:
         sys.stdout.write('\r' + text + '%d %%' % round(perc))
         sys.stdout.flush()
+
+
+def impl_donorcell_test(n_x=1000, rtol=1e-14):
+    """
+    Compare the vectorized and the loop-based matrix assembly of
+    `impl_donorcell_adv_diff_delta` for a dust-like and a gas-like setup
+    on a random logarithmic grid.
+
+    Keywords:
+    ---------
+
+    n_x : int
+        number of grid points
+
+    rtol : float
+        maximum allowed relative deviation
+
+    Output:
+    -------
+
+    err : float
+        the largest relative deviation that was found
+    """
+    import numpy as np
+    from .const import AU, year
+
+    rng = np.random.RandomState(1234)
+    x = np.sort(np.logspace(-1, 3, n_x) * (1 + 0.01 * rng.rand(n_x))) * AU
+    u = rng.rand(n_x) * x
+    ones = np.ones(n_x)
+    zeros = np.zeros(n_x)
+    setups = [
+        # dust: advection with changing sign, diffusion, h = sig_g * x
+        [1e17 * rng.rand(n_x), 1e3 * rng.randn(n_x), ones, 10 * rng.rand(n_x) * x, 0, 1, 1, 0, 0, u[0]],
+        # gas: pure diffusion, viscosity-like g
+        [3 * np.sqrt(x), zeros, 1e15 * rng.rand(n_x) / np.sqrt(x), ones, 1, 0, 1, 1, 0, 1e-100 * x[-1]],
+        ]
+
+    err = 0.0
+    for Diff, v, g, h, pl, pr, ql, qr, rl, rr in setups:
+        out = []
+        for vectorized in [False, True]:
+            A, B, C, D = [np.zeros(n_x) for _ in range(4)]
+            u_out = impl_donorcell_adv_diff_delta(
+                n_x, x, Diff, v, g, h, zeros, zeros, ones, u, 100 * year,
+                pl, pr, ql, qr, rl, rr, 1, A, B, C, D, vectorized=vectorized)
+            out.append([u_out, A, B, C, D])
+        for ref, vec in zip(*out):
+            err = max(err, np.max(np.abs(vec - ref) / np.maximum(np.abs(ref), 1e-300)))
+
+    assert err <= rtol, 'vectorized assembly deviates by {:g}'.format(err)
+    return err
+
+
+def tridag_backends_test(n_x=500, nr=100, nt=4):
+    """
+    Compare the tridiagonal solver backends with the python reference on a
+    well-conditioned random system and on a short run of a disk, and check
+    that every backend raises a ValueError on a zero pivot. The scipy
+    backend (gtsv) is only compared where the dust surface density is
+    within six orders of magnitude of its maximum, see `tridag`.
+
+    Keywords:
+    ---------
+
+    n_x : int
+        size of the random system
+
+    nr, nt : int
+        number of radial grid points and snapshots of the disk
+
+    Output:
+    -------
+
+    errors : dict
+        largest relative deviation from the python backend of the random
+        system and of the disk, for every backend that is available
+    """
+    import numpy as np
+    from .kernels import has_numba
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+    from .observers import silent_observer
+
+    backends = ['python', 'scipy'] + (['numba'] if has_numba() else [])
+
+    rng = np.random.RandomState(42)
+    a = rng.rand(n_x)
+    c = rng.rand(n_x)
+    b = 2 + a + c
+    r = rng.randn(n_x)
+    #
+    # the middle rows are equal, which makes the third pivot zero
+    #
+    singular = [np.array([0., 0., 1., 0.]), np.array([2., 1., 1., 2.]), np.array([0., 1., 0., 0.]), np.ones(4)]
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 4, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+
+    ref = {}
+    errors = {}
+    for backend in backends:
+        ws = workspace(n_x)
+        u = tridag(a, b, c, r, n_x, backend=backend)
+        u_ws = tridag(a, b, c, r, n_x, backend=backend, ws=ws)
+        assert np.array_equal(u, u_ws), '{} differs with a workspace'.format(backend)
+        residual = b * u - r
+        residual[1:] += a[1:] * u[:-1]
+        residual[:-1] += c[:-1] * u[1:]
+        assert np.abs(residual).max() < 1e-12, '{} does not solve the system'.format(backend)
+
+        for ws in [None, workspace(4)]:
+            try:
+                tridag(*singular, 4, backend=backend, ws=ws)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('{} did not raise on a zero pivot'.format(backend))
+
+        res = run(x, 1e-5, time, sig_g, 0.01 * sig_g, v_gas, T, 1e-3 * np.ones(nr), M_sun, 1000., 1.6, 1.0,
+                  solver=backend, observer=silent_observer())
+        sig_d = res[1][-1]
+        if backend == 'python':
+            ref = {'u': u, 'sig_d': sig_d}
+        mask = sig_d > 1e-6 * sig_d.max() if backend == 'scipy' else sig_d > 0
+        errors[backend] = (np.abs(u / ref['u'] - 1).max(), np.abs(sig_d[mask] / ref['sig_d'][mask] - 1).max())
+
+    assert all(err[0] < 1e-12 for err in errors.values()), 'the backends differ on a well-conditioned system'
+    if 'numba' in errors:
+        assert errors['numba'][1] < 1e-12, 'numba deviates by {:g} on the disk'.format(errors['numba'][1])
+    assert errors['scipy'][1] < 1e-10, 'scipy deviates by {:g} on the disk'.format(errors['scipy'][1])
+    return errors
+
+
+def tridag_batch_test(n_batch=50, n_x=300, rtol=1e-14):
+    """
+    Advance a batch of dust-like problems with one call of
+    `impl_donorcell_adv_diff_delta` and compare against solving them one
+    by one. Also checks that a singular member is flagged by `tridag_batch`
+    without affecting the others.
+
+    Keywords:
+    ---------
+
+    n_batch : int
+        number of problems
+
+    n_x : int
+        number of grid points
+
+    rtol : float
+        maximum allowed relative deviation
+
+    Output:
+    -------
+
+    err : float
+        the largest relative deviation that was found
+    """
+    import numpy as np
+    from .const import AU, year
+
+    rng = np.random.RandomState(4321)
+    x = np.logspace(-1, 3, n_x) * AU
+    u = rng.rand(n_batch, n_x) * x
+    Diff = 1e17 * rng.rand(n_batch, n_x)
+    v = 1e3 * rng.randn(n_batch, n_x)
+    h = 10 * rng.rand(n_batch, n_x) * x
+    dt = 100 * year * (1 + rng.rand(n_batch))
+    ones = np.ones(n_x)
+    zeros = np.zeros(n_x)
+
+    A, B, C, D = [np.zeros([n_batch, n_x]) for _ in range(4)]
+    u_batch = impl_donorcell_adv_diff_delta(
+        n_x, x, Diff, v, ones, h, zeros, zeros, ones, u, dt,
+        0, 1, 1, 0, 0, u[:, 0], 1, A, B, C, D)
+
+    err = 0.0
+    for i in range(n_batch):
+        A, B, C, D = [np.zeros(n_x) for _ in range(4)]
+        u_single = impl_donorcell_adv_diff_delta(
+            n_x, x, Diff[i], v[i], ones, h[i], zeros, zeros, ones, u[i], dt[i],
+            0, 1, 1, 0, 0, u[i, 0], 1, A, B, C, D, solver='python')
+        err = max(err, np.max(np.abs(u_batch[i] - u_single) / np.maximum(np.abs(u_single), 1e-300)))
+
+    assert err <= rtol, 'batched solution deviates by {:g}'.format(err)
+
+    # make the second member singular
+
+    b = 3 + rng.rand(n_batch, n_x)
+    b[1, 0] = 0.0
+    sol, failed = tridag_batch(rng.rand(n_batch, n_x), b, rng.rand(n_batch, n_x), rng.rand(n_batch, n_x))
+    assert failed[1] and failed.sum() == 1, 'singular member was not flagged'
+    assert np.isnan(sol[1]).all() and np.isfinite(np.delete(sol, 1, 0)).all()
+
+    return err
+
+
+def run_ensemble_test(n_models=4, nr=80, nt=10, rtol=1e-10):
+    """
+    Evolve a small ensemble of disks with different alpha, fragmentation
+    velocity, material density, stellar mass and sticking efficiency with
+    `run_ensemble` and compare against separate calls of `run`. Then do the
+    same for a self-similar and a cut-off disk, of which `run` evolves the
+    gas of the first with the self-similar solution and of the second
+    numerically.
+
+    Keywords:
+    ---------
+
+    n_models : int
+        number of models
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    rtol : float
+        maximum allowed relative deviation
+
+    Output:
+    -------
+
+    err : float
+        the largest relative deviation that was found
+    """
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+    from .wrapper import lbp_solution
+    from .observers import silent_observer
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 4, nt) * year
+    alpha = np.logspace(-4, -2, n_models)
+    vfrag = np.linspace(300, 1000, n_models)
+    rhos = np.linspace(1.0, 1.6, n_models)
+    mstar = np.linspace(0.5, 1.0, n_models) * M_sun
+    estick = np.linspace(0.5, 1.0, n_models)
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+
+    sig_g = np.array([0.01 * m / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc) for m in mstar])
+    sig_d = 0.01 * sig_g
+    v_gas = np.array([-1.5 * a * k_b * T / mu / m_p / np.sqrt(Grav * m / x) for a, m in zip(alpha, mstar)])
+
+    def deviation(res_e, i, res_i):
+        err = 0.0
+        for ens, single in zip(res_e[1:], res_i[1:]):
+            same = (ens[i] == single) | (np.isnan(ens[i]) & np.isnan(single))
+            with np.errstate(invalid='ignore'):
+                rel = np.abs(ens[i] - single) / np.maximum(np.abs(single), 1e-100)
+            err = max(err, np.max(np.where(same, 0.0, rel)))
+        return err
+
+    res_e = run_ensemble(x, 1e-5, time, sig_g, sig_d, v_gas, T, alpha[:, None], mstar, vfrag, rhos, 1.0,
+                         E_stick=estick, observer=silent_observer())
+
+    err = 0.0
+    for i in range(n_models):
+        res_i = run(x, 1e-5, time, sig_g[i], sig_d[i], v_gas[i], T, alpha[i] * np.ones(nr), mstar[i], vfrag[i],
+                    rhos[i], 1.0, E_stick=estick[i], observer=silent_observer())
+        err = max(err, deviation(res_e, i, res_i))
+    assert err <= rtol, 'ensemble deviates from single runs by {:g}'.format(err)
+    #
+    # the gas solution is chosen per model, as in `run`
+    #
+    T = 200 * (x / AU)**-0.5
+    nu = 1e-2 * k_b * T / mu / m_p * np.sqrt(x**3 / Grav / M_sun)
+    sig_ss, _ = lbp_solution(x, 1.0, nu[0], M_sun, 0.01 * M_sun, rc)
+    sig_g = np.array([sig_ss, np.where(x < 60 * AU, sig_ss, 1e-100)])
+    v_gas = np.array([-1.5e-2 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)] * 2)
+    setup = (x, 1e-5, time)
+    params = (T, 1e-2 * np.ones(nr), M_sun, 1000., 1.6, 1.0)
+    assert [fit_lbp(x, sig, T, 1e-2, M_sun) is not None for sig in sig_g] == [True, False]
+    res_e = run_ensemble(*setup, sig_g, 0.01 * sig_g, v_gas, *params, observer=silent_observer())
+    for i in range(2):
+        res_i = run(*setup, sig_g[i], 0.01 * sig_g[i], v_gas[i], *params, observer=silent_observer())
+        err_i = deviation(res_e, i, res_i)
+        assert err_i <= rtol, 'ensemble model {} deviates from its single run by {:g}'.format(i, err_i)
+        err = max(err, err_i)
+    return err
+
+
+def workspace_test(n_r=2000, n_steps=50, solver=None):
+    """
+    Check that the dust and gas updates with a `workspace` give the same
+    result as without it and that repeated steps do not allocate: the
+    memory traced by `tracemalloc` may neither grow over the steps (up to
+    1 kB) nor peak above the size of a single grid array (at least 4 kB).
+
+    Keywords:
+    ---------
+
+    n_r : int
+        number of grid points
+
+    n_steps : int
+        number of steps which are traced
+
+    solver : None | str
+        tridiagonal solver backend, see `tridag`
+
+    Output:
+    -------
+
+    growth, peak : int
+        growth of the traced memory over the steps and its peak above the
+        starting value in bytes
+    """
+    import tracemalloc
+    import numpy as np
+    from .const import AU, year, M_sun
+
+    x = np.logspace(-1, 3, n_r) * AU
+    T = 200 * (x / AU)**-0.5 + 10
+    sig_g = 100 * (x / AU)**-1 * np.exp(-x / (30 * AU))
+    u = 0.01 * sig_g * x
+    h = sig_g * x
+    D = 1e16 * np.ones(n_r)
+    v = -1e3 * (x / AU)**-0.5
+    ones = np.ones(n_r)
+    zeros = np.zeros(n_r)
+    dt = 100 * year
+
+    ws = workspace(n_r)
+    A, B, C, D0 = [np.zeros(n_r) for _ in range(4)]
+
+    def step():
+        impl_donorcell_adv_diff_delta(n_r, x, D, v, ones, h, zeros, zeros, ones, u, dt, 0, 1, 1, 0, 0, u[0], 1,
+                                      ws.A, ws.B, ws.C, ws.D, solver=solver, ws=ws, out=ws.u_dust)
+        update_gas(x, sig_g, dt, T, 1e-3, M_sun, solver=solver, ws=ws)
+
+    #
+    # compare with the allocating versions
+    #
+    step()
+    u_ref = impl_donorcell_adv_diff_delta(n_r, x, D, v, ones, h, zeros, zeros, ones, u, dt, 0, 1, 1, 0, 0, u[0], 1,
+                                          A, B, C, D0, solver=solver)
+    sig_ref, v_ref = update_gas(x, sig_g, dt, T, 1e-3, M_sun, solver=solver)
+    assert np.array_equal(ws.u_dust, u_ref), 'dust update with workspace differs'
+    assert np.array_equal(ws.sig_g, sig_ref), 'gas update with workspace differs'
+    assert np.array_equal(ws.v_gas, v_ref), 'gas velocity with workspace differs'
+
+    #
+    # trace the allocations of the steps
+    #
+    tracemalloc.start()
+    try:
+        step()
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for _ in range(n_steps):
+            step()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    growth = current - start
+    peak = peak - start
+    # a few bytes may be held by the interpreter's free lists
+    assert growth < 1024, 'memory grew by {} bytes over {} steps'.format(growth, n_steps)
+    assert peak < max(x.nbytes, 4096), 'steps allocated up to {} bytes'.format(peak)
+    return growth, peak
+
+
+def integrator_test(nr=100, nt=8):
+    """
+    Advance two models with `integrator.advance_to` alternately and check
+    that their snapshots are identical to those of `run`, i.e. that
+    interleaved models do not share any state.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    err : float
+        the largest absolute deviation that was found
+    """
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 4.5, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    setups = []
+    for alpha, vfrag in [(1e-3, 1000.), (1e-2, 300.)]:
+        v_gas = -1.5 * alpha * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+        setups.append((x, 1e-5, time[0], sig_g, sig_d, v_gas, T, alpha * np.ones(nr), M_sun, vfrag, 1.6, 1.0))
+
+    models = [integrator(*setup) for setup in setups]
+    states = [[model.state()] for model in models]
+    for it in range(1, nt):
+        for model, st in zip(models, states):
+            model.advance_to(time[it])
+            st.append(model.state())
+
+    names = ['sig_d', 'sig_g', 'v_bar', 'v_gas', 'v_0', 'v_1', 'a_dr', 'a_fr', 'a_df', 'a_t', 'a_gr']
+    err = 0.0
+    for setup, st in zip(setups, states):
+        res = run(*((setup[0], setup[1], time) + setup[3:]))
+        for name, ref in zip(names, res[1:]):
+            val = np.array([s[name] for s in st])
+            same = (ref == val) | (np.isnan(ref) & np.isnan(val))
+            with np.errstate(invalid='ignore'):
+                err = max(err, np.max(np.where(same, 0.0, np.abs(ref - val))))
+
+    assert err == 0.0, 'integrator deviates from run by {:g}'.format(err)
+    return err
+
+
+def checkpoint_test(nr=100, nt=10, n_stop=150, checkpoint_steps=40, npy=False, gas_rtol=None):
+    """
+    Interrupt a run after n_stop steps, restart it from its last checkpoint
+    and check that the result and two reductions are identical to those of
+    an uninterrupted run.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    n_stop : int
+        number of steps after which the first run is interrupted
+
+    checkpoint_steps : int
+        number of steps between checkpoints
+
+    npy : bool
+        if true, the interrupted and the restarted run write their
+        snapshots with `sinks.npy_sink`
+
+    gas_rtol : None | float
+        passed to `run`, to test restarts between gas updates
+
+    Output:
+    -------
+
+    err : float
+        the largest absolute deviation that was found
+    """
+    import os
+    import tempfile
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+    from .sinks import npy_sink
+    from .reductions import dust_mass, dust_radius
+
+    class preempted(Exception):
+        pass
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 5, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+
+    def alpha(x, locals_):
+        if locals_['stats'].n_accepted >= n_stop:
+            raise preempted()
+        return 1e-3 * np.ones_like(x)
+
+    def alpha_ref(x, locals_):
+        return 1e-3 * np.ones_like(x)
+
+    red_ref = [dust_mass(), dust_radius(every=7)]
+    ref = run(x, 1e-5, time, sig_g, sig_d, v_gas, T, alpha_ref, M_sun, 1000., 1.6, 1.0, reductions=red_ref,
+              gas_rtol=gas_rtol)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'checkpoint.npz')
+        try:
+            run(x, 1e-5, time, sig_g, sig_d, v_gas, T, alpha, M_sun, 1000., 1.6, 1.0,
+                checkpoint=fname, checkpoint_steps=checkpoint_steps,
+                sink=npy_sink(os.path.join(tmp, 'snapshots')) if npy else None,
+                reductions=[dust_mass(), dust_radius(every=7)], gas_rtol=gas_rtol)
+        except preempted:
+            pass
+        else:
+            raise AssertionError('the run finished in less than {} steps'.format(n_stop))
+        red = [dust_mass(), dust_radius(every=7)]
+        res = run(x, 1e-5, time, sig_g, sig_d, v_gas, T, alpha_ref, M_sun, 1000., 1.6, 1.0, restart=fname,
+                  sink=npy_sink(os.path.join(tmp, 'snapshots'), mmap_mode=None) if npy else None, reductions=red,
+                  gas_rtol=gas_rtol)
+
+    for r_ref, r in zip(red_ref, red):
+        assert np.array_equal(r_ref.times, r.times) and np.array_equal(r_ref.values, r.values), \
+            'reduction {} differs after the restart'.format(r.name)
+
+    err = 0.0
+    for a, b in zip(ref, res):
+        same = (a == b) | (np.isnan(a) & np.isnan(b))
+        with np.errstate(invalid='ignore'):
+            err = max(err, np.max(np.where(same, 0.0, np.abs(a - b))))
+    assert err == 0.0, 'restarted run deviates by {:g}'.format(err)
+    return err
+
+
+def lbp_gas_test(nr=200, nt=10, rtol=1e-2):
+    """
+    Check the self-similar gas solution: it needs to agree with
+    `wrapper.lbp_solution`, be chosen automatically for a power-law disk but
+    not for a temperature with a floor value or a disk that is cut off, and
+    agree with the numerical solution of the gas evolution within rtol
+    where the surface density is within 1e-6 of its maximum.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    rtol : float
+        allowed relative deviation from the numerical solution
+
+    Output:
+    -------
+
+    err : float
+        the largest relative deviation from the numerical solution
+    """
+    import io
+    import contextlib
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+    from .wrapper import lbp_solution
+
+    xi = np.logspace(np.log10(0.05 * AU), np.log10(3e3 * AU), nr + 1)
+    x = 0.5 * (xi[1:] + xi[:-1])
+    time = np.logspace(3, 6, nt) * year
+    T = 200 * (x / AU)**-0.5
+    alpha = 1e-2 * np.ones(nr)
+    nu = alpha * k_b * T / mu / m_p * np.sqrt(x**3 / Grav / M_sun)
+    sig_g, _ = lbp_solution(x, 1.0, nu[0], M_sun, 0.1 * M_sun, 20 * AU)
+
+    lbp = fit_lbp(x, sig_g, T, alpha, M_sun)
+    assert lbp is not None and abs(lbp['gamma'] - 1) < 1e-10, 'the self-similar profile was not recognized'
+    for t in time:
+        sig_ref, _ = lbp_solution(x, 1.0, nu[0], M_sun, 0.1 * M_sun, 20 * AU, time=t - time[0])
+        mask = sig_ref > 1e-90
+        sig_lbp, _ = lbp_gas(x, t - time[0], lbp)
+        assert np.allclose(sig_lbp[mask], sig_ref[mask], rtol=1e-10, atol=0), 'differs from lbp_solution'
+
+    assert fit_lbp(x, sig_g, np.maximum(T, 10.), alpha, M_sun) is None, 'temperature floor not detected'
+    #
+    # a disk cut off like in `wrapper.model_wrapper` is evolved numerically
+    #
+    sig_cut = np.where(x < 60 * AU, sig_g, 1e-100)
+    assert fit_lbp(x, sig_cut, T, alpha, M_sun) is None, 'cut-off disk taken as self-similar'
+    model = integrator(x, 1e-5, time[0], sig_cut, 0.01 * sig_cut, 0 * x, T, alpha, M_sun, 1000., 1.6, 1.)
+    assert model.lbp is None, '\'auto\' chose the self-similar solution for a cut-off disk'
+    try:
+        integrator(x, 1e-5, time[0], sig_g, 0.01 * sig_g, 0 * x, np.maximum(T, 10.), alpha, M_sun, 1000., 1.6, 1.,
+                   gas_solution='lbp')
+        raise AssertionError('gas_solution=\'lbp\' should fail if the assumptions do not hold')
+    except ValueError:
+        pass
+
+    res = {}
+    for gas_solution in ['numerical', 'lbp', 'auto']:
+        with contextlib.redirect_stdout(io.StringIO()):
+            res[gas_solution] = run(x, 1e-5, time, sig_g, 0.01 * sig_g, lbp_gas(x, 0.0, lbp)[1].copy(), T, alpha,
+                                    M_sun, 1000., 1.6, 1., gas_solution=gas_solution)
+    for a, b in zip(res['lbp'], res['auto']):
+        assert np.array_equal(a, b, equal_nan=True), '\'auto\' did not choose the self-similar solution'
+
+    g_num, g_lbp = res['numerical'][2], res['lbp'][2]
+    err = 0.0
+    for i in range(1, nt):
+        mask = g_lbp[i] > 1e-6 * g_lbp[i].max()
+        err = max(err, np.max(np.abs(g_num[i][mask] / g_lbp[i][mask] - 1)))
+    assert err < rtol, 'the numerical and the self-similar solution deviate by {:g}'.format(err)
+    return err
+
+
+def gas_subcycling_test(nr=200, nt=20, gas_rtol=1e-3):
+    """
+    Compare runs in which the gas is updated every second step or with the
+    tolerance gas_rtol with a run in which gas and dust are updated in
+    lock-step, on the disk of `wrapper.model_wrapper_test`, and restart a
+    subcycled run from a checkpoint between two gas updates.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    gas_rtol : float
+        tolerance of the gas updates
+
+    Output:
+    -------
+
+    err_every, err_rtol : float
+        the largest relative deviation of the gas and dust surface density
+        from the lock-step run (where sig_g is within 1e-6 of its maximum)
+        for gas_every=2 and gas_rtol
+    """
+    import io
+    import contextlib
+    import numpy as np
+    from .const import year
+    from .benchmarks import canonical_disk
+
+    d = canonical_disk(nr)
+    a = d['args']
+    time = np.logspace(3, 6, nt) * year
+
+    def go(**kwargs):
+        stats = run_stats()
+        with contextlib.redirect_stdout(io.StringIO()):
+            res = run(d['x'], a.a0, time, d['sig_g'], d['sig_d'], d['v_gas'], d['T'], d['alpha'], a.mstar,
+                      a.vfrag, a.rhos, a.edrift, stats=stats, **kwargs)
+        return res, stats
+
+    def deviation(res, ref):
+        err = 0.0
+        for i in range(1, nt):
+            mask = ref[2][i] > 1e-6 * ref[2][i].max()
+            for j in [1, 2]:
+                err = max(err, np.max(np.abs(res[j][i][mask] / ref[j][i][mask] - 1)))
+        return err
+
+    ref, stats_ref = go()
+    assert stats_ref.n_gas == stats_ref.n_accepted
+
+    res, stats = go(gas_every=2)
+    assert stats.n_gas < 0.55 * stats.n_accepted, 'the gas was updated too often'
+    err_every = deviation(res, ref)
+    assert err_every < 2e-2, 'gas_every=2 deviates by {:g}'.format(err_every)
+
+    res, stats = go(gas_rtol=gas_rtol)
+    assert stats.n_gas < stats.n_accepted, 'the gas was updated every step'
+    err_rtol = deviation(res, ref)
+    assert err_rtol < 2 * gas_rtol, 'gas_rtol={:g} deviates by {:g}'.format(gas_rtol, err_rtol)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        checkpoint_test(gas_rtol=1e-2)
+
+    return err_every, err_rtol
+
+
+def profile_test(nr=200, nt=20):
+    """
+    Run a model with and without profiling and check that the results are
+    identical, that all phases of the steps were timed and that the time
+    step statistics are consistent.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    stats : run_stats
+        the statistics of the profiled run, `print(stats.report())` shows
+        the timers
+    """
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 5, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+    setup = (x, 1e-5, time, sig_g, sig_d, v_gas, T, 1e-3 * np.ones(nr), M_sun, 1000., 1.6, 1.0)
+
+    for dt_control, phases in [('cfl', []), ('error', ['error_estimate'])]:
+        plain = run_stats()
+        stats = run_stats(profile=True)
+        ref = run(*setup, dt_control=dt_control, gas_solution='numerical', stats=plain)
+        res = run(*setup, dt_control=dt_control, gas_solution='numerical', stats=stats)
+        for a, b in zip(ref, res):
+            assert np.array_equal(a, b, equal_nan=True), 'profiling changed the result'
+        assert plain.timers == {}, 'timers recorded without profiling'
+
+        phases = phases + ['callbacks', 'size_limits', 'velocities', 'dust_solve', 'gas_solve', 'gas_velocity',
+                           'output']
+        missing = set(phases) - set(stats.timers)
+        assert not missing, 'phases {} were not timed'.format(', '.join(sorted(missing)))
+        assert stats.timers['callbacks'][1] == stats.n_accepted
+        assert stats.timers['gas_solve'][1] == stats.timers['gas_velocity'][1] == stats.n_gas
+        assert stats.timers['output'][1] == nt
+        assert stats.dt_min <= stats.dt_mean <= stats.dt_max
+        assert np.isclose(stats.dt_sum, time[-1] - time[0], rtol=1e-12), 'time steps do not add up'
+
+    return stats
+
+
+def time_scheme_test(n_x=200, nr=400):
+    """
+    Check the order of the time integration schemes of `adv_diff_step` on
+    an advection-diffusion problem, and that the second order schemes
+    reach the self-similar solution of Lynden-Bell & Pringle (see
+    `lbp_gas`) with a few large gas steps, where backward Euler needs
+    many more.
+
+    Keywords:
+    ---------
+
+    n_x : int
+        number of grid points of the advection-diffusion problem
+
+    nr : int
+        number of radial grid points of the gas disk
+
+    Output:
+    -------
+
+    orders, errors : dict
+        the measured order and the relative deviation of the gas from the
+        self-similar solution after five steps, for every scheme
+    """
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+    from .wrapper import lbp_solution
+
+    #
+    # advection-diffusion of a gaussian with fixed boundary values
+    #
+    x = np.linspace(1, 2, n_x)
+    Diff = np.full(n_x, 1e-2)
+    v = np.full(n_x, 0.05)
+    ones = np.ones(n_x)
+    zeros = np.zeros(n_x)
+    u_0 = np.exp(-((x - 1.4) / 0.05)**2) + 1e-3
+    ws = workspace(n_x)
+
+    def evolve(scheme, n_steps, use_ws=False):
+        u = u_0.copy()
+        for _ in range(n_steps):
+            u = adv_diff_step(n_x, x, Diff, v, ones, ones, zeros, zeros, ones, u, 1.0 / n_steps, 0, 0, 1, 1,
+                              1e-3, 1e-3, ws.A, ws.B, ws.C, ws.D, scheme=scheme, ws=ws if use_ws else None,
+                              out=ws.u_dust if use_ws else None).copy()
+        return u
+
+    ref = evolve('tr_bdf2', 2048)
+    orders = {}
+    for scheme, order in schemes.items():
+        assert np.array_equal(evolve(scheme, 4), evolve(scheme, 4, use_ws=True)), 'workspace changes ' + scheme
+        err = [np.abs(evolve(scheme, n) - ref).max() for n in [16, 32]]
+        orders[scheme] = np.log2(err[0] / err[1])
+        assert abs(orders[scheme] - order) < 0.2, '{} is of order {:.2f}'.format(scheme, orders[scheme])
+    #
+    # viscous evolution of a self-similar disk over 1e5 years in five steps
+    #
+    x = np.logspace(-1, 3, nr) * AU
+    T = 200 * (x / AU)**-0.5
+    nu = 1e-3 * k_b * T / mu / m_p * np.sqrt(x**3 / Grav / M_sun)
+    sig_0, _ = lbp_solution(x, np.polyfit(np.log(x / x[0]), np.log(nu), 1)[0], nu[0], M_sun, 0.01 * M_sun, 30 * AU)
+    sig_0 = np.maximum(sig_0, 1e-100)
+    lbp = fit_lbp(x, sig_0, T, 1e-3, M_sun)
+    t_end = 1e5 * year
+    sig_lbp, _ = lbp_gas(x, t_end, lbp)
+    mask = (sig_lbp > 1e-6 * sig_lbp.max()) & (x > AU)
+
+    def gas_error(scheme, n_steps):
+        sig = sig_0
+        for _ in range(n_steps):
+            sig, _ = update_gas(x, sig, t_end / n_steps, T, 1e-3, M_sun, scheme=scheme)
+        return np.abs(sig[mask] / sig_lbp[mask] - 1).max()
+
+    #
+    # the remaining deviation of a converged solution is that of the grid
+    #
+    floor = gas_error('tr_bdf2', 200)
+    errors = {scheme: gas_error(scheme, 5) for scheme in schemes}
+    assert errors['euler'] > 3 * floor, 'backward Euler should not have converged with five steps'
+    for scheme in ['crank_nicolson', 'tr_bdf2']:
+        assert errors[scheme] < 1.1 * floor, '{} deviates by {:.2e} from the self-similar solution'.format(
+            scheme, errors[scheme])
+    return orders, errors
+
+
+def error_control_test(nr=100, nt=5):
+    """
+    Run a model with `dt_control='error'` at several tolerances and check
+    that the error against a tight-tolerance run shrinks with rtol, that
+    the accepted and rejected steps are counted, and that every additional
+    snapshot, which cuts a step short, costs at most one more step.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    errors : dict
+        maximum relative error of the final dust surface density, and the
+        accepted and rejected steps for every rtol
+    """
+    import numpy as np
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+    from .observers import silent_observer
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+
+    def sig_final(rtol, nt):
+        stats = run_stats()
+        time = np.logspace(2, 5, nt) * year
+        res = run(x, 1e-5, time, sig_g, sig_d, v_gas, T, 1e-3 * np.ones(nr), M_sun, 1000., 1.6, 1.0,
+                  dt_control='error', rtol=rtol, stats=stats, observer=silent_observer())
+        return res[1][-1], stats
+
+    ref, _ = sig_final(1e-5, nt)
+    mask = ref > 1e-6 * ref.max()
+    errors = {}
+    for rtol in [1e-1, 1e-2, 1e-3]:
+        sig, stats = sig_final(rtol, nt)
+        errors[rtol] = (np.abs(sig[mask] / ref[mask] - 1).max(), stats.n_accepted, stats.n_rejected)
+    assert errors[1e-1][0] > errors[1e-2][0] > errors[1e-3][0], 'the error does not shrink with rtol'
+    assert errors[1e-1][1] < errors[1e-2][1] < errors[1e-3][1]
+    assert errors[1e-3][2] > 0, 'no rejected steps were counted'
+    #
+    # snapshots cut steps short, but the controller keeps its proposal
+    #
+    _, stats = sig_final(1e-2, 10 * nt)
+    n_steps = errors[1e-2][1] + errors[1e-2][2]
+    assert stats.n_accepted + stats.n_rejected <= n_steps + 9 * nt, 'snapshots restart the step size'
+    return errors
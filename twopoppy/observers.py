@@ -0,0 +1,292 @@
+"""
+Observers of the progress of `model.run` and `model.run_ensemble`.
+
+Instead of writing to the terminal, the models report their progress to an
+observer, which decides what to do with it. An observer is an object with
+the following methods and attribute:
+
+    start(event)        called before the first step
+    update(event)       called at every snapshot and, if `every` is not
+                        None, after every `every` accepted steps
+    finish(event)       called when the run ended, also if a stop
+                        condition ended it early
+    every               None or a number of accepted steps
+
+The events are `progress_event`s. The default `console_observer` writes a
+progress bar to stdout at most once per `min_interval` seconds, the
+`silent_observer` ignores all events and the `logging_observer` writes them
+to a `logging` logger, which is the better choice for many models running
+in parallel:
+
+    >>> import logging
+    >>> from twopoppy import model, observers
+    >>> logging.basicConfig(level=logging.INFO)
+    >>> res = model.run(..., observer=observers.logging_observer(min_interval=60.))
+"""
+import sys
+import logging
+from time import perf_counter
+
+
+class progress_event(object):
+    """
+    The progress of a run.
+
+    Attributes:
+    -----------
+
+    t : float
+        current time                                    [s]
+
+    t_end : float
+        time of the last snapshot                       [s]
+
+    dt : float
+        the last time step                              [s]
+
+    n_steps : int
+        number of accepted time steps so far
+
+    snapshot : int
+        index of the last snapshot that was reached
+
+    n_snapshots : int
+        number of snapshots of the run
+
+    done : bool
+        True in the event passed to `finish`
+
+    stop_reason : None | str
+        name of the stop condition that ended the run
+    """
+
+    def __init__(self, t, t_end, dt, n_steps, snapshot, n_snapshots, done=False, stop_reason=None):
+        self.t = t
+        self.t_end = t_end
+        self.dt = dt
+        self.n_steps = n_steps
+        self.snapshot = snapshot
+        self.n_snapshots = n_snapshots
+        self.done = done
+        self.stop_reason = stop_reason
+
+    @property
+    def fraction(self):
+        """
+        Fraction of the snapshots that were reached, between 0 and 1.
+        """
+        if self.done or self.n_snapshots < 2:
+            return 1.0
+        return self.snapshot / (self.n_snapshots - 1)
+
+    def __str__(self):
+        from .const import year
+        return 'snapshot {}/{}, t = {:.4g} years, dt = {:.3g} years, {} steps'.format(
+            self.snapshot, self.n_snapshots - 1, self.t / year, self.dt / year, self.n_steps)
+
+
+class observer(object):
+    """
+    Base class of the observers, it ignores all events.
+    """
+
+    every = None
+
+    def start(self, event):
+        pass
+
+    def update(self, event):
+        pass
+
+    def finish(self, event):
+        pass
+
+
+class silent_observer(observer):
+    """
+    Observer that ignores all events, for runs that should not write
+    anything.
+    """
+    pass
+
+
+class console_observer(observer):
+    """
+    Writes a progress bar like `model.progress_bar`, but at most once per
+    `min_interval` seconds, so that fast runs do not spend their time on
+    the terminal.
+
+    Keywords:
+    ---------
+
+    text : str
+        text in front of the percentage
+
+    min_interval : float
+        minimum time between two updates of the bar [s]
+
+    stream : None | file
+        where to write, defaults to the current `sys.stdout`
+    """
+
+    def __init__(self, text='toy model running', min_interval=0.5, stream=None):
+        self.text = text
+        self.min_interval = min_interval
+        self.stream = stream
+        self._last = None
+
+    def _write(self, string):
+        stream = self.stream or sys.stdout
+        stream.write('\r' + self.text + ' ... ' + string)
+        stream.flush()
+
+    def start(self, event):
+        self._last = perf_counter()
+        self._write('%d %%' % round(100 * event.fraction))
+
+    def update(self, event):
+        now = perf_counter()
+        if self._last is not None and now - self._last < self.min_interval:
+            return
+        self._last = now
+        self._write('%d %%' % round(100 * event.fraction))
+
+    def finish(self, event):
+        if event.stop_reason is None:
+            self._write('Done!\n')
+        else:
+            self._write('stopped by {} at {:.1f} %\n'.format(event.stop_reason, 100 * event.t / event.t_end))
+
+
+class logging_observer(observer):
+    """
+    Writes the progress to a `logging` logger, at most once per
+    `min_interval` seconds. The start and the end of the run are always
+    logged.
+
+    Keywords:
+    ---------
+
+    logger : None | str | logging.Logger
+        the logger or its name, defaults to the logger 'twopoppy'
+
+    level : int
+        logging level of the messages
+
+    min_interval : float
+        minimum time between two messages [s]
+
+    every : None | int
+        also report every `every` accepted steps, not only at the snapshots
+    """
+
+    def __init__(self, logger=None, level=logging.INFO, min_interval=10., every=None):
+        if logger is None or isinstance(logger, str):
+            logger = logging.getLogger(logger or 'twopoppy')
+        self.logger = logger
+        self.level = level
+        self.min_interval = min_interval
+        self.every = every
+        self._last = None
+
+    def start(self, event):
+        self._last = perf_counter()
+        self.logger.log(self.level, 'run started: %s', event)
+
+    def update(self, event):
+        now = perf_counter()
+        if self._last is not None and now - self._last < self.min_interval:
+            return
+        self._last = now
+        self.logger.log(self.level, '%s', event)
+
+    def finish(self, event):
+        if event.stop_reason is None:
+            self.logger.log(self.level, 'run finished: %s', event)
+        else:
+            self.logger.log(self.level, 'run stopped by %s: %s', event.stop_reason, event)
+
+
+def observers_test(nr=100, nt=10):
+    """
+    Run a model with a recording observer that is also called every few
+    steps, and check the order and content of the events and that the
+    results do not depend on the observer. Then check that the console
+    observer is throttled and that the logging observer writes the start
+    and end of the run.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    events : list
+        the (method, event) pairs of the recording observer
+    """
+    import io
+    import numpy as np
+    from . import model
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 5, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+    setup = (x, 1e-5, time, sig_g, 0.01 * sig_g, v_gas, T, 1e-3 * np.ones(nr), M_sun, 1000., 1.6, 1.0)
+
+    class recorder(observer):
+        every = 7
+
+        def __init__(self):
+            self.events = []
+
+        def start(self, event):
+            self.events.append(('start', event))
+
+        def update(self, event):
+            self.events.append(('update', event))
+
+        def finish(self, event):
+            self.events.append(('finish', event))
+
+    stats = model.run_stats()
+    rec = recorder()
+    res = model.run(*setup, observer=rec, stats=stats)
+    ref = model.run(*setup, observer=silent_observer())
+    for a, b in zip(ref, res):
+        assert np.array_equal(a, b), 'the observer changed the results'
+
+    kinds = [kind for kind, _ in rec.events]
+    assert kinds[0] == 'start' and kinds[-1] == 'finish' and kinds.count('finish') == 1
+    events = [event for _, event in rec.events]
+    assert events[0].fraction == 0.0 and events[-1].fraction == 1.0 and events[-1].done
+    assert events[-1].n_steps == stats.n_accepted and events[-1].t == time[-1]
+    assert all(a.t <= b.t and a.n_steps <= b.n_steps for a, b in zip(events[:-1], events[1:]))
+    for it in range(1, nt):
+        assert any(e.snapshot == it and e.t == time[it] for e in events[1:-1]), 'snapshot {} not reported'.format(it)
+    assert sum(event.n_steps % recorder.every == 0 for event in events[1:-1]) >= stats.n_accepted // recorder.every
+
+    out = io.StringIO()
+    model.run(*setup, observer=console_observer(min_interval=1e3, stream=out))
+    assert out.getvalue() == '\rtoy model running ... 0 %\rtoy model running ... Done!\n', 'console not throttled'
+
+    out = io.StringIO()
+    logger = logging.getLogger('twopoppy.observers_test')
+    logger.propagate = False
+    handler = logging.StreamHandler(out)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        model.run(*setup, observer=logging_observer(logger, min_interval=1e3))
+    finally:
+        logger.removeHandler(handler)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2 and lines[0].startswith('run started') and lines[1].startswith('run finished')
+
+    return rec.events
@@ -0,0 +1,182 @@
+"""
+Reductions of the model state to small time series, evaluated during
+`model.run`.
+
+A reduction wraps a function `func(model)` that receives the
+`model.integrator` and returns a number (or a small array). It is evaluated
+at every snapshot or every `every` accepted time steps and accumulates the
+times and values:
+
+    >>> from twopoppy import model, reductions
+    >>> m_d = reductions.dust_mass()
+    >>> r_68 = reductions.dust_radius(0.68, every=100)
+    >>> res = model.run(..., fields=['sig_d'], reductions=[m_d, r_68])
+    >>> m_d.times, m_d.values
+
+The functions must not modify the state of the integrator. Useful
+attributes are `x`, `t`, `sig_d`, `sig_g`, `v_gas`, `size_limits` and
+`velocities`, see `model.integrator`.
+"""
+import numpy as np
+
+
+class reduction(object):
+    """
+    Time series of a function of the model state.
+
+    Arguments:
+    ----------
+
+    func : function
+        called with the `model.integrator` as only argument
+
+    Keywords:
+    ---------
+
+    every : None | int
+        None: evaluate at every snapshot
+        k:    evaluate every k accepted time steps
+
+    name : None | str
+        name of the reduction, defaults to the name of func
+
+    Attributes:
+    -----------
+
+    times : list
+        times at which func was evaluated [s]
+
+    values : list
+        the results of func
+    """
+
+    def __init__(self, func, every=None, name=None):
+        if every is not None and every < 1:
+            raise ValueError('every needs to be None or a positive number of steps')
+        self.func = func
+        self.every = every
+        self.name = name or func.__name__
+        self.times = []
+        self.values = []
+
+    def record(self, model):
+        """
+        Evaluate the function for the current state of `model`.
+        """
+        self.times.append(model.t)
+        self.values.append(self.func(model))
+
+    def __repr__(self):
+        return 'reduction {} with {} values'.format(self.name, len(self.values))
+
+
+def _mass(x, sigma):
+    """
+    Mass within the radial grid x of the surface density sigma.
+    """
+    return np.trapz(2 * np.pi * x * sigma, x)
+
+
+def dust_mass(every=None):
+    """
+    Total dust mass on the grid [g].
+    """
+    def dust_mass(model):
+        return _mass(model.x, model.sig_d)
+    return reduction(dust_mass, every=every)
+
+
+def gas_mass(every=None):
+    """
+    Total gas mass on the grid [g].
+    """
+    def gas_mass(model):
+        return _mass(model.x, model.sig_g)
+    return reduction(gas_mass, every=every)
+
+
+def dust_radius(fraction=0.68, every=None):
+    """
+    Radius that contains the given fraction of the dust mass [cm],
+    interpolated linearly in the cumulative mass.
+    """
+    def dust_radius(model):
+        x = model.x
+        dm = 0.5 * (2 * np.pi * x[1:] * model.sig_d[1:] + 2 * np.pi * x[:-1] * model.sig_d[:-1]) * np.diff(x)
+        m_cum = np.hstack((0.0, np.cumsum(dm)))
+        return np.interp(fraction * m_cum[-1], m_cum, x)
+    return reduction(dust_radius, every=every, name='dust_radius_{:g}'.format(fraction))
+
+
+def inner_dust_flux(every=None):
+    """
+    Dust mass flux through the first cell interface, positive for
+    accretion onto the star [g s^-1]. It is the donor cell advection and
+    the diffusion flux of `model.impl_donorcell_adv_diff_delta` with the
+    velocity and diffusion constant of the last time step.
+    """
+    def inner_dust_flux(model):
+        x = model.x
+        u = model.sig_d[:2] * x[:2]
+        h = model.sig_g[:2] * x[:2]
+        v = model.velocities['v_bar'][1]
+        D = model.velocities['D'][:2]
+        adv = v * (u[1] if v < 0 else u[0])
+        diff = 0.25 * (D[0] + D[1]) * (h[0] + h[1]) * (u[1] / h[1] - u[0] / h[0]) / (x[1] - x[0])
+        return -2 * np.pi * (adv - diff)
+    return reduction(inner_dust_flux, every=every)
+
+
+def reductions_test(nr=100, nt=10):
+    """
+    Run a model recording only three fields and a few reductions and
+    compare them with a run recording all fields.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    err : float
+        the largest relative deviation of the dust mass at the snapshots
+    """
+    from . import model
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 5, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+    alpha = 1e-3 * np.ones(nr)
+    setup = (x, 1e-5, time, sig_g, sig_d, v_gas, T, alpha, M_sun, 1000., 1.6, 1.0)
+
+    ref = model.run(*setup)
+
+    stats = model.run_stats()
+    m_d = dust_mass()
+    r_68 = dust_radius(0.68, every=10)
+    flux = inner_dust_flux()
+    res = model.run(*setup, stats=stats, fields=['a_t', 'sig_g', 'sig_d'], reductions=[m_d, r_68, flux])
+
+    for i, (a, b) in enumerate(zip(ref[1:], res[1:])):
+        if i in [0, 1, 9]:
+            assert np.array_equal(a, b), 'selected field {} differs'.format(i)
+        else:
+            assert b is None, 'field {} was not selected but returned'.format(i)
+
+    assert np.array_equal(m_d.times, time), 'dust mass not recorded at the snapshots'
+    assert len(r_68.values) == stats.n_accepted // 10, 'dust radius not recorded every 10 steps'
+    assert np.all(np.diff(r_68.times) > 0) and np.all(np.array(r_68.values) > 0)
+    assert np.all(np.array(flux.values[1:]) > 0), 'dust should be accreted'
+
+    m_ref = np.array([_mass(x, sig) for sig in ref[1]])
+    err = np.max(np.abs(np.array(m_d.values) / m_ref - 1))
+    assert err < 1e-14, 'dust mass deviates by {:g}'.format(err)
+    return err
@@ -1,100 +1,263 @@
 from .args import args
 
 
+class _lazy(object):
+    """
+    Field of `results` that is loaded from disk on first access. `results.read`
+    registers the file of each field in the `_loaders` dictionary of the
+    instance. The first access loads it and stores it in the instance
+    dictionary, which takes precedence over this (non-data) descriptor for
+    all further accesses. Fields without a file are None.
+    """
+
+    def __init__(self, attr):
+        self.attr = attr
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return None
+        loader = obj.__dict__.get('_loaders', {}).pop(self.attr, None)
+        value = None if loader is None else _load(*loader)
+        obj.__dict__[self.attr] = value
+        return value
+
+
 class results:
-    nri          = None # noqa
-    xi           = None # noqa
-    x            = None # noqa
-    timesteps    = None # noqa
-    T            = None # noqa
-    alpha        = None # noqa
-    sigma_g      = None # noqa
-    sigma_d      = None # noqa
-    v_gas        = None # noqa
-    v_dust       = None # noqa
-    v_0          = None # noqa
-    v_1          = None # noqa
-    a_dr         = None # noqa
-    a_fr         = None # noqa
-    a_df         = None # noqa
-    a_t          = None # noqa
-    args         = None # noqa
-    a            = None # noqa
-    sig_sol      = None # noqa
-
-    def write(self, dirname=None):
+    nri          = None                # noqa
+    xi           = None                # noqa
+    x            = _lazy('x')          # noqa
+    timesteps    = _lazy('timesteps')  # noqa
+    T            = _lazy('T')          # noqa
+    alpha        = _lazy('alpha')      # noqa
+    sigma_g      = _lazy('sigma_g')    # noqa
+    sigma_d      = _lazy('sigma_d')    # noqa
+    v_gas        = _lazy('v_gas')      # noqa
+    v_dust       = _lazy('v_dust')     # noqa
+    v_0          = _lazy('v_0')        # noqa
+    v_1          = _lazy('v_1')        # noqa
+    a_dr         = _lazy('a_dr')       # noqa
+    a_fr         = _lazy('a_fr')       # noqa
+    a_df         = _lazy('a_df')       # noqa
+    a_t          = _lazy('a_t')        # noqa
+    args         = None                # noqa
+    a            = _lazy('a')          # noqa
+    sig_sol      = _lazy('sig_sol')    # noqa
+    stats        = None                # noqa
+
+    def __getstate__(self):
+        """
+        Load all pending fields before pickling.
+        """
+        for attr, _ in _fields:
+            getattr(self, attr)
+        state = self.__dict__.copy()
+        state.pop('_loaders', None)
+        return state
+
+    def write(self, dirname=None, fmt='npy', verbose=False):
         """
         Export data to the specified folder.
+
+        Keywords:
+        ---------
+
+        dirname : None | str
+            output folder, defaults to args.dir
+
+        fmt : str
+            'npy': one binary numpy file per field [default]
+            'txt': one text file per field (the format of earlier versions)
+
+        In both cases, the simulation parameters are written to the file
+        parameters.ini in the same folder.
+
+        verbose : bool
+            print the name of the output folder
         """
         import os
         import numpy as np
 
+        if fmt not in _writers:
+            raise ValueError('fmt needs to be one of {}'.format(', '.join(_writers.keys())))
+
         if dirname is None:
             dirname = self.args.dir
 
-        print('\n' + 35 * '-')
-        print('writing results to {} ...'.format(dirname))
+        if verbose:
+            print('\n' + 35 * '-')
+            print('writing results to {} ...'.format(dirname))
         if not os.path.isdir(dirname):
             os.mkdir(dirname)
 
-        np.savetxt(dirname + os.sep + 'sigma_g.dat', self.sigma_g)                  # noqa
-        np.savetxt(dirname + os.sep + 'sigma_d.dat', self.sigma_d)                  # noqa
-        np.savetxt(dirname + os.sep + 'x.dat',       self.x)                        # noqa
-        np.savetxt(dirname + os.sep + 'T.dat',       self.T)                        # noqa
-        np.savetxt(dirname + os.sep + 'alpha.dat',   np.array(self.alpha, ndmin=1)) # noqa
-        np.savetxt(dirname + os.sep + 'time.dat',    self.timesteps)                # noqa
-        np.savetxt(dirname + os.sep + 'v_gas.dat',   self.v_gas)                    # noqa
-        np.savetxt(dirname + os.sep + 'v_dust.dat',  self.v_dust)                   # noqa
-        np.savetxt(dirname + os.sep + 'v_0.dat',     self.v_0)                      # noqa
-        np.savetxt(dirname + os.sep + 'v_1.dat',     self.v_1)                      # noqa
-        np.savetxt(dirname + os.sep + 'a_dr.dat',    self.a_dr)                     # noqa
-        np.savetxt(dirname + os.sep + 'a_fr.dat',    self.a_fr)                     # noqa
-        np.savetxt(dirname + os.sep + 'a_df.dat',    self.a_df)                     # noqa
-        np.savetxt(dirname + os.sep + 'a_t.dat',     self.a_t)                      # noqa
-
-        if self.a is not None and self.sig_sol is not None:
-            np.savetxt(dirname + os.sep + 'a.dat', self.a)
-            np.savetxt(dirname + os.sep + 'sigma_d_a.dat', self.sig_sol)
-
-        self.args.write_args()
-
-    def read(self, dirname=None):
+        ext, writer = _writers[fmt]
+        for attr, name in _fields:
+            value = getattr(self, attr)
+            if attr == 'alpha':
+                value = np.array(value, ndmin=1)
+            if attr not in ['a', 'sig_sol'] or (self.a is not None and self.sig_sol is not None):
+                writer(dirname + os.sep + name + ext, value)
+
+        self.args.write_args(fname=os.path.join(dirname, 'parameters.ini'))
+
+    def read(self, dirname=None, mmap=True, verbose=False):
         """
-        Read results from the specified folder.
+        Read results from the specified folder. The format (binary or text)
+        is detected automatically. Only the parameters are read right away,
+        each field is loaded on its first access.
+
+        Keywords:
+        ---------
+
+        dirname : None | str
+            folder to read from, defaults to args.dir or 'data'
+
+        mmap : bool
+            if true, binary files are memory-mapped: only the parts of a
+            field that are accessed are read from disk, e.g. `sigma_d[-1]`
+            reads only the last snapshot
+
+        verbose : bool
+            print the name of the folder
         """
         import os
-        import numpy as np
 
         if dirname is None:
-            if self.args.dir is not None:
-                dirname = self.abs.dir
+            if self.args is not None and self.args.dir is not None:
+                dirname = self.args.dir
             else:
                 dirname = 'data'
 
-        print('\n' + 35 * '-')
-        print('reading results from {} ...'.format(dirname))
+        if verbose:
+            print('\n' + 35 * '-')
+            print('reading results from {} ...'.format(dirname))
         if not os.path.isdir(dirname):
-            os.mkdir(dirname)
+            raise IOError('results directory {} does not exist'.format(dirname))
+
+        if os.path.isfile(dirname + os.sep + 'sigma_g.npy'):
+            ext = '.npy'
+        else:
+            ext = '.dat'
 
-        self.sigma_g = np.loadtxt(dirname + os.sep + 'sigma_g.dat')
-        self.sigma_d = np.loadtxt(dirname + os.sep + 'sigma_d.dat')
-        self.x = np.loadtxt(dirname + os.sep + 'x.dat')
-        self.T = np.loadtxt(dirname + os.sep + 'T.dat')
-        self.alpha = np.loadtxt(dirname + os.sep + 'alpha.dat')
-        self.timesteps = np.loadtxt(dirname + os.sep + 'time.dat')
-        self.v_gas = np.loadtxt(dirname + os.sep + 'v_gas.dat')
-        self.v_0 = np.loadtxt(dirname + os.sep + 'v_0.dat')
-        self.v_1 = np.loadtxt(dirname + os.sep + 'v_1.dat')
-        self.a_dr = np.loadtxt(dirname + os.sep + 'a_dr.dat')
-        self.a_fr = np.loadtxt(dirname + os.sep + 'a_fr.dat')
-        self.a_df = np.loadtxt(dirname + os.sep + 'a_df.dat')
-        self.a_t = np.loadtxt(dirname + os.sep + 'a_t.dat')
-
-        if os.path.isfile(dirname + os.sep + 'a.dat'):
-            self.a = np.loadtxt(dirname + os.sep + 'a.dat')
-        if os.path.isfile(dirname + os.sep + 'sigma_d_a.dat'):
-            self.sig_sol = np.loadtxt(dirname + os.sep + 'sigma_d_a.dat')
+        self._loaders = {}
+        for attr, name in _fields:
+            fname = dirname + os.sep + name + ext
+            self.__dict__.pop(attr, None)
+            if os.path.isfile(fname):
+                self._loaders[attr] = (fname, mmap)
 
         self.args = args()
         self.args.dir = dirname
         self.args.read_args()
+
+
+def _load(fname, mmap):
+    """
+    Loads a field written by `results.write`.
+    """
+    import numpy as np
+    if fname.endswith('.npy'):
+        return np.load(fname, mmap_mode='r' if mmap else None)
+    else:
+        return np.loadtxt(fname)
+
+
+def _save_txt(fname, value):
+    import numpy as np
+    np.savetxt(fname, value)
+
+
+def _save_npy(fname, value):
+    import numpy as np
+    np.save(fname, np.asarray(value))
+
+
+# attribute names and file names of the fields of `results`
+
+_fields = [
+    ('sigma_g',   'sigma_g'),    # noqa
+    ('sigma_d',   'sigma_d'),    # noqa
+    ('x',         'x'),          # noqa
+    ('T',         'T'),          # noqa
+    ('alpha',     'alpha'),      # noqa
+    ('timesteps', 'time'),       # noqa
+    ('v_gas',     'v_gas'),      # noqa
+    ('v_dust',    'v_dust'),     # noqa
+    ('v_0',       'v_0'),        # noqa
+    ('v_1',       'v_1'),        # noqa
+    ('a_dr',      'a_dr'),       # noqa
+    ('a_fr',      'a_fr'),       # noqa
+    ('a_df',      'a_df'),       # noqa
+    ('a_t',       'a_t'),        # noqa
+    ('a',         'a'),          # noqa
+    ('sig_sol',   'sigma_d_a'),  # noqa
+    ]
+
+# file extension and writing function of each format
+
+_writers = {
+    'npy': ('.npy', _save_npy),
+    'txt': ('.dat', _save_txt),
+    }
+
+
+def results_io_test(nt=20, nr=50):
+    """
+    Write random results in both formats, read them back and check that
+    the fields are loaded only when accessed, that all fields and parameters
+    are recovered exactly and that read results can be pickled.
+
+    Keywords:
+    ---------
+
+    nt, nr : int
+        shape of the snapshot arrays
+
+    Output:
+    -------
+
+    n_fields : int
+        number of fields that were compared per format
+    """
+    import io
+    import os
+    import pickle
+    import tempfile
+    import contextlib
+    import numpy as np
+
+    rng = np.random.RandomState(1)
+    res = results()
+    res.args = args(nr=nr, nt=nt, alpha=3e-3)
+    res.x = np.logspace(13, 16, nr)
+    res.timesteps = np.logspace(10, 14, nt)
+    res.T = rng.rand(nr)
+    res.alpha = 3e-3
+    for attr, _ in _fields:
+        if getattr(res, attr) is None:
+            setattr(res, attr, 10**(10 * rng.rand(nt, nr) - 5))
+
+    n_fields = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, mmap in [('npy', True), ('npy', False), ('txt', False)]:
+            dirname = os.path.join(tmp, fmt)
+            res2 = results()
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                res.write(dirname, fmt=fmt)
+                res2.read(dirname, mmap=mmap)
+            assert out.getvalue() == '', 'write and read are not quiet'
+            loaded = [attr for attr, _ in _fields if attr in vars(res2)]
+            assert not loaded, 'fields {} were loaded before they were accessed'.format(loaded)
+            assert res2.sigma_d[-1].shape == (nr,) and 'sigma_d' in vars(res2) and 'sigma_g' not in vars(res2), \
+                'accessing sigma_d loaded other fields'
+            res3 = pickle.loads(pickle.dumps(res2))
+            n_fields = 0
+            for attr, _ in _fields:
+                ref = np.array(getattr(res, attr), ndmin=1)
+                for other in [res2, res3]:
+                    assert np.array_equal(ref, np.array(getattr(other, attr), ndmin=1)), \
+                        '{} differs after {} round trip'.format(attr, fmt)
+                n_fields += 1
+            assert isinstance(res2.sigma_g, np.memmap) == mmap, 'mmap={} not respected'.format(mmap)
+            assert res2.args.nr == nr and res2.args.alpha == 3e-3, 'parameters differ after {} round trip'.format(fmt)
+    return n_fields
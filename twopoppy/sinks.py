@@ -0,0 +1,196 @@
+"""
+Snapshot sinks of `model.run`.
+
+Every time a snapshot is reached, `model.run` pushes the state of the model
+to a sink, which either keeps it in memory or writes it to disk. A sink is
+an object with the following methods:
+
+    start(names, time, n_r)         prepare the storage of the fields `names`
+                                    for the snapshot times `time`
+    resume(names, time, n_r, saved) the same when restarting from a
+                                    checkpoint, `saved` is the dict returned
+                                    by `state`
+    write(it, state)                store the snapshot number `it`, `state`
+                                    is the dict of `model.integrator.state`
+    state(n_filled)                 dict of arrays that a checkpoint needs to
+                                    store to resume the first n_filled
+                                    snapshots
+    close()                         finish writing
+    result()                        dict of arrays (nt, nr) for every field
+
+Example:
+--------
+
+    >>> from twopoppy import model, sinks
+    >>> res = model.run(..., sink=sinks.npy_sink('data/snapshots'))
+"""
+import os
+import numpy as np
+
+
+class memory_sink(object):
+    """
+    Keeps all snapshots in (nt, nr) arrays in memory, this is the default of
+    `model.run`.
+    """
+
+    def start(self, names, time, n_r):
+        self.data = {name: np.zeros([len(time), n_r]) for name in names}
+
+    def resume(self, names, time, n_r, saved):
+        self.start(names, time, n_r)
+        for name in names:
+            n_filled = len(saved[name])
+            self.data[name][:n_filled] = saved[name]
+
+    def write(self, it, state):
+        for name, arr in self.data.items():
+            arr[it, :] = state[name]
+
+    def state(self, n_filled):
+        return {name: arr[:n_filled] for name, arr in self.data.items()}
+
+    def close(self):
+        pass
+
+    def result(self):
+        return self.data
+
+
+class npy_sink(object):
+    """
+    Writes every snapshot to disk as soon as it is reached, such that the
+    memory needed by the model does not depend on the number of snapshots.
+    Each field is stored as a numpy file `<name>.npy` of shape (nt, nr) in
+    the given directory, the snapshot times in `time.npy`. Rows of snapshots
+    that were not reached are zero.
+
+    Arguments:
+    ----------
+
+    dirname : str
+        output directory, created if needed
+
+    Keywords:
+    ---------
+
+    mmap_mode : None | str
+        how `result` opens the files, see `numpy.load`. The default 'r'
+        returns read-only memory maps.
+    """
+
+    def __init__(self, dirname, mmap_mode='r'):
+        self.dirname = dirname
+        self.mmap_mode = mmap_mode
+        self.files = {}
+
+    def _fname(self, name):
+        return os.path.join(self.dirname, name + '.npy')
+
+    def _open(self, names, n_t, n_r, create):
+        """
+        Opens the files for writing, they are created with zeros if `create`
+        is true, otherwise they need to exist with the right shape.
+        """
+        self.shape = (n_t, n_r)
+        self.offsets = {}
+        for name in names:
+            fname = self._fname(name)
+            if create:
+                np.lib.format.open_memmap(fname, mode='w+', shape=self.shape)
+            f = open(fname, 'r+b')
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if shape != self.shape or fortran_order or dtype != np.float64:
+                f.close()
+                raise ValueError('{} does not contain a float array of shape {}'.format(fname, self.shape))
+            self.offsets[name] = f.tell()
+            self.files[name] = f
+
+    def start(self, names, time, n_r):
+        os.makedirs(self.dirname, exist_ok=True)
+        np.save(os.path.join(self.dirname, 'time.npy'), time)
+        self._open(names, len(time), n_r, True)
+
+    def resume(self, names, time, n_r, saved):
+        self._open(names, len(time), n_r, False)
+
+    def write(self, it, state):
+        row_bytes = self.shape[1] * 8
+        for name, f in self.files.items():
+            row = np.broadcast_to(np.asarray(state[name], dtype=np.float64), self.shape[1:])
+            f.seek(self.offsets[name] + it * row_bytes)
+            f.write(np.ascontiguousarray(row).tobytes())
+
+    def state(self, n_filled):
+        #
+        # the snapshots are already on disk, make sure that they are written
+        #
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        return {}
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def result(self):
+        return {name: np.load(self._fname(name), mmap_mode=self.mmap_mode) for name in self.offsets}
+
+
+def sink_test(nr=100, nt=200):
+    """
+    Run the same model with `memory_sink` and `npy_sink` and check that the
+    results are identical and that the peak memory traced by `tracemalloc`
+    with `npy_sink` is much lower, as it does not grow with nt.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    peak_memory, peak_npy : int
+        peak traced memory of the two runs in bytes
+    """
+    import tempfile
+    import tracemalloc
+    from . import model
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 4, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+    alpha = 1e-3 * np.ones(nr)
+
+    def run(sink):
+        return model.run(x, 1e-5, time, sig_g, sig_d, v_gas, T, alpha, M_sun, 1000., 1.6, 1.0, sink=sink)
+
+    ref = run(memory_sink())
+
+    peaks = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for sink in [memory_sink(), npy_sink(tmp)]:
+            tracemalloc.start()
+            try:
+                res = run(sink)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        for a, b in zip(ref, res):
+            assert np.array_equal(a, b, equal_nan=True), 'npy_sink gives a different result'
+        del res
+
+    assert peaks[1] < peaks[0] / 4, 'npy_sink needed {} bytes, memory_sink {}'.format(peaks[1], peaks[0])
+    return peaks[0], peaks[1]
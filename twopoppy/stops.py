@@ -0,0 +1,223 @@
+"""
+Stop conditions that end `model.run` before the last snapshot.
+
+A stop condition is evaluated every `every` accepted time steps. As soon as
+one of them is met, the run ends: the snapshots that were not reached are
+NaN, or cut off with `truncate=True`, and the name of the condition and the
+time are stored in the `model.run_stats`:
+
+    >>> from twopoppy import model, stops
+    >>> stats = model.run_stats()
+    >>> res = model.run(..., stats=stats, stop=[stops.dust_depleted(1e-3), stops.steady_state(1e-3)])
+    >>> stats.stop_reason, stats.t_stop
+
+Custom conditions are functions `func(model)` of the `model.integrator`
+that return True to stop, wrapped as `stop_condition(func, every=10)`, or
+subclasses that implement `test`. The built-in conditions are classes, so
+that they can be pickled and passed to `sweep.run`.
+"""
+import numpy as np
+
+
+class stop_condition(object):
+    """
+    Condition that ends a run when it returns True.
+
+    Arguments:
+    ----------
+
+    func : None | function
+        called with the `model.integrator`, returns True to stop. Subclasses
+        implement `test` instead.
+
+    Keywords:
+    ---------
+
+    every : int
+        evaluate every `every` accepted time steps
+
+    name : None | str
+        name of the condition, which is reported as the reason of the stop,
+        defaults to the name of func or of the class
+
+    Attributes:
+    -----------
+
+    state : dict
+        arrays that the condition keeps between evaluations, they are
+        stored in checkpoints
+    """
+
+    def __init__(self, func=None, every=10, name=None):
+        if every < 1:
+            raise ValueError('every needs to be a positive number of steps')
+        self.func = func
+        self.every = every
+        self.name = name or (func.__name__ if func is not None else type(self).__name__)
+        self.state = {}
+
+    def reset(self):
+        """
+        Forget the state of a previous run.
+        """
+        self.state = {}
+
+    def test(self, model):
+        return bool(self.func(model))
+
+    def check(self, model):
+        """
+        Evaluates the condition if it is due after the current step.
+        """
+        return model.stats.n_accepted % self.every == 0 and self.test(model)
+
+    def __repr__(self):
+        return 'stop condition {} every {} steps'.format(self.name, self.every)
+
+
+def _mass(x, sigma):
+    return np.trapz(2 * np.pi * x * sigma, x)
+
+
+class dust_depleted(stop_condition):
+    """
+    Stops when the dust mass on the grid fell below `fraction` of its value
+    at the first evaluation.
+    """
+
+    def __init__(self, fraction=1e-3, every=10):
+        super().__init__(every=every)
+        self.fraction = fraction
+
+    def test(self, model):
+        m_d = _mass(model.x, model.sig_d)
+        if 'm_0' not in self.state:
+            self.state['m_0'] = np.array(m_d)
+        return m_d < self.fraction * self.state['m_0']
+
+
+class dust_radius_below(stop_condition):
+    """
+    Stops when the radius that contains `fraction` of the dust mass is
+    smaller than r_min [cm], e.g. the inner radius of the disk of interest.
+    """
+
+    def __init__(self, r_min, fraction=0.68, every=10):
+        super().__init__(every=every)
+        self.r_min = r_min
+        self.fraction = fraction
+
+    def test(self, model):
+        x = model.x
+        dm = 0.5 * (2 * np.pi * x[1:] * model.sig_d[1:] + 2 * np.pi * x[:-1] * model.sig_d[:-1]) * np.diff(x)
+        m_cum = np.hstack((0.0, np.cumsum(dm)))
+        return np.interp(self.fraction * m_cum[-1], m_cum, x) < self.r_min
+
+
+class steady_state(stop_condition):
+    """
+    Stops when the dust surface density changes by less than rtol per
+    e-folding of time, i.e. |d ln sig_d / d ln t| < rtol, where it is
+    above `floor` times its maximum. The rate is measured between two
+    evaluations. As the dust hardly changes while it grows, it does not
+    stop before t_min [s].
+    """
+
+    def __init__(self, rtol=1e-3, floor=1e-6, t_min=0.0, every=100):
+        super().__init__(every=every)
+        self.rtol = rtol
+        self.floor = floor
+        self.t_min = t_min
+
+    def test(self, model):
+        sig_d, t = model.sig_d, model.t
+        if t < self.t_min:
+            return False
+        last = self.state.get('sig_d')
+        t_last = self.state.get('t')
+        self.state['sig_d'] = sig_d.copy()
+        self.state['t'] = np.array(t)
+        if last is None or t_last <= 0 or t <= t_last:
+            return False
+        mask = last > self.floor * last.max()
+        change = np.abs(sig_d[mask] / last[mask] - 1).max()
+        return change / np.log(t / t_last) < self.rtol
+
+
+def stops_test(nr=100, nt=20):
+    """
+    Stop a run with a steady state condition and check that the snapshots
+    before the stop equal those of a full run, that the others are NaN
+    or cut off, and that a run with a checkpoint stops at the same step.
+    Then check the depletion and radius conditions on a draining disk.
+
+    Keywords:
+    ---------
+
+    nr, nt : int
+        number of radial grid points and snapshots
+
+    Output:
+    -------
+
+    stats : run_stats
+        the statistics of the stopped run, with `stop_reason` and `t_stop`
+    """
+    import io
+    import os
+    import pickle
+    import tempfile
+    import contextlib
+    from . import model
+    from .const import AU, year, M_sun, k_b, mu, m_p, Grav
+
+    x = np.logspace(-1, 2.5, nr) * AU
+    time = np.logspace(2, 6, nt) * year
+    T = 200 * (x / AU)**-0.5 + 10
+    rc = 30 * AU
+    sig_g = 0.01 * M_sun / (2 * np.pi * rc**2) * (x / rc)**-1 * np.exp(-x / rc)
+    sig_d = 0.01 * sig_g
+    v_gas = -1.5e-3 * k_b * T / mu / m_p / np.sqrt(Grav * M_sun / x)
+    setup = (x, 1e-5, time, sig_g, sig_d, v_gas, T, 1e-3 * np.ones(nr), M_sun, 1000., 1.6, 1.0)
+
+    def run(**kwargs):
+        stats = model.run_stats()
+        with contextlib.redirect_stdout(io.StringIO()):
+            res = model.run(*setup, stats=stats, **kwargs)
+        return res, stats
+
+    ref, ref_stats = run()
+    assert ref_stats.stop_reason is None
+
+    stop = steady_state(1.0, t_min=300 * year, every=20)
+    res, stats = run(stop=[stop])
+    assert stats.stop_reason == 'steady_state' and stats.n_accepted < ref_stats.n_accepted, 'the run did not stop'
+    n_filled = np.searchsorted(time, stats.t_stop)
+    assert 1 < n_filled < nt
+    for a, b in zip(ref[1:], res[1:]):
+        assert np.array_equal(a[:n_filled], b[:n_filled]), 'snapshots before the stop differ'
+        assert np.all(np.isnan(b[n_filled:])), 'snapshots after the stop are filled'
+
+    cut, _ = run(stop=[pickle.loads(pickle.dumps(stop))], truncate=True)
+    assert len(cut[0]) == n_filled and all(np.array_equal(a, b[:n_filled]) for a, b in zip(cut[1:], res[1:]))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'checkpoint.npz')
+        _, stats_cp = run(stop=[stop], checkpoint=fname, checkpoint_steps=30)
+        _, stats_restart = run(stop=[stop], checkpoint=fname, restart=fname)
+    assert stats_cp.n_accepted == stats.n_accepted == stats_restart.n_accepted, 'checkpoint changed the stop'
+    assert stats_restart.stop_reason == 'steady_state'
+
+    _, depleted = run(stop=[dust_depleted(0.9), dust_radius_below(1e-3 * AU)])
+    assert depleted.stop_reason == 'dust_depleted'
+    #
+    # the initial dust radius is 34 AU
+    #
+    _, shrunk = run(stop=[dust_radius_below(30 * AU, every=5)])
+    assert shrunk.stop_reason is None
+    _, shrunk = run(stop=[dust_radius_below(35 * AU, every=5)])
+    assert shrunk.stop_reason == 'dust_radius_below' and shrunk.n_accepted == 5
+    _, custom = run(stop=[stop_condition(lambda m: m.t > 1e4 * year, every=1, name='t_max')])
+    assert custom.stop_reason == 't_max' and 1e4 * year < custom.t_stop < 1.1e4 * year
+
+    return stats
@@ -0,0 +1,277 @@
+"""
+Append-only store of many `results`, for example of a parameter sweep.
+
+Unlike `wrapper.write_grid_results`, which pickles a whole list of results
+into one compressed stream, the store appends every model as a separately
+compressed record to a data file and keeps an index of the parameters and
+the position of every record. Loading one model, or selecting models by
+their parameters, only reads the index and the requested records:
+
+    >>> from twopoppy.store import grid_store
+    >>> store = grid_store('data/grid')
+    >>> store.append(res)
+    >>> for i in store.select(alpha=1e-3, vfrag=lambda v: v > 500):
+    ...     res = store[i]
+
+A store is a directory with the files
+
+    records.bin     the compressed, pickled results, one after the other
+    index.jsonl     one line of JSON per record with its offset, length,
+                    compression, parameters and meta data
+    lock            file that is locked while a record is appended
+
+Several processes can append to the same store at the same time, as
+appends are serialized with `fcntl.flock`. The index line is only written
+after the record, so readers never see an incomplete record.
+"""
+import os
+import json
+import gzip
+import bz2
+import lzma
+import pickle
+from numbers import Number
+
+_codecs = {
+    'raw': [lambda data: data, lambda data: data],
+    'gzip': [gzip.compress, gzip.decompress],
+    'bz2': [bz2.compress, bz2.decompress],
+    'xz': [lzma.compress, lzma.decompress]}
+
+
+def _jsonable(value):
+    """
+    Converts a parameter value to something that can be written as JSON:
+    numbers, strings, None and lists of them. Functions are stored as the
+    string 'function'.
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, Number):
+        return value.item() if hasattr(value, 'item') else value
+    if hasattr(value, '__call__'):
+        return 'function'
+    if hasattr(value, '__len__'):
+        return [_jsonable(v) for v in value]
+    return str(value)
+
+
+class grid_store(object):
+    """
+    Append-only store of `results` with an index of their parameters.
+
+    Arguments:
+    ----------
+
+    path : str
+        directory of the store, created if needed
+
+    Keywords:
+    ---------
+
+    compression : str
+        compression of the records that are appended, one of 'raw', 'gzip',
+        'bz2', 'xz'. Records of different compression can be mixed.
+    """
+
+    def __init__(self, path, compression='gzip'):
+        if compression not in _codecs:
+            raise ValueError('compression needs to be one of {}'.format(', '.join(_codecs.keys())))
+        self.path = path
+        self.compression = compression
+        self.entries = []
+        self._index_pos = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _fname(self, name):
+        return os.path.join(self.path, name)
+
+    def append(self, res, **meta):
+        """
+        Append a model to the store.
+
+        Arguments:
+        ----------
+
+        res : results
+            the model, its parameters are taken from `res.args`
+
+        Keywords:
+        ---------
+
+        any JSON-serializable meta data to be stored in the index
+
+        Output:
+        -------
+
+        offset : int
+            position of the record in the data file
+        """
+        import fcntl
+
+        data = _codecs[self.compression][0](pickle.dumps(res, protocol=pickle.HIGHEST_PROTOCOL))
+        params = {}
+        if res.args is not None:
+            params = {name: _jsonable(getattr(res.args, name)) for name, _ in res.args.varlist}
+
+        with open(self._fname('lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self._fname('records.bin'), 'ab') as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                entry = {'offset': offset, 'length': len(data), 'compression': self.compression,
+                         'params': params, 'meta': {name: _jsonable(value) for name, value in meta.items()}}
+                with open(self._fname('index.jsonl'), 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return offset
+
+    def refresh(self):
+        """
+        Read the index lines that were appended since the last call.
+        """
+        fname = self._fname('index.jsonl')
+        if not os.path.isfile(fname):
+            return
+        with open(fname, 'r') as f:
+            f.seek(self._index_pos)
+            for line in f:
+                #
+                # a line without newline is still being written
+                #
+                if not line.endswith('\n'):
+                    break
+                self.entries.append(json.loads(line))
+                self._index_pos += len(line.encode())
+
+    def __len__(self):
+        self.refresh()
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        """
+        Load the i-th model of the store.
+        """
+        self.refresh()
+        entry = self.entries[i]
+        with open(self._fname('records.bin'), 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['length'])
+        return pickle.loads(_codecs[entry['compression']][1](data))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, **params):
+        """
+        Indices of the models whose parameters match.
+
+        Keywords:
+        ---------
+
+        parameter names with either the value that the parameter needs to
+        have, or a function that returns True for accepted values. The name
+        'meta' matches against a dict of meta data.
+
+        Output:
+        -------
+
+        indices : list
+            the indices of the matching models, use them with `store[i]`
+        """
+        self.refresh()
+        meta = params.pop('meta', {})
+
+        def wanted(values):
+            return {name: value if hasattr(value, '__call__') else _jsonable(value) for name, value in values.items()}
+
+        def match(stored, wanted):
+            for name, value in wanted.items():
+                if name not in stored:
+                    return False
+                if hasattr(value, '__call__'):
+                    if not value(stored[name]):
+                        return False
+                elif stored[name] != value:
+                    return False
+            return True
+
+        params, meta = wanted(params), wanted(meta)
+        return [i for i, entry in enumerate(self.entries) if match(entry['params'], params) and match(entry['meta'], meta)]
+
+
+def _store_test_writer(path, worker, n):
+    """
+    Appends n small models to the store, used by `store_test`.
+    """
+    import numpy as np
+    from .args import args
+    from .results import results
+
+    store = grid_store(path, compression=['raw', 'gzip', 'bz2', 'xz'][worker % 4])
+    for i in range(n):
+        res = results()
+        res.args = args(alpha=1e-3 * (worker + 1), nr=i)
+        res.sigma_g = np.full((3, 4), 10. * worker + i)
+        store.append(res, worker=worker, i=i)
+
+
+def store_test(workers=4, n=25):
+    """
+    Append models from several processes at the same time and check that
+    every record can be read back and selected by its parameters. Then
+    check that a model can be loaded if another record is damaged, which
+    shows that only the requested record is read.
+
+    Keywords:
+    ---------
+
+    workers : int
+        number of processes writing at the same time
+
+    n : int
+        number of models every process writes
+
+    Output:
+    -------
+
+    store : grid_store
+        the store, which is in a temporary directory that is already removed
+    """
+    import tempfile
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(_store_test_writer, tmp, w, n) for w in range(workers)]:
+                future.result()
+
+        store = grid_store(tmp)
+        assert len(store) == workers * n, 'expected {} records, found {}'.format(workers * n, len(store))
+
+        for worker in range(workers):
+            indices = store.select(alpha=1e-3 * (worker + 1))
+            assert len(indices) == n, 'selection by alpha failed'
+            for i in indices:
+                res = store[i]
+                meta = store.entries[i]['meta']
+                assert meta['worker'] == worker and res.args.nr == meta['i']
+                assert np.all(res.sigma_g == 10. * worker + meta['i']), 'record {} is damaged'.format(i)
+
+        assert store.select(nr=lambda nr: nr < 5, meta={'worker': 0}) == store.select(meta={'worker': 0})[:5]
+
+        first, last = store.entries[0], store.entries[-1]
+        with open(os.path.join(tmp, 'records.bin'), 'r+b') as f:
+            f.seek(first['offset'])
+            f.write(b'\0' * first['length'])
+        assert np.all(store[-1].sigma_g == 10. * last['meta']['worker'] + last['meta']['i'])
+
+    return store
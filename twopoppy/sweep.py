@@ -0,0 +1,307 @@
+"""
+Parallel parameter sweeps of `wrapper.model_wrapper`.
+
+A sweep is a list of dicts that override attributes of an `args` instance.
+Every entry is run as one model in a `concurrent.futures.ProcessPoolExecutor`
+and the outcome is returned as a `record`, in the order of the list:
+
+    >>> from twopoppy import sweep
+    >>> from twopoppy.const import AU
+    >>> overrides = sweep.grid(alpha=[1e-4, 1e-3, 1e-2], rc=[30 * AU, 100 * AU])
+    >>> records = sweep.run(overrides, workers=8, timeout=3600)
+    >>> res = [rec.result for rec in records if rec.ok]
+
+A model that raises an error or exceeds the timeout does not stop the sweep,
+its record contains the status and the traceback instead of the result. The
+list of results can be stored with `wrapper.write_grid_results`. For large
+sweeps, pass `store='dirname'` instead: every worker appends its model to a
+`store.grid_store` as soon as it finishes, and the results are not kept in
+memory.
+"""
+import os
+import signal
+
+
+class record(object):
+    """
+    Outcome of one model of a sweep.
+
+    Attributes:
+    -----------
+
+    index : int
+        position of the model in the sweep
+
+    overrides : dict
+        the parameters that were changed with respect to the base arguments
+
+    args : args
+        the full set of parameters of the model
+
+    status : str
+        'done', 'failed' or 'timeout'
+
+    result : None | results
+        the output of `model_wrapper` if the status is 'done' and the sweep
+        did not write to a store
+
+    error : None | str
+        the traceback if the model failed
+
+    runtime : float
+        wall clock time of the model in seconds
+    """
+
+    def __init__(self, index, overrides, args, status, result=None, error=None, runtime=0.0):
+        self.index = index
+        self.overrides = overrides
+        self.args = args
+        self.status = status
+        self.result = result
+        self.error = error
+        self.runtime = runtime
+
+    @property
+    def ok(self):
+        return self.status == 'done'
+
+    def __repr__(self):
+        return 'record {} {}: {} ({:.3g} s)'.format(self.index, self.overrides, self.status, self.runtime)
+
+
+class _timeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise _timeout()
+
+
+def grid(**values):
+    """
+    Cartesian product of parameter values.
+
+    Keywords:
+    ---------
+
+    any attribute of `args` with a list of values
+
+    Output:
+    -------
+
+    overrides : list
+        list of dicts with one value of every keyword, the last keyword
+        varies fastest
+
+    Example:
+    --------
+
+    >>> grid(alpha=[1e-3, 1e-2], vfrag=[100., 1000.])
+    [{'alpha': 0.001, 'vfrag': 100.0}, {'alpha': 0.001, 'vfrag': 1000.0},
+     {'alpha': 0.01, 'vfrag': 100.0}, {'alpha': 0.01, 'vfrag': 1000.0}]
+    """
+    import itertools
+    names = list(values.keys())
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def _run_one(ARGS, save, timeout, quiet, store=None, index=None, stop=None):
+    """
+    Runs `model_wrapper` in a worker process and returns the status, the
+    result, the traceback and the runtime. The timeout is enforced in the
+    worker with `signal.setitimer`, since the executor cannot stop a task
+    that is running. If a store is given, the result is appended to it
+    instead of being returned.
+    """
+    import time
+    import traceback
+    import contextlib
+    from .wrapper import model_wrapper
+    from .store import grid_store
+    from .observers import silent_observer
+
+    start = time.perf_counter()
+    if timeout is not None:
+        handler = signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if quiet:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                res = model_wrapper(ARGS, save=save, stop=stop, observer=silent_observer())
+        else:
+            res = model_wrapper(ARGS, save=save, stop=stop)
+        status, error = 'done', None
+    except _timeout:
+        res, status, error = None, 'timeout', 'model exceeded the timeout of {} s'.format(timeout)
+    except (Exception, SystemExit):
+        #
+        # SystemExit is caught as well, as it would end the whole sweep
+        # when the executor passes it on
+        #
+        res, status, error = None, 'failed', traceback.format_exc()
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+    #
+    # the timer is cleared, so the timeout cannot interrupt an append and
+    # leave a record without its index line
+    #
+    if store is not None and status == 'done':
+        try:
+            grid_store(store).append(res, sweep_index=index)
+            res = None
+        except Exception:
+            res, status, error = None, 'failed', traceback.format_exc()
+    return status, res, error, time.perf_counter() - start
+
+
+def run(overrides, base=None, workers=None, timeout=None, save=False, quiet=True, store=None, stop=None):
+    """
+    Run a model for every entry of `overrides` in parallel.
+
+    Arguments:
+    ----------
+
+    overrides : list
+        list of dicts of parameters that replace those of `base`, see `grid`
+
+    Keywords:
+    ---------
+
+    base : None | args
+        the parameters that are not overridden, defaults to `args()`
+
+    workers : None | int
+        number of worker processes, defaults to the number of CPUs
+
+    timeout : None | float
+        maximum wall clock time of every model in seconds, needs
+        `signal.setitimer` (not available on Windows)
+
+    save : bool
+        whether each model writes its results to disk. If `dir` is not
+        overridden, model i writes to the sub-directory `sweep_<i>` of
+        `base.dir`.
+
+    quiet : bool
+        suppress the output that the models print
+
+    store : None | str
+        directory of a `store.grid_store` to which every model is appended
+        when it finishes, with the meta data `sweep_index`. The `result`
+        of the records is then None.
+
+    stop : None | list
+        `stops.stop_condition`s that end every model early, see
+        `wrapper.model_wrapper`. They are copied to the workers, so custom
+        conditions need to be picklable.
+
+    Output:
+    -------
+
+    records : list
+        one `record` for every entry of `overrides`, in the same order
+    """
+    import copy
+    import traceback
+    from concurrent.futures import ProcessPoolExecutor
+    from .args import args
+
+    if base is None:
+        base = args()
+    if timeout is not None and not hasattr(signal, 'setitimer'):
+        raise ValueError('timeouts are not supported on this platform')
+
+    tasks = []
+    for i, override in enumerate(overrides):
+        ARGS = copy.deepcopy(base)
+        for name, value in override.items():
+            if not hasattr(ARGS, name):
+                raise ValueError('unknown parameter \'{}\' in sweep entry {}'.format(name, i))
+            setattr(ARGS, name, value)
+        if save and 'dir' not in override:
+            ARGS.dir = os.path.join(base.dir, 'sweep_{:04d}'.format(i))
+        tasks.append(ARGS)
+
+    records = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_one, ARGS, save, timeout, quiet, store, i, stop) for i, ARGS in enumerate(tasks)]
+        for i, (override, ARGS, future) in enumerate(zip(overrides, tasks, futures)):
+            #
+            # errors raised here are those of the executor itself,
+            # for example if a worker died or the result could not be pickled
+            #
+            try:
+                status, res, error, runtime = future.result()
+            except Exception:
+                status, res, error, runtime = 'failed', None, traceback.format_exc(), 0.0
+            records.append(record(i, override, ARGS, status, result=res, error=error, runtime=runtime))
+    return records
+
+
+def _sweep_test_T(x, state):
+    """
+    Temperature that jumps up after 2e4 years, such that the time step
+    gets too short, used by `sweep_test`.
+    """
+    from .const import AU, year
+    return 100 * (x / AU)**-0.5 * (1 if state.t < 2e4 * year else 1e6)
+
+
+def sweep_test(workers=2):
+    """
+    Run a small sweep with two failing entries and compare one of the models
+    with a direct call of `model_wrapper`. Repeat part of it writing to a
+    `grid_store`, then check that a model that runs too long is stopped by
+    the timeout.
+
+    Keywords:
+    ---------
+
+    workers : int
+        number of worker processes
+
+    Output:
+    -------
+
+    records : list
+        the records of the first sweep
+    """
+    import time
+    import tempfile
+    import numpy as np
+    from .args import args
+    from .store import grid_store
+    from .const import year
+    from .wrapper import model_wrapper
+
+    base = args(nr=50, nt=5, na=30, tmax=1e5 * year)
+    overrides = grid(alpha=[1e-3, 1e-2], vfrag=[300., 1000.]) + [{'T': _sweep_test_T, 'tempevol': True}, {'nr': 0}]
+    records = run(overrides, base=base, workers=workers)
+
+    assert [rec.index for rec in records] == list(range(len(overrides))), 'records are not in submission order'
+    assert [rec.overrides for rec in records] == overrides
+    assert all(rec.ok for rec in records[:-2]), 'a valid model failed'
+    assert records[-2].status == 'failed' and 'time step got too short' in records[-2].error, 'failure not recorded'
+    assert records[-1].status == 'failed' and 'IndexError' in records[-1].error, 'failure not recorded'
+
+    ARGS = args(nr=50, nt=5, na=30, tmax=1e5 * year, alpha=1e-2, vfrag=300.)
+    ref = model_wrapper(ARGS)
+    for name in ['sigma_g', 'sigma_d', 'a_t', 'sig_sol']:
+        assert np.array_equal(getattr(ref, name), getattr(records[2].result, name)), name + ' differs in the sweep'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stored = run(overrides[:2], base=base, workers=workers, store=tmp, timeout=600)
+        results = grid_store(tmp)
+        for rec in stored:
+            assert rec.ok and rec.result is None
+            i, = results.select(meta={'sweep_index': rec.index})
+            assert np.array_equal(results[i].sigma_d, records[rec.index].result.sigma_d), 'stored model differs'
+
+    start = time.perf_counter()
+    slow = run([{'nr': 500, 'nt': 50, 'tmax': 1e7 * year}], base=base, workers=1, timeout=0.5)
+    assert slow[0].status == 'timeout', 'the timeout did not stop the model'
+    assert time.perf_counter() - start < 30, 'the timeout took too long to stop the model'
+
+    return records
@@ -2,7 +2,90 @@ from .const import k_b, mu, m_p, Grav, sig_h2
 import numpy as np
 
 
-def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FRAG, RHO_S, E_drift, stokesregime=False, E_stick=1., nogrowth=False, a_grow_prev=None, dt=None):
+class grid_context(object):
+    """
+    Quantities of `get_size_limits` and `get_velocities_diffusion` that only
+    depend on the grid, the temperature, alpha and the stellar mass. It is
+    created once per run and passed as `ctx` to both functions; `update`
+    recomputes it only if T, alpha or m_star changed.
+
+    Arguments:
+    ----------
+
+    x : array
+        radial grid (nr)                       [cm]
+
+    T : array
+        temperature (nr)                       [K]
+
+    alpha : array
+        turbulence parameter (nr)              [-]
+
+    m_star : float
+        stellar mass                           [g]
+
+    Attributes:
+    -----------
+
+    x2 : x**2
+    om2, o_k : squared and keplerian frequency [s^-2], [s^-1]
+    v_k : keplerian velocity                   [cm s^-1]
+    cs2, cs : squared and isothermal sound speed [cm^2 s^-2], [cm s^-1]
+    H : pressure scale height                  [cm]
+    n_fac : sqrt(2 pi) H mu m_p, the gas number density is sigma_g / n_fac
+    v_dr_fac : the drift velocity is v_dr_fac * gamma [cm s^-1]
+    D : the diffusion constant alpha cs2 / o_k  [cm^2 s^-1]
+
+    v_dr_fac and D are only computed when they are first used.
+
+    All arrays broadcast like the arguments, so that an ensemble of models
+    with arrays of shape (n_models, nr) can be treated as well.
+    """
+
+    def __init__(self, x, T, alpha, m_star):
+        self.x = x
+        self.x2 = x**2
+        self.T = None
+        self.update(T, alpha, m_star)
+
+    def update(self, T, alpha, m_star):
+        """
+        Recompute the quantities if T, alpha or m_star differ from those of
+        the last call. Returns True if they were recomputed.
+        """
+        if self.T is not None and np.array_equal(m_star, self.m_star) and np.array_equal(T, self.T) and \
+                np.array_equal(alpha, self.alpha):
+            return False
+        x = self.x
+        self.T = np.array(T, copy=True)
+        self.alpha = np.array(alpha, copy=True)
+        self.m_star = np.array(m_star, copy=True)
+
+        self.om2 = Grav * m_star / x**3
+        self.o_k = np.sqrt(self.om2)
+        self.v_k = np.sqrt(Grav * m_star / x)
+        self.cs2 = k_b * T / mu / m_p
+        self.cs = np.sqrt(self.cs2)
+        self.H = self.cs / self.o_k
+        self.n_fac = np.sqrt(2.0 * np.pi) * self.H * mu * m_p
+        self._v_dr_fac = None
+        self._D = None
+        return True
+
+    @property
+    def v_dr_fac(self):
+        if self._v_dr_fac is None:
+            self._v_dr_fac = self.cs2 / (2 * self.o_k * self.x)
+        return self._v_dr_fac
+
+    @property
+    def D(self):
+        if self._D is None:
+            self._D = self.alpha * k_b * self.T / mu / m_p / self.o_k
+        return self._D
+
+
+def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FRAG, RHO_S, E_drift, stokesregime=False, E_stick=1., nogrowth=False, a_grow_prev=None, dt=None, ctx=None):
     """
     This model takes a snapshot of temperature, gas surface density and so on
     and calculates the representative sizes which are
@@ -72,6 +155,16 @@ def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FR
     dt : None | float
         to treat the evolution of the growth limit better, the time step can be passed
 
+    ctx : None | grid_context
+        the quantities that depend only on x, T, alpha and m_star, which
+        need to be those passed here. Computed if not given.
+
+    Note:
+    -----
+
+    Several models on the same grid can be treated at once by passing all
+    arrays with shape (n_models, nr) and the scalars as (n_models, 1) arrays.
+
     Returns:
     --------
 
@@ -106,31 +199,32 @@ def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FR
     fudge_fr = 0.37
     fudge_dr = 0.55
 
+    if ctx is None:
+        ctx = grid_context(x, T, alpha, m_star)
+
     n_r = len(x)
     #
     # calculate the pressure power-law index
     #
-    P = sigma_g * np.sqrt(Grav * m_star / x**3) * np.sqrt(k_b * T / mu / m_p)
-    gamma = np.zeros(n_r)
-    gamma[1:n_r - 1] = x[1:n_r - 1] / P[1:n_r - 1] * \
-        (P[2:n_r] - P[0:n_r - 2]) / (x[2:n_r] - x[0:n_r - 2])
-    gamma[0] = gamma[1]
-    gamma[-1] = gamma[-2]
+    P = sigma_g * ctx.o_k * ctx.cs
+    gamma = np.zeros(np.shape(P))
+    gamma[..., 1:n_r - 1] = x[1:n_r - 1] / P[..., 1:n_r - 1] * \
+        (P[..., 2:n_r] - P[..., 0:n_r - 2]) / (x[2:n_r] - x[0:n_r - 2])
+    gamma[..., 0] = gamma[..., 1]
+    gamma[..., -1] = gamma[..., -2]
 
     #
     # calculate the sizes
     #
-    o_k = np.sqrt(Grav * m_star / x**3)
+    o_k = ctx.o_k
     #
     # calculate the mean free path of the particles
     #
-    cs = np.sqrt(k_b * T / mu / m_p)
-    H = cs / o_k
-    n = sigma_g / (np.sqrt(2.0 * np.pi) * H * mu * m_p)
+    n = sigma_g / ctx.n_fac
     lambd = 0.5 / (sig_h2 * n)
     if nogrowth:
-        mask = np.ones(n_r) == 1  # noqa
-        a_max = a_0 * np.ones(n_r)  # noqa
+        mask = np.ones(np.shape(P)) == 1  # noqa
+        a_max = a_0 * np.ones(np.shape(P))  # noqa
         a_max_t = a_max         # noqa
         a_max_t_out = a_max         # noqa
         a_fr = a_max         # noqa
@@ -142,16 +236,16 @@ def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FR
             (3 * np.pi * alpha * RHO_S * k_b * T / mu / m_p)
         # calculate the grain size in case of the Stokes regime
         if stokesregime:
-            a_fr_stokes = np.sqrt(3 / (2 * np.pi)) * np.sqrt((sigma_g * lambd) / (alpha * RHO_S)) * V_FRAG / (np.sqrt(k_b * T / mu / m_p))
+            a_fr_stokes = np.sqrt(3 / (2 * np.pi)) * np.sqrt((sigma_g * lambd) / (alpha * RHO_S)) * V_FRAG / ctx.cs
             a_fr = np.minimum(a_fr_ep, a_fr_stokes)
         else:
             a_fr = a_fr_ep
 
         a_dr = E_stick * fudge_dr / E_drift * 2 / np.pi * sigma_d_t / RHO_S * \
-            x**2 * (Grav * m_star / x**3) / (abs(gamma) * (k_b * T / mu / m_p))
+            ctx.x2 * ctx.om2 / (abs(gamma) * ctx.cs2)
         N = 0.5
-        a_df = fudge_fr * 2 * sigma_g / (RHO_S * np.pi) * V_FRAG * np.sqrt(
-            Grav * m_star / x) / (abs(gamma) * k_b * T / mu / m_p * (1 - N))
+        a_df = fudge_fr * 2 * sigma_g / (RHO_S * np.pi) * V_FRAG * ctx.v_k / (
+            abs(gamma) * k_b * T / mu / m_p * (1 - N))
         a_df = np.maximum(a_0, a_df)
 
         #
@@ -170,7 +264,7 @@ def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FR
         a_max = np.maximum(a_0, np.minimum(a_df, a_max))
         a_max_out = np.minimum(a_df, a_max)
         # mask      = all([a_dr<a_fr,a_dr<a_df],0)
-        mask_drift = np.array([adr < afr and adr < adf for adr, afr, adf in zip(a_dr, a_fr, a_df)])
+        mask_drift = (a_dr < a_fr) & (a_dr < a_df)
 
         ###
         #
@@ -208,7 +302,7 @@ def get_size_limits(t, sigma_d_t, x, sigma_g, v_gas, T, alpha, m_star, a_0, V_FR
         }
 
 
-def get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha, mask_drift):
+def get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha, mask_drift, ctx=None):
     """Calculate the velocities and diffusion constants in the two-pop approach.
 
     Parameters
@@ -231,6 +325,9 @@ def get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha, mask_dr
         turbulence parameter
     mask_drift : array
         boolean mask where the drift limit applies
+    ctx : None | grid_context
+        the quantities that depend only on x, T, alpha and the stellar
+        mass, see `get_size_limits`
 
     Returns
     -------
@@ -251,7 +348,10 @@ def get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha, mask_dr
     #
     # Second: drift velocity
     #
-    v_dr = k_b * T / mu / m_p / (2 * o_k * x) * gamma
+    if ctx is None:
+        v_dr = k_b * T / mu / m_p / (2 * o_k * x) * gamma
+    else:
+        v_dr = ctx.v_dr_fac * gamma
     #
     # level of at the peak position
     #
@@ -268,7 +368,10 @@ def get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha, mask_dr
     #
     # calculate the diffusivity
     #
-    D = alpha * k_b * T / mu / m_p / o_k
+    if ctx is None:
+        D = alpha * k_b * T / mu / m_p / o_k
+    else:
+        D = ctx.D.copy()
 
     return {
         'v_bar': v_bar,
@@ -276,3 +379,58 @@ def get_velocities_diffusion(x, gamma, v_gas, St_0, St_1, T, o_k, alpha, mask_dr
         'v_0': v_0,
         'v_1': v_1,
         'f_m': f_m}
+
+
+def grid_context_test(nr=500):
+    """
+    Check that `get_size_limits` and `get_velocities_diffusion` give
+    identical results with and without a `grid_context`, in both drag
+    regimes, and that the context is only recomputed if T, alpha or the
+    stellar mass change.
+
+    Keywords:
+    ---------
+
+    nr : int
+        number of radial grid points
+
+    Output:
+    -------
+
+    speedup : float
+        ratio of the time of both functions without and with a context
+    """
+    import timeit
+    from .const import AU, M_sun, year
+
+    x = np.logspace(-1, 3, nr) * AU
+    T = 200 * (x / AU)**-0.5 + 10
+    alpha = 1e-3 * np.ones(nr)
+    sig_g = 1e3 * (x / AU)**-1 * np.exp(-x / (50 * AU))
+    sig_d = 0.01 * sig_g
+    v_gas = -1e2 * (x / AU)**0.5
+    a_grow = 1e-4 * np.ones(nr)
+
+    ctx = grid_context(x, T, alpha, M_sun)
+
+    def both(ctx, stokesregime=False):
+        sl = get_size_limits(1e3 * year, sig_d, x, sig_g, v_gas, T, alpha, M_sun, 1e-5, 1000., 1.6, 1.,
+                             stokesregime=stokesregime, a_grow_prev=a_grow, dt=year, ctx=ctx)
+        vel = get_velocities_diffusion(x, sl['gamma'], v_gas, sl['St_0'], sl['St_1'], T, sl['o_k'], alpha,
+                                       sl['mask_drift'], ctx=ctx)
+        return sl, vel
+
+    for stokesregime in [False, True]:
+        for ref, res in zip(both(None, stokesregime), both(ctx, stokesregime)):
+            for key in ref:
+                assert np.array_equal(ref[key], res[key]), '{} differs with a context'.format(key)
+
+    assert not ctx.update(T.copy(), alpha.copy(), M_sun), 'context recomputed without a change'
+    for args in [(1.1 * T, alpha, M_sun), (T, 2 * alpha, M_sun), (T, alpha, 2 * M_sun)]:
+        assert ctx.update(*args), 'context not recomputed after a change'
+        assert np.array_equal(ctx.D, args[1] * k_b * args[0] / mu / m_p / np.sqrt(Grav * args[2] / x**3))
+    ctx.update(T, alpha, M_sun)
+
+    t_ref = min(timeit.repeat(lambda: both(None), number=200, repeat=3))
+    t_ctx = min(timeit.repeat(lambda: both(ctx), number=200, repeat=3))
+    return t_ref / t_ctx
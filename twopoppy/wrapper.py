@@ -32,17 +32,26 @@ results are reproducible, as the code can change.
 """
 import gzip
 import bz2
+import lzma
 import os
 import sys
 import pickle
 from .args import args
 from .results import results
+from .compression import chunked_file, MAGIC as _chunked_magic
 from .distribution_reconstruction import reconstruct_size_distribution
 
+
+def _open_raw(fname, mode='rb'):
+    return open(fname, mode[0] + 'b')
+
+
 compressors = {
-    'no match': [open, 'raw'], 'raw': [open, 'raw'],
+    'no match': [_open_raw, 'raw'], 'raw': [_open_raw, 'raw'],
     'gzip': [gzip.GzipFile, 'pgz'], 'gz': [gzip.GzipFile, 'pgz'],
-    'bz2': [bz2.BZ2File, 'pbz2']}
+    'bz2': [bz2.BZ2File, 'pbz2'],
+    'xz': [lzma.LZMAFile, 'pxz'], 'lzma': [lzma.LZMAFile, 'pxz'],
+    'chunked': [chunked_file, 'pzc']}
 
 
 class task_status(object):
@@ -100,15 +109,20 @@ def get_compression_type(filename):
 
     - gz
     - bz2
+    - xz
+    - chunked (see `compression.chunked_file`)
     - zip
 
-    that name will be returned.
+    that name will be returned. If the file cannot be read, the type is
+    guessed from the file extension.
 
     """
     magic_dict = {
-        "\x1f\x8b\x08": "gz",
-        "\x42\x5a\x68": "bz2",
-        "\x50\x4b\x03\x04": "zip"
+        b"\x1f\x8b\x08": "gz",
+        b"\x42\x5a\x68": "bz2",
+        b"\xfd\x37\x7a\x58\x5a\x00": "xz",
+        _chunked_magic: "chunked",
+        b"\x50\x4b\x03\x04": "zip"
         }
 
     max_len = max(len(x) for x in magic_dict)
@@ -130,9 +144,13 @@ def get_compression_type(filename):
 
 def load_grid_results(fname):
     """
-    Load list of grid results from file
+    Load list of grid results from file. This decompresses and unpickles the
+    whole list, see `store.grid_store` for large grids.
     """
-    compressor, suffix = compressors[get_compression_type(fname)]
+    compression = get_compression_type(fname)
+    if compression not in compressors:
+        raise NotImplementedError('cannot read {}-compressed file \'{}\''.format(compression, fname))
+    compressor, suffix = compressors[compression]
 
     with task_status('Loading {}-file \'{}\''.format(suffix, fname)), compressor(fname) as f:
         res = pickle.load(f)
@@ -156,7 +174,13 @@ def write_grid_results(res, fname, compression='gzip'):
     ---------
 
     compression : string
-        possible compression mechanisms are 'raw', 'pgz', 'pbz2'.
+        possible compression mechanisms are 'raw', 'gzip', 'bz2', 'xz' and
+        'chunked', which compresses independent chunks on all cores, see
+        `compression.chunked_file`.
+
+    The whole list is written as one compressed stream. For large grids, use
+    a `store.grid_store`, which appends one model at a time and can load
+    single models.
     """
     if compression not in compressors.keys():
         raise NameError('{} is not a defined compression method'.format(compression))
@@ -166,6 +190,59 @@ def write_grid_results(res, fname, compression='gzip'):
         pickle.dump(res, f)
 
 
+def grid_results_test(n=3, nr=200, nt=50):
+    """
+    Write a list of results with every compression, load it from a file with
+    a misleading extension, so that the type needs to be detected from the
+    content, and compare.
+
+    Keywords:
+    ---------
+
+    n : int
+        number of results in the list
+
+    nr, nt : int
+        shape of the fields
+
+    Output:
+    -------
+
+    sizes : dict
+        file size for every compression
+    """
+    import tempfile
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    res = []
+    for i in range(n):
+        r = results()
+        r.args = args(alpha=10.**-i)
+        r.x = np.logspace(0, 2, nr)
+        r.sigma_g = np.round(rng.lognormal(size=(nt, nr)), 3)
+        res.append(r)
+
+    sizes = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in ['raw', 'gzip', 'bz2', 'xz', 'chunked']:
+            fname = os.path.join(tmp, 'grid')
+            write_grid_results(res, fname, compression=compression)
+            suffix = compressors[compression][1]
+            os.replace(fname + os.path.extsep + suffix, fname + '.dat')
+
+            expected = compression.replace('gzip', 'gz').replace('raw', 'no match')
+            detected = get_compression_type(fname + '.dat')
+            assert detected == expected, 'detected {} instead of {}'.format(detected, expected)
+
+            loaded = load_grid_results(fname + '.dat')
+            for a, b in zip(res, loaded):
+                assert a.args.alpha == b.args.alpha
+                assert np.array_equal(a.x, b.x) and np.array_equal(a.sigma_g, b.sigma_g), compression + ' round trip failed'
+            sizes[compression] = os.path.getsize(fname + '.dat')
+    return sizes
+
+
 def lbp_solution(R, gamma, nu1, mstar, mdisk, RC0, time=0):
     """
     Calculate Lynden-Bell & Pringle self similar solution.
@@ -257,7 +334,8 @@ def lbp_solution(R, gamma, nu1, mstar, mdisk, RC0, time=0):
         return sig_g.cgs.value, RC1.cgs.value
 
 
-def model_wrapper(ARGS, plot=False, save=False):
+def model_wrapper(ARGS, plot=False, save=False, fmt='npy', profile=False, stop=None, verbose=False,
+                  observer=None):
     """
     This is a wrapper for the two-population model `model.run`, in which
     the disk profile is a self-similar solution.
@@ -275,9 +353,31 @@ def model_wrapper(ARGS, plot=False, save=False):
     save : bool
           whether or not to write the data to disk
 
+    fmt : str
+          output format if save is true, 'npy' (binary) or 'txt' (text),
+          see `results.write`
+
+    profile : bool
+          whether to record the time spent in the phases of the time steps,
+          see `model.run_stats`
+
+    stop : None | list
+          `stops.stop_condition`s that end the run early, the results then
+          only contain the snapshots before the stop
+
+    verbose : bool
+          whether to print the module description, the table of the model
+          parameters and the other messages and banners, including that of
+          `results.write`
+
+    observer : None | observer
+          receives the progress of the run, see `model.run` and
+          `twopoppy.observers`
+
     Output:
     -------
-    results : instance of the results object
+    results : instance of the results object, its `stats` attribute holds
+              the `model.run_stats` of the run
     """
     import numpy as np
     from . import model
@@ -315,10 +415,11 @@ def model_wrapper(ARGS, plot=False, save=False):
     #
     # print setup
     #
-    print(__doc__)
-    print('\n' + 48 * '-')
-    print('Model parameters:')
-    ARGS.print_args()
+    if verbose:
+        print(__doc__)
+        print('\n' + 48 * '-')
+        print('Model parameters:')
+        ARGS.print_args()
     #
     # ===========
     # SETUP MODEL
@@ -349,7 +450,8 @@ def model_wrapper(ARGS, plot=False, save=False):
     if isinstance(alpha, (list, tuple, np.ndarray)):
         def alpha_fct(x, locals_):
             return alpha
-        print('alpha given as array, ignoring gamma index when setting alpha')
+        if verbose:
+            print('alpha given as array, ignoring gamma index when setting alpha')
     elif hasattr(alpha, '__call__'):
         alpha_fct = alpha
     elif isinstance(alpha, Number):
@@ -377,11 +479,16 @@ def model_wrapper(ARGS, plot=False, save=False):
     sigma_g = sigma_g / np.trapz(2 * np.pi * x * sigma_g, x=x) * mdisk
     sigma_d = sigma_g * d2g
 
-    # call the model
+    # call the model, a static alpha is passed as array, such that
+    # model.run can use the self-similar gas solution if it applies
 
+    alpha_run = alpha_fct if hasattr(alpha, '__call__') else np.asarray(alpha_fct(x, None), dtype=float)
+
+    stats = model.run_stats(profile=profile)
     TI, SOLD, SOLG, VD, VG, v_0, v_1, a_dr, a_fr, a_df, a_t, a_gr, Tout, alphaout, alphagasout = model.run(
-        x, a0, timesteps, sigma_g, sigma_d, v_gas, T, alpha_fct, mstar, vfrag, rhos, edrift,
-        stokesregime=stokesregime, E_stick=estick, nogrowth=False, gasevol=gasevol)
+        x, a0, timesteps, sigma_g, sigma_d, v_gas, T, alpha_run, mstar, vfrag, rhos, edrift,
+        stokesregime=stokesregime, E_stick=estick, nogrowth=False, gasevol=gasevol, stats=stats,
+        stop=stop, truncate=True, observer=observer)
 
     #
     # ================================
@@ -389,10 +496,11 @@ def model_wrapper(ARGS, plot=False, save=False):
     # ================================
     #
     a = np.logspace(np.log10(a0), np.log10(5 * a_t.max()), n_a)
-    print('\n' + 48 * '-')
+    if verbose:
+        print('\n' + 48 * '-')
+        print('reconstructing size distribution')
 
     try:
-        print('reconstructing size distribution')
         it = -1
         sig_sol, _, _, _, _, _ = reconstruct_size_distribution(
             x, a, TI[it], SOLG[it], SOLD[it], alpha * np.ones(nr), rhos, Tout[it], mstar, vfrag, a_0=a0, estick=estick)
@@ -424,7 +532,7 @@ def model_wrapper(ARGS, plot=False, save=False):
     else:
         res.alpha = alpha
 
-    res.timesteps = timesteps
+    res.timesteps = timesteps[:len(TI)]
     res.v_gas     = VG      # noqa
     res.v_dust    = VD      # noqa
     res.v_0       = v_0     # noqa
@@ -435,11 +543,12 @@ def model_wrapper(ARGS, plot=False, save=False):
     res.a_t       = a_t     # noqa
     res.args      = ARGS    # noqa
     res.a         = a       # noqa
+    res.stats     = stats   # noqa
 
     res.sig_sol = sig_sol
 
     if save:
-        res.write()
+        res.write(fmt=fmt, verbose=verbose)
     #
     # ========
     # PLOTTING
@@ -479,9 +588,10 @@ def model_wrapper(ARGS, plot=False, save=False):
 
         plt.show()
 
-    print(48 * '-' + '\n')
-    print('ALL DONE'.center(48))
-    print('\n' + 48 * '-')
+    if verbose:
+        print(48 * '-' + '\n')
+        print('ALL DONE'.center(48))
+        print('\n' + 48 * '-')
     return res
 
 